@@ -0,0 +1,75 @@
+"""Compares extutil.jsonable with the json.dumps/json.loads round trip creturn used before,
+on payloads shaped like describe_repositories and describe_images responses.
+
+    python benchmarks/bench_creturn.py [--repositories 300] [--images 1000] [--logs 300]
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "repo"))
+
+from extutil import jsonable, defaultconverter
+
+def round_trip(o):
+    return json.loads(json.dumps(o, default=defaultconverter))
+
+def gen_payload(repositories, images, logs):
+    now = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    return {
+        "statusCode": 200,
+        "progress": 100,
+        "success": True,
+        "props": {
+            "repositories": {
+                f"repo-{i}": {
+                    "repositoryArn": f"arn:aws:ecr:us-east-1:123456789012:repository/repo-{i}",
+                    "registryId": "123456789012",
+                    "repositoryName": f"repo-{i}",
+                    "repositoryUri": f"123456789012.dkr.ecr.us-east-1.amazonaws.com/repo-{i}",
+                    "createdAt": now - datetime.timedelta(days=i),
+                    "imageTagMutability": "MUTABLE",
+                    "imageScanningConfiguration": {"scanOnPush": bool(i % 2)},
+                    "encryptionConfiguration": {"encryptionType": "AES256"},
+                    "tags": {f"key-{t}": f"value-{t}" for t in range(10)}
+                } for i in range(repositories)
+            },
+            "images": [{
+                "registryId": "123456789012",
+                "repositoryName": "repo-0",
+                "imageDigest": f"sha256:{i:064x}",
+                "imageTags": [f"v{i}", f"build-{i}"],
+                "imageSizeInBytes": 123456789 + i,
+                "imagePushedAt": now - datetime.timedelta(hours=i),
+                "imageManifestMediaType": "application/vnd.docker.distribution.manifest.v2+json",
+                "lastRecordedPullTime": now - datetime.timedelta(minutes=i)
+            } for i in range(images)]
+        },
+        "logs": [{
+            "title": f"Log {i}",
+            "details": {"name": f"repo-{i}", "time": now, "count": i},
+            "is_error": False
+        } for i in range(logs)]
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repositories", type=int, default=300)
+    parser.add_argument("--images", type=int, default=1000)
+    parser.add_argument("--logs", type=int, default=300)
+    parser.add_argument("--number", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    payload = gen_payload(args.repositories, args.images, args.logs)
+    assert jsonable(payload) == round_trip(payload)
+
+    for name, func in [("round trip", round_trip), ("jsonable", jsonable)]:
+        best = min(timeit.repeat(lambda: func(payload), number=args.number, repeat=args.repeat)) / args.number
+        print(f"{name:>10}: {best * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Per-call validation cost of fastjsonschema.validate, which compiles the schema every time,
+against the cached validators from extutil.get_validator.
+
+    python benchmarks/bench_validators.py [--number 2000]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "repo"))
+
+import fastjsonschema
+from extutil import INVOKE_EXTENSION_SCHEMA, get_validator
+from lambda_function import COMPONENT_DEF_SCHEMA
+
+INVOKE_EXTENSION_PAYLOAD = {
+    "arn": "arn:aws:lambda:us-east-1:123456789012:function:ck-codebuild-project",
+    "component_def": {"name": "build", "container_image": "aws/codebuild/standard:6.0"},
+    "child_key": "Codebuild Project",
+    "progress_start": 20,
+    "progress_end": 30,
+    "op": "upsert",
+    "merge_props": False,
+    "synchronous": None
+}
+
+REPO_COMPONENT_DEF = {
+    "changeable_tags": "IMMUTABLE",
+    "scan_on_push": True,
+    "tags": {"Environment": "Production", "Team": "Platform"},
+    "lifecycle_policy": {"rules": [{"rulePriority": 1, "selection": {"tagStatus": "untagged", "countType": "imageCountMoreThan", "countNumber": 10}, "action": {"type": "expire"}}]}
+}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    for name, schema, payload in [
+        ("invoke_extension", INVOKE_EXTENSION_SCHEMA, INVOKE_EXTENSION_PAYLOAD),
+        ("repo component_def", COMPONENT_DEF_SCHEMA, REPO_COMPONENT_DEF)
+    ]:
+        number = max(1, args.number // 50)
+        uncached = timeit.timeit(lambda: fastjsonschema.validate(schema, payload), number=number) / number
+        get_validator(schema)
+        cached = timeit.timeit(lambda: get_validator(schema)(payload), number=args.number) / args.number
+        print(f"{name:>20}: fastjsonschema.validate {uncached * 1e6:.0f} us, get_validator {cached * 1e6:.1f} us")
+
+if __name__ == "__main__":
+    main()
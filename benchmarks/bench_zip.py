@@ -0,0 +1,65 @@
+"""Times create_zip against the serial zipfile.write loop it replaced, on a generated tree 
+of source-like (compressible) and already-compressed (random) files.
+
+    python benchmarks/bench_zip.py [--files 400] [--file-kb 256] [--workers 1 2 4 8]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "repo"))
+
+from extutil import create_zip
+
+def serial_zip(file_name, path):
+    with zipfile.ZipFile(file_name, 'w', zipfile.ZIP_DEFLATED) as ziph:
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                ziph.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), os.path.join(path, '')))
+
+def gen_tree(path, files, file_kb):
+    rng = random.Random(0)
+    words = [bytes(rng.choice(b"abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10))) for _ in range(2000)]
+    for i in range(files):
+        folder = os.path.join(path, f"pkg{i % 20}")
+        os.makedirs(folder, exist_ok=True)
+        if i % 4 == 3:
+            data = rng.randbytes(file_kb * 1024)
+            name = f"asset{i}.png"
+        else:
+            data = b" ".join(rng.choice(words) for _ in range(file_kb * 160))[:file_kb * 1024]
+            name = f"module{i}.py"
+        with open(os.path.join(folder, name), "wb") as f:
+            f.write(data)
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=400)
+    parser.add_argument("--file-kb", type=int, default=256)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = os.path.join(tmp, "tree")
+        gen_tree(tree, args.files, args.file_kb)
+        out = os.path.join(tmp, "out.zip")
+        print(f"{args.files} files of {args.file_kb} KB, {os.cpu_count()} CPUs")
+
+        print(f"{'serial zipfile.write':>32}: {timed(serial_zip, out, tree):.2f} s, {os.path.getsize(out)} bytes")
+        for workers in args.workers:
+            seconds = timed(create_zip, out, tree, reproducible=True, max_workers=workers)
+            print(f"{f'create_zip, {workers} workers':>32}: {seconds:.2f} s, {os.path.getsize(out)} bytes")
+        seconds = timed(create_zip, out, tree, reproducible=True, store_extensions=(".png",))
+        print(f"{'create_zip, .png stored':>32}: {seconds:.2f} s, {os.path.getsize(out)} bytes")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Cold import time of each lambda, from python -X importtime, and the modules that
+extutil defers to first use (boto3, fastjsonschema, zipfile) that got imported anyway.
+
+    python benchmarks/importtime.py [--repeat 5] [--top 10]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDAS = ["repo", "image", "pullthrough"]
+DEFERRED_MODULES = ["boto3", "fastjsonschema", "zipfile"]
+
+def import_times(folder):
+    """Returns {module: cumulative microseconds} for one cold import of folder's lambda_function"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import lambda_function"],
+        cwd=os.path.join(ROOT, folder), capture_output=True, text=True, check=True,
+        env={**os.environ, "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION") or "us-east-1"}
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    for folder in LAMBDAS:
+        runs = [import_times(folder) for _ in range(args.repeat)]
+        best = min(runs, key=lambda t: t["lambda_function"])
+        print(f"{folder}: lambda_function {best['lambda_function'] / 1000:.1f} ms (best of {args.repeat})")
+        top_level = sorted(((t, n) for n, t in best.items() if "." not in n and n != "lambda_function"), reverse=True)
+        for t, name in top_level[:args.top]:
+            print(f"  {name:<24} {t / 1000:8.1f} ms")
+        loaded = [m for m in DEFERRED_MODULES if m in best]
+        print(f"  deferred modules imported: {', '.join(loaded) or 'none'}")
+
+if __name__ == "__main__":
+    main()
@@ -6,11 +6,18 @@ import base64
 import hashlib
 import uuid
 import os
-import boto3
-import botocore
-import zipfile
-import fastjsonschema
+import threading
+import copy
+import io
+import random
+import zlib
+import sys
 
+# boto3, zipfile and fastjsonschema are imported where they are used, 
+# so cold starts only pay for what the invocation actually needs
+from botocore.exceptions import ClientError, BotoCoreError
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
 
 NAME_REGEX = r"^[a-zA-Z0-9\-\_]+$"
@@ -18,6 +25,106 @@ LOWERCASE_NAME_REGEX = r"^[a-z0-9\-\_]+$"
 NO_UNDERSCORE_NAME_REGEX = r"^[a-zA-Z0-9\-]+$"
 NO_UNDERSCORE_LOWERCASE_NAME_REGEX = r"^[a-z0-9\-]+$"
 
+# Every setting can be overridden with the matching boto_* environment variable
+CLIENT_DEFAULTS = {
+    "max_pool_connections": 25,
+    "connect_timeout": 5,
+    "read_timeout": 60,
+    "max_attempts": 5,
+    "retry_mode": "adaptive",
+    # Client-side token bucket shared by every op in the process, 0 turns it off
+    "rate_limit_per_sec": 20.0,
+    "rate_limit_burst": 40.0
+}
+# RequestResponse invokes wait for the child extension to finish
+SERVICE_CLIENT_DEFAULTS = {
+    "lambda": {"read_timeout": 900},
+    "codebuild": {"rate_limit_per_sec": 10.0, "rate_limit_burst": 20.0}
+}
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+_call_recorders = []
+_call_recorders_lock = threading.Lock()
+
+# Backoff for retried errors, looked up by error code, then by the error itself.
+# The callback delay is a random value between 0 and min(cap, base * 2**retries) seconds
+RETRY_POLICIES = {
+    "default": {"base": 1, "cap": 60, "jitter": True, "max_attempts": 6},
+    "ThrottlingException": {"base": 2, "cap": 120, "jitter": True, "max_attempts": 10},
+    "Throttling": {"base": 2, "cap": 120, "jitter": True, "max_attempts": 10},
+    "TooManyRequestsException": {"base": 2, "cap": 120, "jitter": True, "max_attempts": 10},
+    "RequestLimitExceeded": {"base": 2, "cap": 120, "jitter": True, "max_attempts": 10},
+    "ServiceUnavailableException": {"base": 2, "cap": 60, "jitter": True, "max_attempts": 8},
+    "ServerException": {"base": 1, "cap": 30, "jitter": True, "max_attempts": 8},
+    "RequestTimeout": {"base": 1, "cap": 30, "jitter": True, "max_attempts": 8},
+    "EndpointConnectionError": {"base": 1, "cap": 30, "jitter": True, "max_attempts": 8},
+    "ReadTimeoutError": {"base": 1, "cap": 30, "jitter": True, "max_attempts": 8},
+    # Eventual consistency after a build, worth waiting on but not for long
+    "Object Not Found": {"base": 2, "cap": 30, "jitter": True, "max_attempts": 6},
+    "Image Tags Not Found": {"base": 2, "cap": 20, "jitter": True, "max_attempts": 8},
+    "Platform Images Not Found": {"base": 2, "cap": 20, "jitter": True, "max_attempts": 8}
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+INVOKE_EXTENSION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "arn": {"type": "string"},
+        "component_def": {"type": "object"},
+        "child_key": {"type": "string"},
+        "progress_start": {"type": "number"},
+        "progress_end": {"type": "number"},
+        "object_name": {"type": ["string", "null"]},
+        "op": {"type": ["string", "null"]},
+        "merge_props": {"type": ["boolean", "null"]},
+        "links_prefix": {"type": ["string", "null"]},
+        "ignore_props_links": {"type": ["boolean", "null"]},
+        "synchronous": {"type": ["boolean", "null"]}
+    },
+    "required": ["arn", "component_def", "child_key", "progress_start", "progress_end"]
+}
+
+_validators = {}
+_validators_lock = threading.Lock()
+
+# Earliest time a zip entry can hold, used so reproducible archives don't depend on mtimes
+ZIP_FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# Members that are already compressed, so deflating them only costs time. Pass as store_extensions to store them
+ZIP_STORED_EXTENSIONS = (
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".br", ".jar", ".war", ".whl",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp3", ".mp4", ".woff", ".woff2"
+)
+# Bigger members are streamed through zipfile instead of being compressed in memory
+ZIP_MAX_PARALLEL_MEMBER_BYTES = 64 * 1024 * 1024
+# Members compressing or waiting to be written hold at most this much, or one member if it is bigger
+ZIP_MAX_WINDOW_BYTES = 256 * 1024 * 1024
+# S3 rejects smaller parts, except for the last one
+S3_MIN_PART_BYTES = 5 * 1024 * 1024
+S3_DEFAULT_PART_BYTES = 8 * 1024 * 1024
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+# Set debug_logs to restore full, untruncated dumps of events, responses and returns
+DEBUG_LOGS = (os.environ.get("debug_logs") or "").lower() in ["true", "1", "yes"]
+LOG_LEVEL = LOG_LEVELS["DEBUG"] if DEBUG_LOGS else LOG_LEVELS.get((os.environ.get("log_level") or "INFO").upper(), 20)
+LOG_DETAIL_MAX_CHARS = int(os.environ.get("log_detail_max_chars") or 4096)
+
+# API call metrics are printed at the end of each invocation in CloudWatch Embedded Metric Format
+EMF_METRICS = (os.environ.get("emf_metrics") or "true").lower() not in ["false", "0", "no"]
+EMF_NAMESPACE = os.environ.get("emf_namespace") or "CloudKommand/Extensions"
+# Per-service totals in each EMF line: (metric name, api_operations key it totals, unit). 
+# ApiLatency is added to them as each call's latency
+EMF_TOTALS = [
+    ("ApiCalls", "calls", "Count"), ("ApiErrors", "errors", "Count"), ("ApiThrottles", "throttles", "Count"),
+    ("ApiRetries", "retries", "Count"), ("ApiBytesIn", "bytes_in", "Bytes"), ("ApiBytesOut", "bytes_out", "Bytes")
+]
+EMF_MAX_VALUES = 100 # Values of one metric in one EMF line
+THROTTLE_ERROR_CODES = [
+    "ThrottlingException", "Throttling", "ThrottledException", "TooManyRequestsException", 
+    "RequestLimitExceeded", "SlowDown", "RequestThrottled", "RequestThrottledException"
+]
+
 def safe_encode(string):
     return base64.b32encode(string.encode("ascii")).decode("ascii").replace("=", "8")
 
@@ -98,15 +205,515 @@ def lambda_env(key):
     except Exception as e:
         raise e
 
-def create_zip(file_name, path):
-    ziph=zipfile.ZipFile(file_name, 'w', zipfile.ZIP_DEFLATED)
-    # ziph is zipfile handle
+def client_settings(service):
+    settings = {**CLIENT_DEFAULTS, **SERVICE_CLIENT_DEFAULTS.get(service, {})}
+    for k, v in settings.items():
+        override = lambda_env(f"boto_{k}")
+        if override:
+            settings[k] = type(v)(override)
+    return settings
+
+def client_config(service):
+    from botocore.config import Config
+
+    settings = client_settings(service)
+    return Config(
+        max_pool_connections=settings["max_pool_connections"],
+        connect_timeout=settings["connect_timeout"],
+        read_timeout=settings["read_timeout"],
+        tcp_keepalive=True,
+        retries={
+            "mode": settings["retry_mode"],
+            "max_attempts": settings["max_attempts"]
+        }
+    )
+
+def get_client(service, region_name=None):
+    """Returns one shared client per service and region, built on first use
+    so warm invocations reuse its connection pool"""
+    key = (service, region_name)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                import boto3
+                client = boto3.client(service, region_name=region_name, config=client_config(service))
+                limiter = get_rate_limiter(service)
+                if limiter:
+                    # Fires for every HTTP attempt, including botocore's own retries
+                    client.meta.events.register("before-send", limiter.before_send)
+                instrument_client(client)
+                _clients[key] = client
+    return client
+
+def instrument_client(client):
+    """Times every API call the client makes. Stubbed calls are included,
+    since the Stubber answers after parameters are built"""
+    client.meta.events.register("before-parameter-build", _start_api_call)
+    client.meta.events.register("before-call", _count_request_bytes)
+    client.meta.events.register("response-received", _count_attempt)
+    client.meta.events.register("after-call", _end_api_call)
+    client.meta.events.register("after-call-error", _end_api_call)
+
+def _start_api_call(model, context, **kwargs):
+    # after-call-error isn't passed the model, so the call is named here
+    context["ck_call"] = (model.service_model.service_name, model.name)
+    context["ck_call_start"] = time.perf_counter()
+    context["ck_throttles"] = 0
+
+def _count_request_bytes(params, context, **kwargs):
+    body = params.get("body")
+    context["ck_bytes_out"] = len(body) if isinstance(body, (bytes, bytearray, str)) else 0
+
+def _count_attempt(context, parsed_response=None, **kwargs):
+    # Fires once per HTTP attempt, so throttles that botocore retried away are counted too
+    if (parsed_response or {}).get("Error", {}).get("Code") in THROTTLE_ERROR_CODES:
+        context["ck_throttles"] = context.get("ck_throttles", 0) + 1
+
+def _end_api_call(context, http_response=None, parsed=None, exception=None, **kwargs):
+    if "ck_call" not in context:
+        return
+    start = context.get("ck_call_start")
+    parsed = parsed or {}
+    headers = http_response.headers if http_response is not None else {}
+    call = {
+        "service": context["ck_call"][0],
+        "operation": context["ck_call"][1],
+        "duration_ms": round((time.perf_counter() - start) * 1000, 3) if start else None,
+        "status_code": http_response.status_code if http_response is not None else None,
+        "error": type(exception).__name__ if exception else parsed.get("Error", {}).get("Code"),
+        "retries": parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+        # Stubbed responses skip response-received, so a throttled result counts at least once
+        "throttles": context.get("ck_throttles", 0) or int(parsed.get("Error", {}).get("Code") in THROTTLE_ERROR_CODES),
+        "bytes_out": context.get("ck_bytes_out", 0),
+        "bytes_in": int(headers.get("content-length") or 0)
+    }
+    with _call_recorders_lock:
+        recorders = list(_call_recorders)
+    for recorder in recorders:
+        recorder.record(call)
+
+class ApiCallRecorder:
+    """Records the API calls made through get_client clients while it is active,
+    from any thread, along with its own wall time. For example:
+
+        with ApiCallRecorder() as calls:
+            lambda_handler(event, context)
+        calls.check_counts({"ecr.DescribeRepositories": 1})
+    """
+    def __init__(self):
+        self.calls = []
+        self.wall_ms = None
+        self._start = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        with _call_recorders_lock:
+            _call_recorders.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def stop(self):
+        with _call_recorders_lock:
+            if self not in _call_recorders:
+                return
+            _call_recorders.remove(self)
+        self.wall_ms = round((time.perf_counter() - self._start) * 1000, 3)
+
+    def record(self, call):
+        with self._lock:
+            self.calls.append(call)
+
+    def sequence(self):
+        return [f"{c['service']}.{c['operation']}" for c in self.calls]
+
+    def counts(self):
+        return dict(Counter(self.sequence()))
+
+    def summary(self):
+        return {"wall_ms": self.wall_ms, "api_ms": round(sum(c["duration_ms"] or 0 for c in self.calls), 3), "counts": self.counts()}
+
+    def check_counts(self, expected):
+        """Raises AssertionError if any call was made more often than expected.
+        Calls missing from expected are allowed zero times"""
+        grown = {k: {"expected": expected.get(k, 0), "actual": v} for k, v in self.counts().items() if v > expected.get(k, 0)}
+        if grown:
+            raise AssertionError(f"API call counts grew: {grown}")
+
+    def emf(self, dimensions, properties=None):
+        """EMF documents for this invocation's API calls, one per service with a Service dimension,
+        so one service's latency and throttles can be alarmed on. ApiLatency lists each call's
+        latency, so its percentiles are per call. A service with more than EMF_MAX_VALUES calls
+        continues its latencies in more documents, which carry only ApiLatency. The breakdown by 
+        operation goes in the api_operations property, which Logs Insights can query, 
+        so it doesn't add a metric per operation"""
+        by_service = {}
+        for c in self.calls:
+            by_service.setdefault(c["service"], []).append(c)
+
+        documents = []
+        for service, calls in sorted(by_service.items()):
+            operations = {}
+            for c in calls:
+                op = operations.setdefault(f"{c['service']}.{c['operation']}", {
+                    "calls": 0, "errors": 0, "throttles": 0, "retries": 0, "latency_ms": 0, "bytes_in": 0, "bytes_out": 0
+                })
+                op["calls"] += 1
+                op["errors"] += int(bool(c["error"]))
+                op["throttles"] += c["throttles"]
+                op["retries"] += c["retries"]
+                op["latency_ms"] = round(op["latency_ms"] + (c["duration_ms"] or 0), 3)
+                op["bytes_in"] += c["bytes_in"]
+                op["bytes_out"] += c["bytes_out"]
+
+            service_dimensions = {**dimensions, "Service": service}
+            latencies = [round(c["duration_ms"] or 0, 3) for c in calls]
+            for i in range(0, len(latencies), EMF_MAX_VALUES):
+                totals = {name: sum(op[key] for op in operations.values()) for name, key, _ in EMF_TOTALS} if i == 0 else {}
+                documents.append({
+                    "_aws": {
+                        "Timestamp": int(time.time() * 1000),
+                        "CloudWatchMetrics": [{
+                            "Namespace": EMF_NAMESPACE,
+                            "Dimensions": [sorted(service_dimensions)],
+                            "Metrics": [
+                                {"Name": name, "Unit": unit} for name, _, unit in EMF_TOTALS if name in totals
+                            ] + [{"Name": "ApiLatency", "Unit": "Milliseconds"}]
+                        }]
+                    },
+                    **service_dimensions,
+                    **totals,
+                    "ApiLatency": latencies[i:i + EMF_MAX_VALUES],
+                    **(properties or {}),
+                    **({"api_operations": operations} if i == 0 else {})
+                })
+        return documents
+
+def get_rate_limiter(service):
+    """One limiter per service, shared by the clients of every region"""
+    with _rate_limiters_lock:
+        if service not in _rate_limiters:
+            settings = client_settings(service)
+            rate = settings["rate_limit_per_sec"]
+            _rate_limiters[service] = TokenBucket(rate, max(settings["rate_limit_burst"], 1)) if rate > 0 else None
+        return _rate_limiters[service]
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def before_send(self, **kwargs):
+        # Returning anything here would replace the HTTP response
+        self.acquire()
+
+class LazyClient:
+    """Module-level stand-in for a boto3 client that defers to get_client"""
+    def __init__(self, service, region_name=None):
+        self._service = service
+        self._region_name = region_name
+
+    def __getattr__(self, name):
+        return getattr(get_client(self._service, self._region_name), name)
+
+class TTLCache:
+    """Bounded LRU cache for the life of a warm container. Entries expire after ttl seconds.
+    Values are copied in and out so callers can't change cached entries by accident."""
+    def __init__(self, name, ttl=60, max_size=512):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and entry[0] > time.time():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            if entry:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, copy.deepcopy(value))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def update(self, key, func):
+        """Applies func to the cached value in place, if there is one"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and entry[0] > time.time():
+                func(entry[1])
+            elif entry:
+                del self._data[key]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        return {"name": self.name, "hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+def create_zip(file_name, path, reproducible=False, max_workers=None, compresslevel=6, store_extensions=None):
+    """Zips every file under path. reproducible=True gives byte-identical archives 
+    for identical trees, by sorting entries and fixing timestamps and permissions.
+    Everything is deflated by default. Pass store_extensions=ZIP_STORED_EXTENSIONS (or any 
+    tuple of extensions) to store already-compressed files, or True to store everything"""
+    with open(file_name, 'wb') as f:
+        write_zip(f, path, reproducible, max_workers, compresslevel, store_extensions)
+
+def write_zip(fileobj, path, reproducible=False, max_workers=None, compresslevel=6, store_extensions=None):
+    """Writes the zip to any writable file object. Members are compressed on a thread pool
+    (zlib releases the GIL) and written in order"""
+    import zipfile
+
+    max_workers = max_workers or min(8, os.cpu_count() or 1)
+    members = list(walk_zip_members(path, reproducible))
+
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as ziph:
+        if not zip_internals_available(ziph):
+            log("zipfile Internals Missing, Compressing Serially", {"python": sys.version}, level="WARNING")
+            for full_path, zinfo in members:
+                zinfo.compress_type = zip_compress_type(zinfo.filename, store_extensions)
+                write_zip_member(ziph, zinfo, None, full_path)
+            return
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # A window bounded by count and by bytes keeps only a few members in memory.
+            # Streamed members aren't read until they are written, so they add no bytes
+            pending = deque()
+            window_bytes = 0
+            for full_path, zinfo in members:
+                zinfo.compress_type = zip_compress_type(zinfo.filename, store_extensions)
+                size = zinfo.file_size if zinfo.file_size <= ZIP_MAX_PARALLEL_MEMBER_BYTES else 0
+                while pending and ((len(pending) >= max_workers * 2) or (window_bytes + size > ZIP_MAX_WINDOW_BYTES)):
+                    written = pending.popleft()
+                    write_zip_member(ziph, *written)
+                    window_bytes -= written[0].file_size if written[1] else 0
+                if zinfo.file_size > ZIP_MAX_PARALLEL_MEMBER_BYTES:
+                    pending.append((zinfo, None, full_path))
+                else:
+                    pending.append((zinfo, executor.submit(compress_zip_member, full_path, zinfo.compress_type, compresslevel), full_path))
+                    window_bytes += size
+            while pending:
+                write_zip_member(ziph, *pending.popleft())
+
+def create_zip_s3(bucket, key, path, s3_client=None, part_size=S3_DEFAULT_PART_BYTES, upload_workers=4, **zip_options):
+    """Streams the zip of path straight to s3://bucket/key without touching disk, 
+    and returns the new object's ETag. Takes the same options as create_zip"""
+    writer = S3MultipartWriter(bucket, key, s3_client, part_size, upload_workers)
+    try:
+        write_zip(writer, path, **zip_options)
+        return writer.complete()
+    except Exception:
+        writer.abort()
+        raise
+
+class S3MultipartWriter:
+    """A write-only file object that uploads each full part while the next one fills.
+    At most upload_workers + 1 parts are held in memory. Archives smaller than 
+    one part are sent with a single put_object"""
+    def __init__(self, bucket, key, s3_client=None, part_size=S3_DEFAULT_PART_BYTES, upload_workers=4):
+        if part_size < S3_MIN_PART_BYTES:
+            raise ValueError(f"part_size must be at least {S3_MIN_PART_BYTES} bytes")
+        self.bucket = bucket
+        self.key = key
+        self.s3 = s3_client or get_client("s3")
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+        self.executor = ThreadPoolExecutor(max_workers=upload_workers)
+        self.slots = threading.BoundedSemaphore(upload_workers + 1)
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, *args):
+        raise io.UnsupportedOperation("seek")
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, body):
+        if not self.upload_id:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+        part_number = len(self.parts) + 1
+        self.slots.acquire()
+        self.parts.append(self.executor.submit(self._send_part, part_number, body))
+
+    def _send_part(self, part_number, body):
+        try:
+            response = self.s3.upload_part(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                PartNumber=part_number, Body=body
+            )
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        finally:
+            self.slots.release()
+
+    def complete(self):
+        try:
+            if not self.upload_id:
+                return self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))["ETag"]
+
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+                self.buffer = bytearray()
+            parts = [f.result() for f in self.parts]
+            response = self.s3.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={"Parts": parts}
+            )
+            return response["ETag"]
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def abort(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        if self.upload_id:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except ClientError as e:
+                log("Abort Multipart Upload Failed", {"key": self.key, "error": str(e)}, level="WARNING")
+
+def walk_zip_members(path, reproducible=False):
+    import zipfile
+
     for root, dirs, files in os.walk(path):
+        if reproducible:
+            dirs.sort()
+            files.sort()
         for file in files:
-            ziph.write(os.path.join(root, file), 
-                       os.path.relpath(os.path.join(root, file), 
-                                       os.path.join(path, '')))
-    ziph.close()
+            full_path = os.path.join(root, file)
+            arcname = os.path.relpath(full_path, os.path.join(path, '')).replace(os.sep, "/")
+            if reproducible:
+                st = os.stat(full_path)
+                zinfo = zipfile.ZipInfo(arcname, ZIP_FIXED_DATE_TIME)
+                zinfo.file_size = st.st_size
+                zinfo.external_attr = (0o100755 if st.st_mode & 0o111 else 0o100644) << 16
+                zinfo.create_system = 3
+            else:
+                zinfo = zipfile.ZipInfo.from_file(full_path, arcname)
+            yield full_path, zinfo
+
+def zip_compress_type(arcname, store_extensions):
+    import zipfile
+
+    if store_extensions is True:
+        return zipfile.ZIP_STORED
+    elif store_extensions and arcname.lower().endswith(tuple(store_extensions)):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def compress_zip_member(full_path, compress_type, compresslevel):
+    import zipfile
+
+    with open(full_path, 'rb') as f:
+        data = f.read()
+    crc = zlib.crc32(data)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        return crc, len(data), compressor.compress(data) + compressor.flush()
+    return crc, len(data), data
+
+def zip_internals_available(ziph):
+    """Precompressed members are written through zipfile internals, which CPython doesn't promise
+    to keep. Without them every member goes through the public ZipFile.open instead"""
+    import zipfile
+
+    return hasattr(zipfile.ZipInfo, "FileHeader") and \
+        all(hasattr(ziph, attr) for attr in ["fp", "filelist", "NameToInfo", "start_dir"])
+
+def write_zip_member(ziph, zinfo, future, full_path):
+    """future holds the member's (crc, size, compressed data), or is None to stream the file through zipfile"""
+    if future is None:
+        with open(full_path, 'rb') as src, ziph.open(zinfo, 'w') as dest:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                dest.write(chunk)
+        return
+
+    zinfo.CRC, zinfo.file_size, data = future.result()
+    zinfo.compress_size = len(data)
+    zinfo.header_offset = ziph.fp.tell()
+    ziph.fp.write(zinfo.FileHeader(None))
+    ziph.fp.write(data)
+    ziph.filelist.append(zinfo)
+    ziph.NameToInfo[zinfo.filename] = zinfo
+    ziph.start_dir = ziph.fp.tell()
+
+def get_validator(schema):
+    """Compiles a fastjsonschema validator the first time a schema is seen and reuses it after.
+    Leave defaults out of schemas, fastjsonschema fills them into the validated data."""
+    key = json.dumps(schema, sort_keys=True)
+    validator = _validators.get(key)
+    if validator is None:
+        with _validators_lock:
+            validator = _validators.get(key)
+            if validator is None:
+                import fastjsonschema
+                validator = fastjsonschema.compile(schema)
+                _validators[key] = validator
+    return validator
+
+def validate_component_def(extension_handler, component_def, schema):
+    """Returns True if component_def matches schema, otherwise declares a permanent error"""
+    import fastjsonschema
+
+    try:
+        get_validator(schema)(component_def)
+        return True
+    except fastjsonschema.JsonSchemaException as e:
+        extension_handler.add_log("Invalid Component Definition", {"error": e.message}, is_error=True)
+        extension_handler.perm_error(f"Invalid Component Definition: {e.message}", 0)
+        return False
 
 def account_context(context):
     vals = context.invoked_function_arn.split(':')
@@ -115,6 +722,25 @@ def account_context(context):
         "region": vals[3]
     }
 
+def log(title, details=None, level="INFO"):
+    """Prints title and details if level is enabled. Details are only rendered when printed"""
+    if LOG_LEVELS[level] < LOG_LEVEL:
+        return
+    if details is None:
+        print(title)
+    else:
+        print(f"{title}: {truncate_details(details)}")
+
+def truncate_details(details, max_chars=None):
+    """Replaces details larger than the per record budget with a truncated preview"""
+    max_chars = max_chars or LOG_DETAIL_MAX_CHARS
+    if DEBUG_LOGS:
+        return details
+    rendered = details if isinstance(details, str) else json.dumps(details, default=str)
+    if len(rendered) <= max_chars:
+        return details
+    return {"truncated": True, "size": len(rendered), "preview": rendered[:max_chars]}
+
 def gen_log(title, details, is_error=False, link=None):
     return {
         "title": title,
@@ -128,6 +754,30 @@ def defaultconverter(o):
     if isinstance(o, datetime.datetime):
         return o.__str__()
 
+JSON_KEY_CONSTANTS = {True: "true", False: "false", None: "null"}
+
+def jsonable(o):
+    """Returns what json.loads(json.dumps(o, default=defaultconverter)) would, in one walk
+    and without building the intermediate string"""
+    if isinstance(o, str) or o is None or isinstance(o, bool):
+        return o
+    elif isinstance(o, dict):
+        return {jsonable_key(k): jsonable(v) for k, v in o.items()}
+    elif isinstance(o, (list, tuple)):
+        return [jsonable(v) for v in o]
+    elif isinstance(o, (int, float)):
+        return o
+    return jsonable(defaultconverter(o))
+
+def jsonable_key(k):
+    if isinstance(k, str):
+        return k
+    elif k is None or isinstance(k, bool):
+        return JSON_KEY_CONSTANTS[k]
+    elif isinstance(k, (int, float)):
+        return json.dumps(k)
+    raise TypeError(f"keys must be str, int, float, bool or None, not {k.__class__.__name__}")
+
 def creturn(status_code, progress, success=None, error=None, logs=None, pass_back_data=None, state=None, props=None, links=None, callback_sec=2, error_details={}):
     
     assembled = remove_none_attributes({
@@ -143,9 +793,16 @@ def creturn(status_code, progress, success=None, error=None, logs=None, pass_bac
         "logs": logs,
         "callback_sec":callback_sec
     })
-    print(f'assembled = {assembled}')
+    log("assembled", assembled, level="DEBUG")
 
-    return json.loads(json.dumps(assembled, default=defaultconverter))
+    return jsonable(assembled)
+
+def retry_delay(policy, retries):
+    ceiling = min(policy["cap"], policy["base"] * 2**retries)
+    if policy.get("jitter"):
+        # Full jitter, so components that failed together don't retry together
+        return max(1, round(random.uniform(0, ceiling)))
+    return max(1, round(ceiling))
 
 def handle_common_errors(error, extension_handler, text, progress, perm_errors=[]):
     if error.response['Error']['Code'] in perm_errors:
@@ -154,10 +811,83 @@ def handle_common_errors(error, extension_handler, text, progress, perm_errors=[
         print(f"Permanent Error: {text}: {str(error)}")
     else:
         extension_handler.add_log(f"{text}: {error.response['Error']['Code']}", {"error": str(error)}, True)
-        extension_handler.retry_error(f"{text}: {str(error)}", progress)
+        extension_handler.retry_error(f"{text}: {str(error)}", progress, retry_code=error.response['Error']['Code'])
         print(f"Retry Error: {text}: {str(error)}")
 
 
+_local_results = {}
+
+class LocalResultStore:
+    """Keeps async child returns in memory, or as files under path. 
+    A stand-in for S3ResultStore when running parents and children locally"""
+    def __init__(self, path=None):
+        self.path = path
+
+    def put(self, token, result):
+        if self.path:
+            with open(os.path.join(self.path, f"{token}.json"), "w") as f:
+                json.dump(result, f)
+        else:
+            _local_results[token] = result
+
+    def get(self, token):
+        if self.path:
+            try:
+                with open(os.path.join(self.path, f"{token}.json")) as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                return None
+        return _local_results.get(token)
+
+    def delete(self, token):
+        if self.path:
+            try:
+                os.remove(os.path.join(self.path, f"{token}.json"))
+            except FileNotFoundError:
+                pass
+        else:
+            _local_results.pop(token, None)
+
+    def describe(self):
+        return remove_none_attributes({"type": "local", "path": self.path})
+
+class S3ResultStore:
+    """Keeps async child returns as objects under prefix in bucket"""
+    def __init__(self, bucket, prefix="ck-async-results/"):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, token, result):
+        get_client("s3").put_object(Bucket=self.bucket, Key=f"{self.prefix}{token}.json", Body=json.dumps(result).encode())
+
+    def get(self, token):
+        try:
+            response = get_client("s3").get_object(Bucket=self.bucket, Key=f"{self.prefix}{token}.json")
+            return json.loads(response["Body"].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] in ["NoSuchKey", "404"]:
+                return None
+            raise e
+
+    def delete(self, token):
+        get_client("s3").delete_object(Bucket=self.bucket, Key=f"{self.prefix}{token}.json")
+
+    def describe(self):
+        return {"type": "s3", "bucket": self.bucket, "prefix": self.prefix}
+
+# Children write this next to the result token as soon as they start, so a parent can tell
+# a slow child from one that will never write its result
+ASYNC_ACK_SUFFIX = ".ack"
+# Puts of a child's result, with exponential backoff from the delay. The parent waits until its
+# async_timeout_sec on a result that was never stored
+ASYNC_RESULT_PUT_ATTEMPTS = 3
+ASYNC_RESULT_PUT_DELAY_SEC = 0.5
+
+def result_store_from_description(description):
+    if description.get("type") == "local":
+        return LocalResultStore(description.get("path"))
+    return S3ResultStore(description["bucket"], description.get("prefix") or "ck-async-results/")
+
 # def sort_f(td):
 #     return td['timestamp_usec']
 
@@ -184,11 +914,24 @@ class ExtensionHandler:
         self.repo_id = None
         self.bucket = None
         self.component_name = None
+        self.async_result = None
+        self.count_retry = True
+        self.retry_code = None
+        self._log_link = None
+        if getattr(self, "api_calls", None):
+            self.api_calls.stop()
+        self.api_calls = None
     
-    def __init__(self, ignore_undeclared_return=True, max_retries_per_error_code=6):
+    def __init__(self, ignore_undeclared_return=True, max_retries_per_error_code=6, max_op_workers=4, result_store=None, retry_policies=None):
         self.refresh()
         self.ignore_undelared_return = ignore_undeclared_return
         self.max_retries_per_error_code = max_retries_per_error_code
+        self.retry_policies = {**RETRY_POLICIES, **(retry_policies or {})}
+        self.max_op_workers = max_op_workers
+        self.result_store = result_store
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._parallel = False
 
     def capture_event(self, event):
         self.refresh()
@@ -199,6 +942,18 @@ class ExtensionHandler:
         self.bucket = event.get("bucket")
         self.component_name = event.get("component_name")
         self.op = event.get("op")
+        self.async_result = event.get("async_result")
+        if EMF_METRICS:
+            self.api_calls = ApiCallRecorder().start()
+        if self.async_result:
+            self.acknowledge_async_result()
+
+    def acknowledge_async_result(self):
+        token = self.async_result["token"]
+        try:
+            result_store_from_description(self.async_result["store"]).put(f"{token}{ASYNC_ACK_SUFFIX}", {"acknowledged_at": int(time.time())})
+        except ClientError as e:
+            log("Acknowledge Async Result Failed", {"token": token, "error": str(e)}, level="WARNING")
         
     def declare_pass_back_data(self, pass_back_data):
         pbd = pass_back_data.copy()
@@ -207,36 +962,24 @@ class ExtensionHandler:
         self.props = pbd.pop("props", {}) or {}
         self.links = pbd.pop("links", {}) or {}
         self.state = pbd.pop("state", {}) or {}
-        print(f"Ops = {self.ops}, Retries = {self.retries}, Links = {self.links}, Props = {self.props}")
+        log("Pass Back Data", {"ops": self.ops, "retries": self.retries, "links": self.links, "props": self.props}, level="DEBUG")
         self.children = pbd
         if pbd:
-            print(f"Set Children {self.children}")
+            log("Set Children", self.children, level="DEBUG")
 
     def invoke_extension(self, arn, component_def, child_key, 
             progress_start, progress_end, object_name=None, 
             op=None, merge_props=False, links_prefix=None,
-            ignore_props_links=False, synchronous=True):
-
-        schema = {
-            "type": "object",
-            "properties": {
-                "arn": {"type": "string"},
-                "component_def": {"type": "object"},
-                "child_key": {"type": "string"},
-                "progress_start": {"type": "number"},
-                "progress_end": {"type": "number"},
-                "object_name": {"type": ["string", "null"]},
-                "op": {"type": ["string", "null"]},
-                "merge_props": {"type": ["boolean", "null"]},
-                "links_prefix": {"type": ["string", "null"]},
-                "ignore_props_links": {"type": ["boolean", "null"]},
-                "synchronous": {"type": ["boolean", "null"]}
-            },
-            "required": ["arn", "component_def", "child_key", "progress_start", "progress_end"]
-        }
+            ignore_props_links=False, synchronous=True, 
+            poll_sec=None, async_timeout_sec=900, async_ack_timeout_sec=120):
+        """Invokes a child extension. With poll_sec set, the child is invoked with InvocationType Event
+        and this handler retries every poll_sec seconds, collecting the child's return from
+        self.result_store once the child has written it. A child that hasn't acknowledged 
+        the result token within async_ack_timeout_sec doesn't support async invocation, 
+        and fails the op without waiting out async_timeout_sec"""
 
         try:
-            fastjsonschema.validate(schema, {
+            get_validator(INVOKE_EXTENSION_SCHEMA)({
                 "arn": arn,
                 "component_def": component_def,
                 "child_key": child_key,
@@ -257,20 +1000,32 @@ class ExtensionHandler:
         if child_key in ['ops', 'retries', 'props', 'links']:
             raise Exception(f"Child key cannot be set to {child_key}. Please choose another key")
         
-        l_client = boto3.client("lambda")
+        l_client = get_client("lambda")
         child_key = child_key or arn
         op = op or self.op
+
+        child_pass_back_data = self.children.get(child_key)
+        async_result = None
+        if poll_sec:
+            child_data = self.children.get(child_key) or {}
+            child_pass_back_data = child_data.get("pass_back_data")
+            if child_data.get("async_token"):
+                return self._collect_async_result(child_key, child_data, op, progress_start, 
+                    progress_end, links_prefix, ignore_props_links, poll_sec, async_timeout_sec,
+                    async_ack_timeout_sec)
+            async_result = {"token": random_id(), "store": self.get_result_store().describe()}
         
         payload = bytes(json.dumps(remove_none_attributes({
             "component_def": component_def,
             "component_name": self.component_name,
             "op": op,
             "s3_object_name": object_name,
-            "pass_back_data": self.children.get(child_key),
+            "pass_back_data": child_pass_back_data,
             "prev_state": {"props": self.props.get(child_key)} if self.props.get(child_key) else None,
             "bucket": self.bucket,
             "repo_id": self.repo_id,
-            "project_code": self.project_code
+            "project_code": self.project_code,
+            "async_result": async_result
         })), "utf-8")
 
         ################################
@@ -280,7 +1035,7 @@ class ExtensionHandler:
         try:
             response = l_client.invoke(
                 FunctionName=arn,
-                InvocationType="RequestResponse" if synchronous else "Event",
+                InvocationType="RequestResponse" if (synchronous and not poll_sec) else "Event",
                 LogType="None",
                 Payload=payload
             )
@@ -289,51 +1044,25 @@ class ExtensionHandler:
                 print(f'Error = {response["Payload"].read()}')
                 raise Exception(f'Function Error = {response.get("FunctionError")}')
 
-            if synchronous:
+            if poll_sec:
+                self.children[child_key] = remove_none_attributes({
+                    "async_token": async_result["token"],
+                    "invoked_at": int(time.time()),
+                    "pass_back_data": child_pass_back_data
+                })
+                self.retry_error(f"Waiting on {child_key}", progress_start, callback_sec=poll_sec, count_retry=False)
+                proceed=False
+
+            elif synchronous:
                 result = json.loads(response["Payload"].read())
-                print(f"Invoke Result = {result}")
-
-                logs = result.get("logs") or []
-                progress = result.get("progress") or 0
-                success = result.get("success")
-                error = result.get("error")
-                props = result.get("props") or {}
-                # state = result.get("state") Not Handling child state ATM
-                links = result.get("links") or {}
-                
-                true_progress = int(progress_start + (progress/100 * (progress_end - progress_start)))
-                self.logs.extend(logs)
-                if error:
-                    self.perm_error(error, true_progress)
-                    return False
-                else:
-                    if op == "upsert":
-                        if not ignore_props_links:
-                            if links_prefix:
-                                links = {f"{links_prefix} {k}":v for k,v in links.items()} 
-                            self.links.update(links)
-                            if props:
-                                if isinstance(self.props.get(child_key), dict):
-                                    self.props[child_key].update(props)
-                                else:
-                                    self.props[child_key] = props
-                                if merge_props:
-                                    self.props.update(props)
-
-                    if not success:
-                        pass_back_data = result.get("pass_back_data") or {}
-                        self.children[child_key] = pass_back_data
-                        self.retry_error(f'{child_key} {pass_back_data.get("last_retry")}', true_progress, callback_sec=result['callback_sec'])
-                        proceed=False
-
-                    else:
-                        if child_key in self.children:
-                            del self.children[child_key]
-                        proceed= True
+                log("Invoke Result", result, level="DEBUG")
+                proceed = self._process_child_result(result, child_key, op, progress_start, 
+                    progress_end, links_prefix, ignore_props_links)
+
             else:
                 proceed=True
 
-        except botocore.exceptions.ClientError as e:
+        except ClientError as e:
             proceed=False
             if e.response['Error']['Code'] in ["ResourceNotFoundException", "InvalidRequestContentException", "RequestTooLargeException"]:
                 self.add_log(f"Error Invoking {child_key}", {"error": str(e)}, True)
@@ -346,7 +1075,140 @@ class ExtensionHandler:
         
         return proceed
 
+    def _collect_async_result(self, child_key, child_data, op, progress_start, 
+            progress_end, links_prefix, ignore_props_links, poll_sec, async_timeout_sec,
+            async_ack_timeout_sec):
+        store = self.get_result_store()
+        token = child_data["async_token"]
+        try:
+            result = store.get(token)
+            acknowledged = child_data.get("acknowledged") or (result is not None) or \
+                (store.get(f"{token}{ASYNC_ACK_SUFFIX}") is not None)
+        except ClientError as e:
+            self.add_log(f"Error Reading {child_key} Result", {"error": str(e)}, True)
+            self.retry_error(str(e), progress_start)
+            return False
+
+        if result is None:
+            waited = int(time.time()) - child_data.get("invoked_at", 0)
+            if acknowledged and not child_data.get("acknowledged"):
+                self.children[child_key] = {**child_data, "acknowledged": True}
+            if (not acknowledged) and (waited > async_ack_timeout_sec):
+                self.add_log(f"{child_key} Never Acknowledged Its Result Token", {"token": token, "waited_sec": waited}, True)
+                self.perm_error(f"{child_key} does not support asynchronous invocation, invoke it synchronously", progress_start)
+            elif waited > async_timeout_sec:
+                self.add_log(f"Timed Out Waiting on {child_key}", {"token": token, "waited_sec": waited}, True)
+                self.perm_error(f"Timed Out Waiting on {child_key}", progress_start)
+            else:
+                self.retry_error(f"Waiting on {child_key}", progress_start, callback_sec=poll_sec, count_retry=False)
+            return False
+
+        log("Async Invoke Result", result, level="DEBUG")
+        store.delete(token)
+        store.delete(f"{token}{ASYNC_ACK_SUFFIX}")
+        self.children[child_key] = {"pass_back_data": child_data.get("pass_back_data")}
+        proceed = self._process_child_result(result, child_key, op, progress_start, 
+            progress_end, links_prefix, ignore_props_links)
+        if not proceed and (child_key in self.children):
+            # The child needs another pass; it is re-invoked with its own pass_back_data next time
+            self.children[child_key] = {"pass_back_data": self.children[child_key]}
+        return proceed
+
+    def _process_child_result(self, result, child_key, op, progress_start, 
+            progress_end, links_prefix, ignore_props_links):
+        logs = result.get("logs") or []
+        progress = result.get("progress") or 0
+        success = result.get("success")
+        error = result.get("error")
+        props = result.get("props") or {}
+        # state = result.get("state") Not Handling child state ATM
+        links = result.get("links") or {}
         
+        true_progress = int(progress_start + (progress/100 * (progress_end - progress_start)))
+        self.logs.extend(logs)
+        if error:
+            self.perm_error(error, true_progress)
+            return False
+        else:
+            if op == "upsert":
+                if not ignore_props_links:
+                    if links_prefix:
+                        links = {f"{links_prefix} {k}":v for k,v in links.items()} 
+                    self.links.update(links)
+                    if props:
+                        if isinstance(self.props.get(child_key), dict):
+                            self.props[child_key].update(props)
+                        else:
+                            self.props[child_key] = props
+
+            if not success:
+                pass_back_data = result.get("pass_back_data") or {}
+                self.children[child_key] = pass_back_data
+                self.retry_error(f'{child_key} {pass_back_data.get("last_retry")}', true_progress, callback_sec=result['callback_sec'])
+                return False
+
+            else:
+                if child_key in self.children:
+                    del self.children[child_key]
+                return True
+
+    def get_result_store(self):
+        """Where asynchronously invoked children write their returns. Defaults to the event's bucket"""
+        return self.result_store or S3ResultStore(self.bucket)
+
+    def run_ops(self, calls, max_workers=None):
+        """Runs ext-decorated functions, each passed as a (function, *args) tuple.
+        A call becomes ready once its op is in self.ops and none of the ops it depends on
+        (directly or through their own depends_on) are still pending. Ready calls run together
+        on a bounded thread pool, wave by wave, until nothing is ready or a return is declared.
+        Functions without depends_on wait for every call listed before them, as if run serially."""
+        pending = list(calls)
+        declared = {c[0].ext_op: c[0].ext_depends_on for c in pending}
+
+        def blocking_ops(index):
+            deps = declared.get(pending[index][0].ext_op)
+            if deps is None:
+                return {c[0].ext_op for c in pending[:index]}
+            seen, stack = set(), list(deps)
+            while stack:
+                dep = stack.pop()
+                if dep not in seen:
+                    seen.add(dep)
+                    stack.extend(declared.get(dep) or [])
+            return seen
+
+        while pending and not self.ret:
+            ready = [
+                c for i, c in enumerate(pending)
+                if c[0].ext_op in self.ops 
+                and not any((dep in self.ops) for dep in blocking_ops(i) if dep != c[0].ext_op)
+            ]
+            if not ready:
+                break
+            pending = [c for c in pending if c not in ready]
+
+            if len(ready) == 1:
+                ready[0][0](*ready[0][1:])
+                continue
+
+            print(f"Running ops in parallel: {[c[0].ext_op for c in ready]}")
+            self.run_parallel(ready, max_workers)
+
+    def run_parallel(self, calls, max_workers=None):
+        """Runs (function, *args) calls on a bounded thread pool and returns their results in order.
+        The first return declared by any call wins, and it counts as declared by the calling thread,
+        so an op that fans out work doesn't complete when part of that work failed"""
+        self._parallel = True
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(len(calls), max_workers or self.max_op_workers))) as executor:
+                futures = [executor.submit(c[0], *c[1:]) for c in calls]
+            results = [future.result() for future in futures]
+        finally:
+            self._parallel = False
+        if self.ret:
+            self._local.declared = True
+        return results
+
     def add_op(self, opkey, opvalue=True):
         print(f'add op {opkey} with value {opvalue}')
         self.ops[opkey] = opvalue
@@ -374,19 +1236,43 @@ class ExtensionHandler:
         self.links.update(links)
         return self.links
         
+    def log_link(self):
+        if not self._log_link:
+            self._log_link = gen_log_link()
+        return self._log_link
+
     def add_log(self, title, details={}, is_error=False):
-        link = gen_log_link()
+        details = truncate_details(details)
         print(f"{title}: {details}")
-        self.logs.append(gen_log(title, details, is_error, link))
+        self.logs.append(gen_log(title, details, is_error, self.log_link()))
 
     def perm_error(self, error, progress=0):
         return self.declare_return(200, progress, error_code=error, callback=False)
 
-    def retry_error(self, error, progress=0, callback_sec=0):
-        return self.declare_return(200, progress, error_code=error, callback_sec=callback_sec)
+    def retry_error(self, error, progress=0, callback_sec=0, count_retry=True, retry_code=None):
+        """Set count_retry to False for expected waits that shouldn't use up max_retries_per_error_code.
+        retry_code picks the retry policy, and defaults to the error itself"""
+        return self.declare_return(200, progress, error_code=error, callback_sec=callback_sec, count_retry=count_retry, retry_code=retry_code)
+
+    def retry_policy(self, code):
+        policy = self.retry_policies.get(code)
+        if policy is None:
+            policy = {**self.retry_policies["default"], "max_attempts": self.max_retries_per_error_code}
+        return policy
 
-    def declare_return(self, status_code, progress, success=None, props=None, links=None, error_code=None, error_details=None, callback=True, callback_sec=0):
+    def declare_return(self, status_code, progress, success=None, props=None, links=None, error_code=None, error_details=None, callback=True, callback_sec=0, count_retry=True, retry_code=None):
         print(f"Calling back to CK, success = {success}, error_code = {error_code}")
+        with self._lock:
+            self._local.declared = True
+            if self.ret and self._parallel:
+                # The first op to return in a parallel wave wins, the others retry next time
+                print(f"Ignoring return from parallel op, {self.error} was declared first")
+                return
+            self._declare_return(status_code, progress, success, props, links, error_code, error_details, callback, callback_sec, count_retry, retry_code)
+
+    def _declare_return(self, status_code, progress, success, props, links, error_code, error_details, callback, callback_sec, count_retry, retry_code=None):
+        self.count_retry = count_retry
+        self.retry_code = retry_code
         self.status_code = status_code
         self.progress = progress
         self.success = success
@@ -398,24 +1284,43 @@ class ExtensionHandler:
         self.error_details = error_details
         self.ret = True
         
+    def flush_metrics(self):
+        """Prints this invocation's API metrics as EMF lines, which CloudWatch
+        turns into metrics without any PutMetricData calls"""
+        if not self.api_calls:
+            return
+        self.api_calls.stop()
+        if self.api_calls.calls:
+            # Op and service are the only dimensions. The component is a property, so new components don't make new metrics
+            for document in self.api_calls.emf({"Op": self.op or "unknown"}, remove_none_attributes({
+                "component_name": self.component_name,
+                "project_code": self.project_code,
+                "repo_id": self.repo_id
+            })):
+                print(json.dumps(document))
+        self.api_calls = None
+
     def finish(self):
+        self.flush_metrics()
         pass_back_data = {}
         if self.error:
             pass_back_data['ops'] = self.ops
             pass_back_data['retries'] = self.retries
-            this_retries = pass_back_data['retries'].get(self.error, 0) + 1
-            pass_back_data['retries'][self.error] = this_retries
+            this_retries = pass_back_data['retries'].get(self.error, 0) + (1 if self.count_retry else 0)
+            if self.count_retry:
+                pass_back_data['retries'][self.error] = this_retries
             pass_back_data['props'] = self.props
             pass_back_data['links'] = self.links
             pass_back_data['state'] = self.state
             if self.children:
                 pass_back_data.update(self.children)
-            if this_retries < self.max_retries_per_error_code and self.callback:
+            policy = self.retry_policy(self.retry_code or self.error)
+            if this_retries < policy["max_attempts"] and self.callback:
                 pass_back_data['last_retry'] = self.error
                 self.error = None
                 self.error_details = None
                 if not self.callback_sec:
-                    self.callback_sec = 2**this_retries                
+                    self.callback_sec = retry_delay(policy, this_retries)
 
         elif not self.success and not self.ignore_undelared_return:
             self.error = "no_success_or_error"
@@ -427,13 +1332,32 @@ class ExtensionHandler:
 
 #       self.logs.sort(key=sort_f, reverse=True)
             
-        return creturn(
+        result = creturn(
             self.status_code, self.progress, self.success, self.error, self.logs, 
             pass_back_data, self.state or None, self.props, self.links, self.callback_sec, self.error_details
         )
+        if self.async_result:
+            # We were invoked asynchronously, so the parent collects this return from its result store
+            self.put_async_result(result)
+        return result
+
+    def put_async_result(self, result):
+        """Returns whether result was stored. Failures are logged rather than raised, 
+        so lambda_handler still returns result"""
+        token = self.async_result["token"]
+        for attempt in range(ASYNC_RESULT_PUT_ATTEMPTS):
+            try:
+                result_store_from_description(self.async_result["store"]).put(token, result)
+                return True
+            except (ClientError, BotoCoreError) as e:
+                log("Put Async Result Failed", {"token": token, "attempt": attempt + 1, "error": str(e)}, level="WARNING")
+                if attempt + 1 < ASYNC_RESULT_PUT_ATTEMPTS:
+                    time.sleep(ASYNC_RESULT_PUT_DELAY_SEC * 2**attempt)
+        log("Async Result Not Stored", {"token": token, "attempts": ASYNC_RESULT_PUT_ATTEMPTS}, level="ERROR")
+        return False
     
 # A decorator
-def ext(f=None, handler=None, op=None, complete_op=True):
+def ext(f=None, handler=None, op=None, complete_op=True, depends_on=None):
     import functools
     
     if not f:
@@ -441,7 +1365,8 @@ def ext(f=None, handler=None, op=None, complete_op=True):
             ext,
             handler=handler,
             op=op,
-            complete_op=complete_op
+            complete_op=complete_op,
+            depends_on=depends_on
         )
 
     if not handler:
@@ -458,11 +1383,14 @@ def ext(f=None, handler=None, op=None, complete_op=True):
         except:
             raise Exception(f"Must pass handler of type ExtensionHandler to ext decorator")
 
+        handler._local.declared = False
         result = f(*args, **kwargs)
-        if complete_op and not handler.ret:
+        if complete_op and not handler._local.declared:
             handler.complete_op(op)
         return result
 
+    the_wrapper_around_the_original_function.ext_op = op
+    the_wrapper_around_the_original_function.ext_depends_on = depends_on
     return the_wrapper_around_the_original_function
 
 def gen_log_link():
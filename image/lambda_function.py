@@ -1,25 +1,101 @@
-import boto3
-import botocore
 # import jsonschema
 import json
 import traceback
-import zipfile
 import os
 import hashlib
+import base64
+import shlex
+import posixpath
+import re
+import struct
+import zlib
 
 from botocore.exceptions import ClientError
 
 from extutil import remove_none_attributes, account_context, ExtensionHandler, ext, \
     current_epoch_time_usec_num, component_safe_name, lambda_env, random_id, \
-    handle_common_errors, create_zip
+    handle_common_errors, create_zip, LazyClient, get_client, log, \
+    validate_component_def
 
 eh = ExtensionHandler()
 
-ecr = boto3.client('ecr')
+CHILD_POLL_SEC = 10
+BUILD_CACHE_TAG_PREFIX = "ck-build-"
+LAYER_CACHE_TAG = "ck-layer-cache"
+# The registry layer cache's builder. Pinned, and pulled through base_image_cache_prefix when that is set
+BUILDKIT_IMAGE = "moby/buildkit:v0.13.2"
+DOCKER_MANIFEST_LIST_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.list.v2+json"
+OCI_INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+# Native CodeBuild environments for each supported platform
+PLATFORM_PROJECT_DEFS = {
+    "linux/amd64": {"container_image": "aws/codebuild/standard:6.0"},
+    "linux/arm64": {"container_image": "aws/codebuild/amazonlinux2-aarch64-standard:2.0", "environment_type": "ARM_CONTAINER"}
+}
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json"
+]
+# Def keys that don't change the built image, so they are left out of the build hash
+NON_BUILD_KEYS = ["repo_name", "docker_tags", "trust_level", "async_children", "build_cache", "fingerprint_dockerignore"]
+
+SOURCE_FINGERPRINT_PREFIX = "zipfp-v1:"
+# End of central directory record plus the largest possible comment
+ZIP_EOCD_MAX_BYTES = 22 + 65535
+ZIP_EOCD_SIG = b"PK\x05\x06"
+ZIP64_EOCD_LOCATOR_SIG = b"PK\x06\x07"
+ZIP64_EOCD_SIG = b"PK\x06\x06"
+ZIP_CENTRAL_DIR_SIG = b"PK\x01\x02"
+ZIP_LOCAL_HEADER_SIG = b"PK\x03\x04"
+# Compression methods, as in zipfile, which this lambda doesn't need to import
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+# Always sent to the daemon, even when .dockerignore lists them, along with the Dockerfile given with -f
+DOCKERIGNORE_ALWAYS_INCLUDED = ["Dockerfile", ".dockerignore"]
+
+# Runs in the build with python3 after rewrite_from_lines, rewriting the Dockerfile at argv[1] to use $BASE_IMAGE_CACHE
+FROM_REWRITE_MAIN = r"""
+path = sys.argv[1]
+with open(path) as f:
+    lines, rewritten = rewrite_from_lines(f.readlines(), os.environ["BASE_IMAGE_CACHE"])
+for old_ref, new_ref in rewritten:
+    print("Base image " + old_ref + " -> " + new_ref)
+with open(path, "w") as f:
+    f.writelines(lines)
+"""
+
+# Mirrors the image input schema in kommand.json, which isn't deployed with the lambda
+COMPONENT_DEF_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "repo_name": {"type": "string"},
+        "docker_tags": {"type": "array", "items": {"type": "string"}},
+        "docker_build_options": {"type": "string"},
+        "login_to_dockerhub": {"type": "boolean"},
+        "trust_level": {"type": "string", "enum": ["full", "code", "zero"]},
+        "Codebuild Project": {"type": "object"},
+        "Codebuild Build": {"type": "object"},
+        "async_children": {"type": "boolean"},
+        "build_cache": {"type": "boolean"},
+        "layer_cache": {"type": "string", "enum": ["registry", "local", "both"]},
+        "buildkit_image": {"type": "string"},
+        "platforms": {"type": "array", "items": {"type": "string", "enum": ["linux/amd64", "linux/arm64"]}},
+        "base_image_cache_prefix": {"type": "string"},
+        "fingerprint_dockerignore": {"type": "boolean"}
+    },
+    "required": ["repo_name"]
+}
+
+ecr = LazyClient('ecr')
+
+# HEAD and fingerprint results for the current invocation, keyed by (bucket, key)
+_source_memo = {}
 
 def lambda_handler(event, context):
     try:
-        print(f"event = {event}")
+        _source_memo.clear()
+        log("event", event, level="DEBUG")
         account_number = account_context(context)['number']
         region = account_context(context)['region']
         eh.capture_event(event)
@@ -32,11 +108,11 @@ def lambda_handler(event, context):
         # cname = event.get("component_name")
 
         cdef = event.get("component_def")
+        # Callbacks carry the def that was validated on the first invocation
+        if (not event.get("pass_back_data")) and (not validate_component_def(eh, cdef, COMPONENT_DEF_SCHEMA)):
+            return eh.finish()
 
         repo_name = cdef.get("repo_name")
-        if not repo_name:
-            eh.add_log("repo_name is Required; Exiting", cdef, is_error=True)
-            eh.perm_error("repo_name is Required", 0)
 
         docker_tags = cdef.get("docker_tags") or ["latest"]
         trust_level = cdef.get("trust_level") or "code"
@@ -47,11 +123,18 @@ def lambda_handler(event, context):
         op = event.get("op")
 
         login_to_dockerhub = cdef.get("login_to_dockerhub")
+        poll_sec = CHILD_POLL_SEC if cdef.get("async_children") else None
+        build_cache = cdef.get("build_cache") or False
+        build_hash = gen_build_hash(cdef)
+        honor_dockerignore = cdef.get("fingerprint_dockerignore") is not False
+        dockerfile = posixpath.normpath(dockerfile_path(cdef.get("docker_build_options")))
 
         if event.get("pass_back_data"):
             print(f"pass_back_data found")
         elif op == "upsert":
             eh.add_op("load_initial_props")
+            if build_cache:
+                eh.add_op("check_build_cache")
             eh.add_op("setup_codebuild_project")
             if trust_level in ["full", "code"]: #At the moment these two are the same
                 eh.add_op("compare_defs")
@@ -59,11 +142,17 @@ def lambda_handler(event, context):
         elif op == "delete":
             eh.add_op("setup_codebuild_project")
 
-        compare_defs(event)
-        compare_etags(event, bucket, object_name)
-        load_initial_props(bucket, object_name)
-        setup_codebuild_project(bucket, object_name, codebuild_project_override_def, region, account_number, repo_name, docker_tags, op, login_to_dockerhub, cdef)
-        run_codebuild_build(codebuild_build_override_def)
+        compare_defs(event, build_hash, repo_name)
+        compare_etags(event, bucket, object_name, docker_tags, honor_dockerignore, dockerfile)
+        load_initial_props(bucket, object_name, honor_dockerignore, dockerfile)
+        check_build_cache(repo_name, docker_tags, build_hash)
+        retag_image(repo_name)
+        setup_codebuild_project(bucket, object_name, codebuild_project_override_def, region, account_number, repo_name, docker_tags, op, login_to_dockerhub, cdef, poll_sec)
+        run_codebuild_build(codebuild_build_override_def, poll_sec)
+        build_platforms(bucket, object_name, codebuild_project_override_def, codebuild_build_override_def, region, account_number, repo_name, op, login_to_dockerhub, cdef, poll_sec)
+        create_manifest_list(repo_name, docker_tags, region, account_number)
+        retag_image(repo_name)
+        untag_platform_images(repo_name)
         get_final_props(repo_name, docker_tags, region, account_number)
 
         return eh.finish()
@@ -76,19 +165,247 @@ def lambda_handler(event, context):
         return eh.finish()
 
 def get_s3_etag(bucket, object_name):
-    s3 = boto3.client("s3")
+    memo = _source_memo.setdefault((bucket, object_name), {})
+    if "etag" in memo:
+        eh.add_state({"zip_etag": memo["etag"], "zip_size": memo["size"]})
+        return
+
+    s3 = get_client("s3")
 
     try:
         s3_metadata = s3.head_object(Bucket=bucket, Key=object_name)
-        print(f"s3_metadata = {s3_metadata}")
-        eh.add_state({"zip_etag": s3_metadata['ETag']})
+        log("s3_metadata", s3_metadata, level="DEBUG")
+        memo.update({"etag": s3_metadata['ETag'], "size": s3_metadata['ContentLength']})
+        eh.add_state({"zip_etag": memo["etag"], "zip_size": memo["size"]})
     except s3.exceptions.NoSuchKey:
         eh.add_log("Cound Not Find Zipfile", {"bucket": bucket, "key": object_name})
         eh.retry_error("Object Not Found")
+    except ClientError as e:
+        if e.response['Error']['Code'] in ["404", "NoSuchKey"]:
+            eh.add_log("Cound Not Find Zipfile", {"bucket": bucket, "key": object_name})
+            eh.retry_error("Object Not Found")
+        else:
+            raise e
+
+def get_source_fingerprint(bucket, object_name, honor_dockerignore=True, dockerfile="Dockerfile"):
+    """Hashes the (path, CRC32, size) of every file in the source zip, reading
+    only the central directory, so a re-zip of the same files keeps its fingerprint.
+    Returns None if the object can't be fingerprinted, in which case callers use the ETag"""
+    get_s3_etag(bucket, object_name)
+    if not eh.state.get("zip_etag"):
+        return None
+
+    memo = _source_memo[(bucket, object_name)]
+    if "fingerprint" in memo:
+        return memo["fingerprint"]
+
+    try:
+        entries = read_zip_central_directory(bucket, object_name, memo["etag"], memo["size"])
+        if honor_dockerignore:
+            entries = filter_dockerignored(bucket, object_name, memo["etag"], entries, dockerfile)
+
+        fhash = hashlib.sha256()
+        for entry in sorted(entries, key=lambda x: x["name"]):
+            fhash.update(f"{entry['name']}\0{entry['crc']:08x}\0{entry['size']}\n".encode())
+        fingerprint = f"{SOURCE_FINGERPRINT_PREFIX}{fhash.hexdigest()}"
+        log("Source Fingerprint", {"fingerprint": fingerprint, "files": len(entries)}, level="DEBUG")
+    except (ValueError, struct.error, zlib.error) as e:
+        eh.add_log("Could Not Fingerprint Source, Using ETag", {"error": str(e)})
+        fingerprint = None
+
+    memo["fingerprint"] = fingerprint
+    if fingerprint:
+        eh.add_state({"source_fingerprint": fingerprint})
+    return fingerprint
+
+def get_s3_range(bucket, object_name, etag, start, end):
+    """Inclusive byte range. IfMatch keeps every read on the same version of the object"""
+    response = get_client("s3").get_object(
+        Bucket=bucket, Key=object_name, IfMatch=etag, Range=f"bytes={start}-{end}"
+    )
+    return response["Body"].read()
+
+def read_zip_central_directory(bucket, object_name, etag, size):
+    if size < 22:
+        raise ValueError("Object is too small to be a zip file")
+
+    tail_start = max(0, size - ZIP_EOCD_MAX_BYTES)
+    tail = get_s3_range(bucket, object_name, etag, tail_start, size - 1)
+
+    eocd_pos = tail.rfind(ZIP_EOCD_SIG)
+    if eocd_pos < 0:
+        raise ValueError("No end of central directory record found")
+    _, _, _, _, entry_count, cd_size, cd_offset, _ = struct.unpack("<4s4H2LH", tail[eocd_pos:eocd_pos + 22])
+
+    if (entry_count == 0xFFFF) or (cd_size == 0xFFFFFFFF) or (cd_offset == 0xFFFFFFFF):
+        locator_pos = eocd_pos - 20
+        if (locator_pos < 0) or (tail[locator_pos:locator_pos + 4] != ZIP64_EOCD_LOCATOR_SIG):
+            raise ValueError("No ZIP64 end of central directory locator found")
+        _, _, zip64_eocd_offset, _ = struct.unpack("<4sLQL", tail[locator_pos:locator_pos + 20])
+        if zip64_eocd_offset >= tail_start:
+            record = tail[zip64_eocd_offset - tail_start:zip64_eocd_offset - tail_start + 56]
+        else:
+            record = get_s3_range(bucket, object_name, etag, zip64_eocd_offset, zip64_eocd_offset + 55)
+        if record[:4] != ZIP64_EOCD_SIG:
+            raise ValueError("No ZIP64 end of central directory record found")
+        _, _, _, _, _, _, _, entry_count, cd_size, cd_offset = struct.unpack("<4sQ2H2L4Q", record[:56])
+
+    if cd_offset + cd_size > size:
+        raise ValueError("Central directory lies outside the object")
+
+    if cd_offset >= tail_start:
+        central_dir = tail[cd_offset - tail_start:cd_offset - tail_start + cd_size]
+    elif cd_size:
+        central_dir = get_s3_range(bucket, object_name, etag, cd_offset, cd_offset + cd_size - 1)
+    else:
+        central_dir = b""
+
+    return parse_central_directory(central_dir, entry_count)
+
+def parse_central_directory(central_dir, entry_count):
+    entries = []
+    pos = 0
+    for _ in range(entry_count):
+        if central_dir[pos:pos + 4] != ZIP_CENTRAL_DIR_SIG:
+            raise ValueError(f"Bad central directory entry at offset {pos}")
+        (_, _, _, flags, method, _, _, crc, csize, usize, name_len, extra_len, 
+            comment_len, _, _, _, header_offset) = struct.unpack("<4s6H3L5H2L", central_dir[pos:pos + 46])
+        pos += 46
+        raw_name = central_dir[pos:pos + name_len]
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        extra = central_dir[pos + name_len:pos + name_len + extra_len]
+        pos += name_len + extra_len + comment_len
+
+        if 0xFFFFFFFF in [usize, csize, header_offset]:
+            usize, csize, header_offset = read_zip64_extra(extra, usize, csize, header_offset)
+
+        name = name.replace("\\", "/")
+        if name.endswith("/"):
+            continue
+        entries.append({
+            "name": name, "crc": crc, "size": usize, 
+            "compressed_size": csize, "method": method, "header_offset": header_offset
+        })
+    return entries
+
+def read_zip64_extra(extra, usize, csize, header_offset):
+    """The ZIP64 extra field only holds the values that overflowed, in this order"""
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, data_len = struct.unpack("<2H", extra[pos:pos + 4])
+        data = extra[pos + 4:pos + 4 + data_len]
+        if header_id == 0x0001:
+            values = []
+            for i in range(0, len(data) - 7, 8):
+                values.append(struct.unpack("<Q", data[i:i + 8])[0])
+            if usize == 0xFFFFFFFF and values:
+                usize = values.pop(0)
+            if csize == 0xFFFFFFFF and values:
+                csize = values.pop(0)
+            if header_offset == 0xFFFFFFFF and values:
+                header_offset = values.pop(0)
+            break
+        pos += 4 + data_len
+    return usize, csize, header_offset
+
+def filter_dockerignored(bucket, object_name, etag, entries, dockerfile="Dockerfile"):
+    dockerignore = next((e for e in entries if e["name"] == ".dockerignore"), None)
+    if not dockerignore:
+        return entries
+
+    patterns = parse_dockerignore(read_zip_member(bucket, object_name, etag, dockerignore))
+    if not patterns:
+        return entries
+
+    always_included = DOCKERIGNORE_ALWAYS_INCLUDED + [dockerfile]
+    kept = [e for e in entries if (e["name"] in always_included) or not is_dockerignored(e["name"], patterns)]
+    log("Dockerignore Applied To Fingerprint", {"patterns": len(patterns), "ignored": len(entries) - len(kept)}, level="DEBUG")
+    return kept
+
+def read_zip_member(bucket, object_name, etag, entry):
+    offset = entry["header_offset"]
+    header = get_s3_range(bucket, object_name, etag, offset, offset + 29)
+    if header[:4] != ZIP_LOCAL_HEADER_SIG:
+        raise ValueError(f"Bad local header for {entry['name']}")
+    # The local extra field can differ from the central one, so its length comes from here
+    name_len, extra_len = struct.unpack("<2H", header[26:30])
+    data_start = offset + 30 + name_len + extra_len
+    if not entry["compressed_size"]:
+        return b""
+    data = get_s3_range(bucket, object_name, etag, data_start, data_start + entry["compressed_size"] - 1)
+
+    if entry["method"] == ZIP_STORED:
+        return data
+    elif entry["method"] == ZIP_DEFLATED:
+        return zlib.decompress(data, -15)
+    raise ValueError(f"Unsupported compression method {entry['method']} for {entry['name']}")
+
+def parse_dockerignore(content):
+    patterns = []
+    for line in content.decode("utf-8", errors="replace").splitlines():
+        line = line.strip()
+        if (not line) or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:].strip()
+        line = os.path.normpath(line.lstrip("/")).replace("\\", "/")
+        if line in [".", ""]:
+            continue
+        patterns.append((negate, re.compile(dockerignore_pattern_regex(line))))
+    return patterns
+
+def dockerignore_pattern_regex(pattern):
+    """Translates a .dockerignore pattern (Go filepath.Match plus **) to a regex"""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**", i):
+            i += 2
+            if pattern.startswith("/", i):
+                i += 1
+                regex += "(?:.*/)?"
+            else:
+                regex += ".*"
+            continue
+        elif c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end < 0:
+                regex += re.escape(c)
+            else:
+                body = pattern[i + 1:end]
+                if body[:1] in ["!", "^"]:
+                    body = "^" + body[1:]
+                regex += f"[{body}]"
+                i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+def is_dockerignored(name, patterns):
+    """A pattern that matches a directory excludes everything under it.
+    The last matching pattern wins, which is how ! exceptions work"""
+    parts = name.split("/")
+    candidates = ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+    ignored = False
+    for negate, regex in patterns:
+        if any(regex.fullmatch(c) for c in candidates):
+            ignored = not negate
+    return ignored
 
 @ext(handler=eh, op="compare_defs")
-def compare_defs(event):
-    old_digest = event.get("prev_state", {}).get("props", {}).get("def_hash")
+def compare_defs(event, build_hash, repo_name):
+    old_props = event.get("prev_state", {}).get("props", {})
+    old_digest = old_props.get("def_hash")
     new_rendef = event.get("component_def")
 
     _ = new_rendef.pop("trust_level", None)
@@ -96,26 +413,44 @@ def compare_defs(event):
     dhash = hashlib.md5()
     dhash.update(json.dumps(new_rendef, sort_keys=True).encode())
     digest = dhash.hexdigest()
-    eh.add_props({"def_hash": digest})
+    eh.add_props({"def_hash": digest, "build_hash": build_hash})
 
     if old_digest == digest:
         eh.add_log("Definitions Match, Checking Code", {"old_hash": old_digest, "new_hash": digest})
         eh.add_op("compare_etags") #Should hash definition
 
+    # repo_name isn't in the build hash, but the old image can only be retagged where it is
+    elif (old_props.get("build_hash") == build_hash) and old_props.get("digest") and (uri_repo_name(old_props.get("uri")) == repo_name):
+        eh.add_log("Only Tags Changed, Checking Code", {"old": old_digest, "new": digest})
+        eh.add_op("compare_etags", {"retag_digest": old_props["digest"]})
+
     else:
         eh.add_log("Definitions Don't Match, Deploying", {"old": old_digest, "new": digest})
 
 @ext(handler=eh, op="compare_etags")
-def compare_etags(event, bucket, object_name):
+def compare_etags(event, bucket, object_name, docker_tags, honor_dockerignore, dockerfile):
     old_props = event.get("prev_state", {}).get("props", {})
+    op_value = eh.ops["compare_etags"]
+    retag_digest = op_value.get("retag_digest") if isinstance(op_value, dict) else None
 
-    initial_etag = old_props.get("initial_etag")
-
-    #Get new etag
-    get_s3_etag(bucket, object_name)
+    #Get new etag, and the fingerprint of the files in it
+    fingerprint = get_source_fingerprint(bucket, object_name, honor_dockerignore, dockerfile)
     if eh.state.get("zip_etag"):
-        new_etag = eh.state["zip_etag"]
-        if initial_etag == new_etag:
+        #Fingerprints ignore timestamps and compression, so a re-zip of the same files still matches
+        if fingerprint and old_props.get("initial_fingerprint"):
+            initial_etag = old_props["initial_fingerprint"]
+            new_etag = fingerprint
+        else:
+            initial_etag = old_props.get("initial_etag")
+            new_etag = eh.state["zip_etag"]
+        if retag_digest and (initial_etag == new_etag):
+            eh.add_log("Only Tags Changed: Retagging", {"digest": retag_digest, "tags": docker_tags})
+            eh.add_props({k: v for k, v in old_props.items() if k not in ["def_hash", "build_hash", "tags"]})
+            eh.complete_op("check_build_cache")
+            eh.complete_op("setup_codebuild_project")
+            eh.add_op("retag_image", {"digest": retag_digest, "tags": list(docker_tags)})
+
+        elif initial_etag == new_etag:
             eh.add_log("Elevated Trust: No Change Detected", {"initial_etag": initial_etag, "new_etag": new_etag})
             eh.add_props(old_props)
             eh.add_links(event.get("prev_state", {}).get("links", {}))
@@ -127,13 +462,120 @@ def compare_etags(event, bucket, object_name):
             eh.add_log("Code Changed, Deploying", {"old_etag": initial_etag, "new_etag": new_etag})
 
 @ext(handler=eh, op="load_initial_props")
-def load_initial_props(bucket, object_name):
-    get_s3_etag(bucket, object_name)
+def load_initial_props(bucket, object_name, honor_dockerignore, dockerfile):
+    fingerprint = get_source_fingerprint(bucket, object_name, honor_dockerignore, dockerfile)
     if eh.state.get("zip_etag"):
-        eh.add_props({"initial_etag": eh.state.get("zip_etag")})
+        eh.add_props(remove_none_attributes({
+            "initial_etag": eh.state.get("zip_etag"),
+            "initial_fingerprint": fingerprint
+        }))
+
+@ext(handler=eh, op="check_build_cache")
+def check_build_cache(repo_name, docker_tags, build_hash):
+    """Looks for an image already built from the same build def and source, 
+    which is tagged with a content key by every build that has the cache on"""
+    content_key = hashlib.sha256(json.dumps({
+        "build_hash": build_hash, 
+        "source": eh.state.get("source_fingerprint") or eh.state.get("zip_etag")
+    }, sort_keys=True).encode()).hexdigest()
+    cache_tag = f"{BUILD_CACHE_TAG_PREFIX}{content_key}"
+    eh.add_state({"build_cache_tag": cache_tag})
+
+    try:
+        response = ecr.batch_get_image(
+            repositoryName=repo_name,
+            imageIds=[{"imageTag": cache_tag}],
+            acceptedMediaTypes=MANIFEST_MEDIA_TYPES
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == "RepositoryNotFoundException":
+            # The repository can be created by the same deploy, after this check but before the build pushes
+            eh.add_log("Build Cache Miss, No Repository Yet", {"repo_name": repo_name})
+        else:
+            handle_common_errors(e, eh, "Check Build Cache Failed", 20)
+        return 0
+
+    if not response.get("images"):
+        eh.add_log("Build Cache Miss, Building", {"cache_tag": cache_tag})
+        return 0
+
+    image = response["images"][0]
+    eh.add_log("Build Cache Hit, Skipping Build", {"cache_tag": cache_tag, "digest": image["imageId"]["imageDigest"]})
+    eh.complete_op("setup_codebuild_project")
+    eh.add_op("retag_image", {
+        "manifest": image["imageManifest"],
+        "media_type": image.get("imageManifestMediaType"),
+        "tags": list(docker_tags)
+    })
+
+@ext(handler=eh, op="retag_image")
+def retag_image(repo_name):
+    """Points each tag at an existing image manifest without building"""
+    pending = eh.ops["retag_image"]
+    tags = list(pending["tags"])
+
+    if not pending.get("manifest"):
+        try:
+            response = ecr.batch_get_image(
+                repositoryName=repo_name,
+                imageIds=[{"imageDigest": pending["digest"]}],
+                acceptedMediaTypes=MANIFEST_MEDIA_TYPES
+            )
+        except ClientError as e:
+            handle_common_errors(e, eh, "Get Image Manifest Failed", 35, ["RepositoryNotFoundException"])
+            return 0
+
+        if not response.get("images"):
+            eh.add_log("Previous Image Not Found, Building", {"digest": pending["digest"], "failures": response.get("failures")})
+            eh.add_op("setup_codebuild_project")
+            return 0
+        pending["manifest"] = response["images"][0]["imageManifest"]
+        pending["media_type"] = response["images"][0].get("imageManifestMediaType")
+
+    for tag in tags:
+        try:
+            ecr.put_image(**remove_none_attributes({
+                "repositoryName": repo_name,
+                "imageManifest": pending["manifest"],
+                "imageManifestMediaType": pending.get("media_type"),
+                "imageTag": tag
+            }))
+        except ClientError as e:
+            if e.response['Error']['Code'] != "ImageAlreadyExistsException":
+                handle_common_errors(e, eh, f"Tag Image {tag} Failed", 40, [
+                    "ImageTagAlreadyExistsException", "InvalidParameterException", 
+                    "RepositoryNotFoundException", "ImageDigestDoesNotMatchException"
+                ])
+                return 0
+        pending["tags"].remove(tag)
+
+    eh.add_log("Tagged Existing Image", {"tags": tags})
+    eh.add_op("get_final_props")
 
 @ext(handler=eh, op="setup_codebuild_project")
-def setup_codebuild_project(bucket, object_name, codebuild_def, region, account_number, repo_name, docker_tags, op, login_to_dockerhub, cdef):
+def setup_codebuild_project(bucket, object_name, codebuild_def, region, account_number, repo_name, docker_tags, op, login_to_dockerhub, cdef, poll_sec):
+    platforms = cdef.get("platforms")
+    if platforms:
+        eh.add_op("build_platforms", {platform: "project" for platform in platforms})
+        return 0
+
+    component_def = gen_codebuild_project_def(bucket, object_name, codebuild_def, region, account_number, repo_name, docker_tags, op, login_to_dockerhub, cdef)
+    if not component_def:
+        return 0
+
+    proceed = eh.invoke_extension(
+        arn=lambda_env("codebuild_project_lambda_name"), 
+        component_def=component_def, 
+        child_key="Codebuild Project", progress_start=25, 
+        progress_end=30, poll_sec=poll_sec
+    )
+
+    if proceed and op == "upsert":
+        eh.add_op("run_codebuild_build")
+
+def gen_codebuild_project_def(bucket, object_name, codebuild_def, region, account_number, repo_name, docker_tags, op, login_to_dockerhub, cdef, platform=None):
+    """Returns the Codebuild Project component def that builds and pushes the image, 
+    or None if a permanent error was declared. Pass platform to build that platform natively"""
 
     docker_build_options = cdef.get("docker_build_options") or ""
 
@@ -158,7 +600,33 @@ def setup_codebuild_project(bucket, object_name, codebuild_def, region, account_
         "echo Pushing the Docker image...",
     ]
 
-    actual_build_command = f"docker build {docker_build_options.strip() if docker_build_options else docker_build_options}{' ' if docker_build_options else ''}"
+    base_image_cache_prefix = cdef.get("base_image_cache_prefix")
+    base_image_cache = f"{account_number}.dkr.ecr.{region}.amazonaws.com/{base_image_cache_prefix.strip('/')}" if base_image_cache_prefix else None
+
+    layer_cache = cdef.get("layer_cache")
+    registry_cache = layer_cache in ["registry", "both"]
+    if registry_cache:
+        # The docker-container driver is needed to export cache to a registry; --load brings the image back for tagging
+        layer_cache_tag = f"{LAYER_CACHE_TAG}-{platform_arch(platform)}" if platform else LAYER_CACHE_TAG
+        buildkit_image = cdef.get("buildkit_image") or (f"{base_image_cache}/{BUILDKIT_IMAGE}" if base_image_cache else BUILDKIT_IMAGE)
+        environment_variables["DOCKER_BUILDKIT"] = "1"
+        environment_variables["LAYER_CACHE_REF"] = f"{account_number}.dkr.ecr.{region}.amazonaws.com/{repo_name}:{layer_cache_tag}"
+        pre_build_commands.append(f"docker buildx create --use --driver docker-container --driver-opt image={shlex.quote(buildkit_image)} --name ck-builder")
+        if op == "upsert" and not eh.state.get(f"layer_cache_checked_{layer_cache_tag}"):
+            log_layer_cache_status(repo_name, layer_cache_tag)
+        actual_build_command = "docker buildx build --progress=plain --load --cache-from type=registry,ref=$LAYER_CACHE_REF "
+        # An IMMUTABLE repository rejects the cache tag once it exists, so those builds only read the cache
+        if eh.state.get("repo_tag_mutability") != "IMMUTABLE":
+            actual_build_command += "--cache-to type=registry,ref=$LAYER_CACHE_REF,mode=max,image-manifest=true,oci-mediatypes=true "
+    else:
+        actual_build_command = "docker build "
+    actual_build_command += f"{docker_build_options.strip() if docker_build_options else docker_build_options}{' ' if docker_build_options else ''}"
+
+    if base_image_cache:
+        # The ECR login above also covers pulls through the cache
+        environment_variables["BASE_IMAGE_CACHE"] = base_image_cache
+        script = base64.b64encode(from_rewrite_script().encode()).decode()
+        pre_build_commands.append(f"echo {script} | base64 -d | python3 - {shlex.quote(dockerfile_path(docker_build_options))}")
 
     if login_to_dockerhub:
         try:
@@ -167,12 +635,14 @@ def setup_codebuild_project(bucket, object_name, codebuild_def, region, account_
         except:
             eh.add_log("Dockerhub Login Secrets Not Set", {"error": "Dockerhub Login Secrets Not Set"}, is_error=True)
             eh.perm_error("Dockerhub Login Secrets Not Set")
-            return 0
+            return None
         pre_build_commands.append("docker login -u $DOCKERHUB_USERNAME -p $DOCKERHUB_PASSWORD")
         post_build_commands.append("docker logout")
 
     if not docker_tags:
         docker_tags = ["latest"]
+    if eh.state.get("build_cache_tag") and not platform:
+        docker_tags = docker_tags + [eh.state["build_cache_tag"]]
 
     tag_build_commands = []
     for i, tag in enumerate(docker_tags):
@@ -182,6 +652,9 @@ def setup_codebuild_project(bucket, object_name, codebuild_def, region, account_
         post_build_commands += [f"docker push $AWS_ACCOUNT_ID.dkr.ecr.$AWS_DEFAULT_REGION.amazonaws.com/$IMAGE_REPO_NAME:$IMAGE_TAG_{i}"]
 
     actual_build_command += f"."
+    if registry_cache:
+        # Keeps the plain progress output so cached steps can be counted once the build finishes
+        actual_build_command = f"{actual_build_command} > /tmp/ck-build.log 2>&1; BUILD_STATUS=$?; cat /tmp/ck-build.log; echo \"Layer cache: $(grep -c ' CACHED' /tmp/ck-build.log) steps cached, $(grep -c '^#[0-9]* \\[' /tmp/ck-build.log) steps total\"; test $BUILD_STATUS -eq 0"
     build_commands += [actual_build_command] + tag_build_commands
 
     component_def = {
@@ -194,24 +667,247 @@ def setup_codebuild_project(bucket, object_name, codebuild_def, region, account_
         "container_image": "aws/codebuild/standard:6.0",
         "privileged_mode": True
     }
+    if platform:
+        component_def.update(PLATFORM_PROJECT_DEFS[platform])
+
+    if layer_cache in ["local", "both"]:
+        component_def["cache"] = {"type": "LOCAL", "modes": ["LOCAL_DOCKER_LAYER_CACHE"]}
 
     #Allows for custom overrides as the user sees fit
     component_def.update(codebuild_def)
+    return component_def
+
+def rewrite_from_lines(lines, cache):
+    """Points Docker Hub FROM lines at the ECR pull through cache prefix cache, and returns the new lines 
+    and the (old, new) references it rewrote. Build stages, scratch, images from other registries 
+    and references built from ARGs are left alone. Also runs in the build, so it only uses re"""
+    docker_hub = ["docker.io", "index.docker.io", "registry-1.docker.io"]
+    from_line = re.compile(r"^\s*FROM\s+(?:--\S+\s+)*(\S+)", re.IGNORECASE)
+    stage = re.compile(r"\sAS\s+(\S+)", re.IGNORECASE)
+    stages = set()
+    new_lines, rewritten = [], []
+    for line in lines:
+        m = from_line.match(line)
+        if m:
+            ref = m.group(1)
+            new_ref = None
+            if (ref.lower() != "scratch") and (ref.lower() not in stages) and ("$" not in ref):
+                first, _, remainder = ref.partition("/")
+                explicit = bool(remainder) and (("." in first) or (":" in first) or (first == "localhost"))
+                if explicit and (first in docker_hub):
+                    ref, explicit = remainder, False
+                if not explicit:
+                    new_ref = cache + "/" + (ref if "/" in ref else "library/" + ref)
+            s = stage.search(line, m.end(1))
+            if s:
+                stages.add(s.group(1).lower())
+            if new_ref:
+                rewritten.append((m.group(1), new_ref))
+                line = line[:m.start(1)] + new_ref + line[m.end(1):]
+        new_lines.append(line)
+    return new_lines, rewritten
+
+def from_rewrite_script():
+    import inspect
+    return "import os, re, sys\n" + inspect.getsource(rewrite_from_lines) + FROM_REWRITE_MAIN
+
+def dockerfile_path(docker_build_options):
+    try:
+        args = shlex.split(docker_build_options or "")
+    except ValueError:
+        return "Dockerfile"
+    for i, arg in enumerate(args):
+        if arg in ["-f", "--file"] and i + 1 < len(args):
+            return args[i + 1]
+        elif arg.startswith("--file="):
+            return arg[len("--file="):]
+    return "Dockerfile"
+
+@ext(handler=eh, op="build_platforms")
+def build_platforms(bucket, object_name, codebuild_project_def, codebuild_build_def, region, account_number, repo_name, op, login_to_dockerhub, cdef, poll_sec):
+    """Builds each platform natively on its own Codebuild Project and Build, all at once.
+    The op value tracks each platform's next step so retries pick up where each left off"""
+    pending = eh.ops["build_platforms"]
+    if not eh.state.get("platform_build_id"):
+        eh.add_state({"platform_build_id": random_id()[:8]})
+
+    def build_platform(platform):
+        arch = platform_arch(platform)
+        if pending[platform] == "project":
+            component_def = gen_codebuild_project_def(
+                bucket, object_name, codebuild_project_def, region, account_number, repo_name, 
+                [platform_tag(platform)], op, login_to_dockerhub, cdef, platform
+            )
+            if not component_def:
+                return False
+            if not eh.invoke_extension(
+                arn=lambda_env("codebuild_project_lambda_name"), 
+                component_def=component_def, 
+                child_key=f"Codebuild Project {arch}", progress_start=25, 
+                progress_end=30, poll_sec=poll_sec
+            ):
+                return False
+            pending[platform] = "build" if op == "upsert" else "done"
+
+        if pending[platform] == "build":
+            if not eh.invoke_extension(
+                arn=lambda_env("codebuild_build_lambda_name"),
+                component_def={
+                    "project_name": eh.props[f"Codebuild Project {arch}"]["name"],
+                    **codebuild_build_def
+                }, 
+                child_key=f"Codebuild Build {arch}", progress_start=30, 
+                progress_end=45, poll_sec=poll_sec
+            ):
+                return False
+            pending[platform] = "done"
+        return True
+
+    platforms = [p for p in pending.keys() if pending[p] != "done"]
+    results = eh.run_parallel([(build_platform, p) for p in platforms], max_workers=len(platforms))
+    if all(results) and (op == "upsert"):
+        eh.add_log("Built All Platforms", {"platforms": list(pending.keys())})
+        eh.add_op("create_manifest_list", list(pending.keys()))
+
+@ext(handler=eh, op="create_manifest_list")
+def create_manifest_list(repo_name, docker_tags, region, account_number):
+    """Stitches the per-platform images into one manifest list and tags it"""
+    platforms = eh.ops["create_manifest_list"]
 
-    eh.invoke_extension(
-        arn=lambda_env("codebuild_project_lambda_name"), 
-        component_def=component_def, 
-        child_key="Codebuild Project", progress_start=25, 
-        progress_end=30
-    )
+    try:
+        response = ecr.batch_get_image(
+            repositoryName=repo_name,
+            imageIds=[{"imageTag": platform_tag(p)} for p in platforms],
+            acceptedMediaTypes=MANIFEST_MEDIA_TYPES
+        )
+    except ClientError as e:
+        handle_common_errors(e, eh, "Get Platform Images Failed", 50, ["RepositoryNotFoundException"])
+        return 0
+
+    images = {i["imageId"]["imageTag"]: i for i in response.get("images") or []}
+    missing = [p for p in platforms if platform_tag(p) not in images]
+    if missing:
+        eh.add_log("Platform Images Not Found", {"platforms": missing, "failures": response.get("failures")}, is_error=True)
+        eh.retry_error(f"Platform Images Not Found", 50)
+        return 0
+
+    manifests = []
+    for platform in platforms:
+        image = images[platform_tag(platform)]
+        os_name, architecture, *variant = platform.split("/")
+        manifests.append({
+            "mediaType": image.get("imageManifestMediaType") or json.loads(image["imageManifest"]).get("mediaType"),
+            "digest": image["imageId"]["imageDigest"],
+            "size": len(image["imageManifest"].encode()),
+            "platform": remove_none_attributes({
+                "architecture": architecture, 
+                "os": os_name,
+                "variant": variant[0] if variant else ("v8" if architecture == "arm64" else None)
+            })
+        })
 
-    if op == "upsert":
-        eh.add_op("run_codebuild_build")
+    oci = any(m["mediaType"].startswith("application/vnd.oci") for m in manifests)
+    media_type = OCI_INDEX_MEDIA_TYPE if oci else DOCKER_MANIFEST_LIST_MEDIA_TYPE
+    manifest_list = json.dumps({"schemaVersion": 2, "mediaType": media_type, "manifests": manifests})
+    digest = f"sha256:{hashlib.sha256(manifest_list.encode()).hexdigest()}"
+
+    eh.add_props({"platform_digests": {p: images[platform_tag(p)]["imageId"]["imageDigest"] for p in platforms}})
+    eh.add_log("Created Manifest List", {"digest": digest, "platforms": eh.props["platform_digests"]})
+    eh.add_op("retag_image", {
+        "manifest": manifest_list,
+        "media_type": media_type,
+        "tags": list(docker_tags) + ([eh.state["build_cache_tag"]] if eh.state.get("build_cache_tag") else [])
+    })
+    eh.add_op("untag_platform_images", {
+        p: {"manifest": images[platform_tag(p)]["imageManifest"], "media_type": images[platform_tag(p)].get("imageManifestMediaType")}
+        for p in platforms
+    })
+
+@ext(handler=eh, op="untag_platform_images")
+def untag_platform_images(repo_name):
+    """Moves each platform image from its per-build tag to the stable ck-<arch> tag, so per-build 
+    tags don't pile up. The per-build tag is only removed once the image has the stable tag, 
+    because removing an image's last tag deletes the image, which the manifest list needs"""
+    pending = eh.ops["untag_platform_images"]
+
+    for platform in list(pending.keys()):
+        try:
+            ecr.put_image(**remove_none_attributes({
+                "repositoryName": repo_name,
+                "imageManifest": pending[platform]["manifest"],
+                "imageManifestMediaType": pending[platform].get("media_type"),
+                "imageTag": platform_stable_tag(platform)
+            }))
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ImageTagAlreadyExistsException":
+                # IMMUTABLE repositories can't move the stable tag, so the per-build tag has to stay
+                eh.add_log("Keeping Per-Build Platform Tag", {"tag": platform_tag(platform), "error": str(e)})
+                del pending[platform]
+                continue
+            elif e.response['Error']['Code'] != "ImageAlreadyExistsException":
+                handle_common_errors(e, eh, f"Tag {platform} Image Failed", 85, ["InvalidParameterException", "RepositoryNotFoundException"])
+                return 0
+
+    if not pending:
+        return 0
+
+    try:
+        response = ecr.batch_delete_image(
+            repositoryName=repo_name,
+            imageIds=[{"imageTag": platform_tag(p)} for p in pending]
+        )
+    except ClientError as e:
+        handle_common_errors(e, eh, "Remove Per-Build Platform Tags Failed", 85, ["RepositoryNotFoundException"])
+        return 0
+
+    eh.add_log("Removed Per-Build Platform Tags", {
+        "tags": [i.get("imageTag") for i in response.get("imageIds") or []],
+        "failures": response.get("failures") or None
+    })
+
+def platform_arch(platform):
+    return platform.split("/")[1]
+
+def platform_tag(platform):
+    return f"ck-{platform_arch(platform)}-{eh.state['platform_build_id']}"
+
+def platform_stable_tag(platform):
+    return f"ck-{platform_arch(platform)}"
+
+def log_layer_cache_status(repo_name, layer_cache_tag):
+    if "repo_tag_mutability" not in eh.state:
+        try:
+            repo = ecr.describe_repositories(repositoryNames=[repo_name])["repositories"][0]
+            eh.add_state({"repo_tag_mutability": repo.get("imageTagMutability")})
+            if repo.get("imageTagMutability") == "IMMUTABLE":
+                eh.add_log("Immutable Repository, Layer Cache is Read Only", {"repo_name": repo_name})
+        except ClientError as e:
+            # Usually a repository the same deploy creates, which is mutable unless set otherwise
+            eh.add_log("Could Not Check Repository Tag Mutability", {"error": str(e)})
+            eh.add_state({"repo_tag_mutability": None})
+
+    try:
+        response = ecr.describe_images(
+            repositoryName=repo_name,
+            imageIds=[{"imageTag": layer_cache_tag}]
+        )
+        details = response["imageDetails"][0]
+        eh.add_log("Registry Layer Cache Found", {
+            "tag": layer_cache_tag, 
+            "size_in_bytes": details.get("imageSizeInBytes"),
+            "pushed_at": details.get("imagePushedAt")
+        })
+    except ClientError as e:
+        if e.response['Error']['Code'] == "ImageNotFoundException":
+            eh.add_log("No Registry Layer Cache Yet, Building Cold", {"tag": layer_cache_tag})
+        else:
+            eh.add_log("Could Not Check Registry Layer Cache", {"error": str(e)})
+    eh.add_state({f"layer_cache_checked_{layer_cache_tag}": True})
 
 @ext(handler=eh, op="run_codebuild_build")
-def run_codebuild_build(codebuild_build_def):
-    print(eh.props)
-    print(eh.links)
+def run_codebuild_build(codebuild_build_def, poll_sec):
+    log("props", eh.props, level="DEBUG")
+    log("links", eh.links, level="DEBUG")
 
     component_def = {
         "project_name": eh.props["Codebuild Project"]["name"]
@@ -219,37 +915,89 @@ def run_codebuild_build(codebuild_build_def):
 
     component_def.update(codebuild_build_def)
 
-    eh.invoke_extension(
+    proceed = eh.invoke_extension(
         arn=lambda_env("codebuild_build_lambda_name"),
         component_def=component_def, 
         child_key="Codebuild Build", progress_start=30, 
-        progress_end=45
+        progress_end=45, poll_sec=poll_sec
     )
 
-    eh.add_op("get_final_props")
+    if proceed:
+        eh.add_op("get_final_props")
 
 
 @ext(handler=eh, op="get_final_props")
 def get_final_props(repo_name, tags, region, account_number):
-    tag = tags[0]
+    """Checks that every tag resolves to the same image. Tags already resolved are kept in state, 
+    so a retry only looks up the tags that were missing"""
+    tag_digests = eh.state.get("tag_digests") or {}
+    pending = [t for t in tags if t not in tag_digests]
+    details = {}
 
     try:
-        response = ecr.describe_images(
-            repositoryName=repo_name,
-            imageIds=[{"imageTag": tag}]
-        )
+        if pending:
+            try:
+                response = ecr.describe_images(
+                    repositoryName=repo_name,
+                    imageIds=[{"imageTag": t} for t in pending]
+                )
+                for detail in response["imageDetails"]:
+                    details[detail["imageDigest"]] = detail
+                    tag_digests.update({t: detail["imageDigest"] for t in detail.get("imageTags") or [] if t in pending})
+            except ClientError as e:
+                if e.response['Error']['Code'] != "ImageNotFoundException":
+                    raise e
+                # describe_images fails outright if any tag is missing, batch_get_image reports them one by one
+                response = ecr.batch_get_image(
+                    repositoryName=repo_name,
+                    imageIds=[{"imageTag": t} for t in pending],
+                    acceptedMediaTypes=MANIFEST_MEDIA_TYPES
+                )
+                tag_digests.update({i["imageId"]["imageTag"]: i["imageId"]["imageDigest"] for i in response.get("images") or []})
+            eh.add_state({"tag_digests": tag_digests})
+
+        missing = [t for t in tags if t not in tag_digests]
+        if missing:
+            eh.add_log("Image Tags Not Found", {"missing": missing, "found": tag_digests}, is_error=True)
+            eh.retry_error(f"Image Tags Not Found", 90)
+            return 0
+
+        digests = set(tag_digests[t] for t in tags)
+        if len(digests) > 1:
+            eh.add_log("Image Tags Point to Different Images", {"tag_digests": tag_digests}, is_error=True)
+            eh.add_state({"tag_digests": {}})
+            eh.retry_error(f"Image Tags Point to Different Images", 90)
+            return 0
 
-        digest_value = response["imageDetails"][0]["imageDigest"]
+        digest_value = digests.pop()
+        if digest_value not in details:
+            response = ecr.describe_images(
+                repositoryName=repo_name,
+                imageIds=[{"imageDigest": digest_value}]
+            )
+            details[digest_value] = response["imageDetails"][0]
+        detail = details[digest_value]
 
         eh.add_props({
             "uri": f"{account_number}.dkr.ecr.{region}.amazonaws.com/{repo_name}@{digest_value}",
             "digest": digest_value,
-            "tags": tags
+            "tags": tags,
+            "tag_digests": {t: tag_digests[t] for t in tags},
+            "size_in_bytes": detail.get("imageSizeInBytes"),
+            "pushed_at": detail.get("imagePushedAt")
         })
 
     except ClientError as e:
         handle_common_errors(e, eh, "Get Final Props", 90)
 
+def uri_repo_name(uri):
+    """The repository name in a uri prop, which looks like REGISTRY/NAME@DIGEST"""
+    return (uri or "").partition("/")[2].partition("@")[0] or None
+
+def gen_build_hash(cdef):
+    build_def = {k: v for k, v in cdef.items() if k not in NON_BUILD_KEYS}
+    return hashlib.md5(json.dumps(build_def, sort_keys=True).encode()).hexdigest()
+
 def format_tags(tags_dict):
     return [{"Key": k, "Value": v} for k,v in tags_dict]
 
@@ -0,0 +1,224 @@
+# import jsonschema
+import json
+import traceback
+import os
+
+from botocore.exceptions import ClientError
+
+from extutil import remove_none_attributes, account_context, ExtensionHandler, ext, \
+    current_epoch_time_usec_num, component_safe_name, lambda_env, random_id, \
+    handle_common_errors, LazyClient, log, validate_component_def
+
+eh = ExtensionHandler()
+
+ecr = LazyClient('ecr')
+
+DOCKER_HUB_URL = "registry-1.docker.io"
+# Upstreams that ECR can only cache with a Secrets Manager credential
+CREDENTIAL_REQUIRED_UPSTREAMS = ["docker-hub", "github-container-registry", "azure-container-registry", "gitlab-container-registry"]
+
+# Mirrors the pullthrough input schema in kommand.json, which isn't deployed with the lambda
+COMPONENT_DEF_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "ecr_repository_prefix": {"type": "string", "pattern": "^[a-z0-9]+(?:[._-][a-z0-9]+)*(?:/[a-z0-9]+(?:[._-][a-z0-9]+)*)*$", "minLength": 2, "maxLength": 30},
+        "upstream_registry_url": {"type": "string"},
+        "upstream_registry": {"type": "string", "enum": ["ecr-public", "quay", "k8s", "docker-hub", "github-container-registry", "azure-container-registry", "gitlab-container-registry"]},
+        "credential_arn": {"type": "string"},
+        "registry_account_id": {"type": "string"}
+    }
+}
+
+RULE_OPS = ["get_rule", "delete_rule", "create_rule", "update_rule"]
+
+def lambda_handler(event, context):
+    try:
+        log("event", event, level="DEBUG")
+        account_number = account_context(context)['number']
+        region = account_context(context)['region']
+        eh.capture_event(event)
+
+        prev_state = event.get("prev_state") or {}
+        cdef = event.get("component_def")
+        # Callbacks carry the def that was validated on the first invocation
+        if (not event.get("pass_back_data")) and (not validate_component_def(eh, cdef, COMPONENT_DEF_SCHEMA)):
+            return eh.finish()
+
+        upstream_registry_url = cdef.get("upstream_registry_url") or DOCKER_HUB_URL
+        upstream_registry = cdef.get("upstream_registry") or ("docker-hub" if upstream_registry_url == DOCKER_HUB_URL else None)
+        prefix = cdef.get("ecr_repository_prefix") or upstream_registry or "pull-through"
+        registry_id = cdef.get("registry_account_id") or None
+        credential_arn = cdef.get("credential_arn")
+
+        rule_def = remove_none_attributes({
+            "ecrRepositoryPrefix": prefix,
+            "upstreamRegistryUrl": upstream_registry_url,
+            "registryId": registry_id,
+            "upstreamRegistry": upstream_registry,
+            "credentialArn": credential_arn
+        })
+
+        if event.get("pass_back_data"):
+            print(f"pass_back_data found")
+        elif event.get("op") == "upsert":
+            if (upstream_registry in CREDENTIAL_REQUIRED_UPSTREAMS) and not credential_arn:
+                eh.add_log("credential_arn Required", {"upstream_registry": upstream_registry}, is_error=True)
+                eh.perm_error(f"{upstream_registry} pull through cache rules need a credential_arn, the ARN of a Secrets Manager secret whose name starts with ecr-pullthroughcache/", 0)
+                return eh.finish()
+            eh.add_op("get_rule")
+
+        elif event.get("op") == "delete":
+            prev_props = prev_state.get("props") or {}
+            eh.add_op("delete_rule", {
+                "prefix": prev_props.get("ecr_repository_prefix") or prefix, 
+                "registry_id": prev_props.get("registry_id") or registry_id
+            })
+
+        eh.run_ops([
+            (get_rule, rule_def, prev_state),
+            (delete_rule,),
+            (create_rule, rule_def),
+            (update_rule, rule_def),
+            (remove_old_rule,),
+        ])
+
+        if eh.props.get("registry_id") and not eh.ret and event.get("op") == "upsert":
+            eh.add_props({"cache_uri_prefix": f"{eh.props['registry_id']}.dkr.ecr.{region}.amazonaws.com/{prefix}"})
+            eh.add_links({"Pull Through Cache Rules": gen_pull_through_cache_link(region)})
+
+        return eh.finish()
+
+    except Exception as e:
+        msg = traceback.format_exc()
+        print(msg)
+        eh.add_log("Unexpected Error", {"error": msg}, is_error=True)
+        eh.declare_return(200, 0, error_code=str(e))
+        return eh.finish()
+
+@ext(handler=eh, op="get_rule", depends_on=[])
+def get_rule(rule_def, prev_state):
+    prefix = rule_def["ecrRepositoryPrefix"]
+    prev_props = prev_state.get("props") or {}
+    if prev_props.get("ecr_repository_prefix") and (prev_props["ecr_repository_prefix"] != prefix):
+        eh.add_op("remove_old_rule", {
+            "prefix": prev_props["ecr_repository_prefix"],
+            "registry_id": prev_props.get("registry_id")
+        })
+
+    try:
+        response = ecr.describe_pull_through_cache_rules(**remove_none_attributes({
+            "registryId": rule_def.get("registryId"),
+            "ecrRepositoryPrefixes": [prefix]
+        }))
+        rules = response.get("pullThroughCacheRules") or []
+    except ClientError as e:
+        if e.response['Error']['Code'] == "PullThroughCacheRuleNotFoundException":
+            rules = []
+        else:
+            handle_common_errors(e, eh, "Get Pull Through Cache Rule Failed", 10)
+            return 0
+
+    if not rules:
+        eh.add_op("create_rule")
+        return 0
+
+    rule = rules[0]
+    eh.add_log("Found Pull Through Cache Rule", rule)
+    set_rule_props(rule)
+    if rule.get("upstreamRegistryUrl") != rule_def["upstreamRegistryUrl"]:
+        # The upstream of a rule can't be changed in place
+        eh.add_log("Upstream Changed, Replacing Rule", {"old": rule.get("upstreamRegistryUrl"), "new": rule_def["upstreamRegistryUrl"]})
+        eh.add_op("delete_rule", {"prefix": prefix, "registry_id": rule.get("registryId"), "replace": True})
+        eh.add_op("create_rule")
+    elif rule.get("credentialArn") != rule_def.get("credentialArn"):
+        if rule_def.get("credentialArn"):
+            eh.add_op("update_rule")
+        else:
+            eh.add_op("delete_rule", {"prefix": prefix, "registry_id": rule.get("registryId"), "replace": True})
+            eh.add_op("create_rule")
+
+@ext(handler=eh, op="delete_rule", depends_on=["get_rule"])
+def delete_rule():
+    op_def = eh.ops["delete_rule"]
+    try:
+        ecr.delete_pull_through_cache_rule(**remove_none_attributes({
+            "ecrRepositoryPrefix": op_def["prefix"],
+            "registryId": op_def.get("registry_id")
+        }))
+        eh.add_log("Deleted Pull Through Cache Rule", {"prefix": op_def["prefix"]})
+    except ClientError as e:
+        if e.response['Error']['Code'] == "PullThroughCacheRuleNotFoundException":
+            eh.add_log("Pull Through Cache Rule Does Not Exist", {"prefix": op_def["prefix"]})
+        else:
+            handle_common_errors(e, eh, "Delete Pull Through Cache Rule Failed", 30 if op_def.get("replace") else 10)
+
+@ext(handler=eh, op="create_rule", depends_on=["get_rule", "delete_rule"])
+def create_rule(rule_def):
+    try:
+        response = ecr.create_pull_through_cache_rule(**rule_def)
+        eh.add_log("Created Pull Through Cache Rule", response)
+        set_rule_props(response)
+    except ClientError as e:
+        handle_common_errors(
+            e, eh, "Create Pull Through Cache Rule Failed", 50,
+            perm_errors=[
+                "PullThroughCacheRuleAlreadyExistsException",
+                "UnsupportedUpstreamRegistryException",
+                "LimitExceededException",
+                "InvalidParameterException",
+                "ValidationException",
+                "SecretNotFoundException",
+                "UnableToAccessSecretException",
+                "UnableToDecryptSecretValueException"
+            ]
+        )
+
+@ext(handler=eh, op="update_rule", depends_on=["get_rule"])
+def update_rule(rule_def):
+    try:
+        response = ecr.update_pull_through_cache_rule(**remove_none_attributes({
+            "registryId": rule_def.get("registryId"),
+            "ecrRepositoryPrefix": rule_def["ecrRepositoryPrefix"],
+            "credentialArn": rule_def["credentialArn"]
+        }))
+        eh.add_log("Updated Pull Through Cache Rule Credential", response)
+        set_rule_props(response)
+    except ClientError as e:
+        handle_common_errors(
+            e, eh, "Update Pull Through Cache Rule Failed", 50,
+            perm_errors=[
+                "PullThroughCacheRuleNotFoundException",
+                "InvalidParameterException",
+                "ValidationException",
+                "SecretNotFoundException",
+                "UnableToAccessSecretException",
+                "UnableToDecryptSecretValueException"
+            ]
+        )
+
+# The old prefix is only removed once the new rule is in place
+@ext(handler=eh, op="remove_old_rule", depends_on=RULE_OPS)
+def remove_old_rule():
+    op_def = eh.ops["remove_old_rule"]
+    try:
+        ecr.delete_pull_through_cache_rule(**remove_none_attributes({
+            "ecrRepositoryPrefix": op_def["prefix"],
+            "registryId": op_def.get("registry_id")
+        }))
+        eh.add_log("Deleted Old Pull Through Cache Rule", {"prefix": op_def["prefix"]})
+    except ClientError as e:
+        if e.response['Error']['Code'] == "PullThroughCacheRuleNotFoundException":
+            eh.add_log("Old Pull Through Cache Rule Does Not Exist", {"prefix": op_def["prefix"]})
+        else:
+            handle_common_errors(e, eh, "Delete Old Pull Through Cache Rule Failed", 80)
+
+def set_rule_props(rule):
+    eh.add_props(remove_none_attributes({
+        "ecr_repository_prefix": rule.get("ecrRepositoryPrefix"),
+        "upstream_registry_url": rule.get("upstreamRegistryUrl"),
+        "registry_id": rule.get("registryId"),
+        "credential_arn": rule.get("credentialArn")
+    }))
+
+def gen_pull_through_cache_link(region):
+    return f"https://{region}.console.aws.amazon.com/ecr/private-registry/pull-through-cache?region={region}"
@@ -1,25 +1,112 @@
-import boto3
-import botocore
 # import jsonschema
 import json
 import traceback
-import zipfile
 import os
 import hashlib
+import time
+import re
+import datetime
 
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
 from extutil import remove_none_attributes, account_context, ExtensionHandler, ext, \
     current_epoch_time_usec_num, component_safe_name, lambda_env, random_id, \
-    handle_common_errors, create_zip
+    handle_common_errors, create_zip, LazyClient, log, TTLCache, \
+    validate_component_def
 
 eh = ExtensionHandler()
 
-ecr = boto3.client('ecr')
+ecr = LazyClient('ecr')
+
+# Repository descriptions and tags, keyed by (registry_id, name), shared by callbacks hitting a warm container
+repo_cache = TTLCache(
+    "repositories", 
+    ttl=int(lambda_env("repo_cache_ttl_sec") or 60),
+    max_size=int(lambda_env("repo_cache_max_size") or 1024)
+)
+
+# Unchanged deploys still read the repository after this many deploys or hours, to catch drift
+DRIFT_CHECK_DEPLOYS = 10
+DRIFT_CHECK_HOURS = 24
+DESCRIBE_BATCH_SIZE = 100 # describe_repositories accepts at most 100 names per call
+MAX_TAG_WORKERS = 10
+TAG_PERM_ERRORS = ["InvalidParameterException", "InvalidTagParameterException", "TooManyTagsException"]
+MAX_TAGS_PER_CALL = 50 # ECR allows at most 50 tags per resource, and per tag_resource/untag_resource call
+LIFECYCLE_PREVIEW_MAX_IMAGES = 100 # Expiring images listed in the preview prop, the count covers all of them
+MAX_REPLICATION_RULES = 10 # Per registry, shared by every component replicating from this account
+REPLICATION_PUT_ATTEMPTS = 3 # Puts in one invocation while other writers keep dropping this one's rules
+MAX_REPLICATION_DESTINATIONS = 25 # Per rule
+MAX_REPLICATION_FILTERS = 100 # Per rule
+
+REPO_PROPERTIES = {
+    "name": {"type": "string"},
+    "changeable_tags": {"type": "string", "enum": ["MUTABLE", "IMMUTABLE"]},
+    "scan_on_push": {"type": "boolean"},
+    "kms_key_arn": {"type": "string"},
+    "tags": {"type": "object", "additionalProperties": {"type": "string"}}
+}
+
+# Mirrors the repo input schema in kommand.json, which isn't deployed with the lambda
+COMPONENT_DEF_SCHEMA = {
+    "type": "object",
+    "properties": {
+        **REPO_PROPERTIES,
+        "registry_account_id": {"type": "string"},
+        "trust_level": {"type": "string", "enum": ["full", "code", "zero"]},
+        "drift_check_deploys": {"type": "integer", "minimum": 1},
+        "drift_check_hours": {"type": "number", "exclusiveMinimum": 0},
+        "lifecycle_policy": {
+            "type": "object",
+            "properties": {"rules": {"type": "array", "minItems": 1}},
+            "required": ["rules"]
+        },
+        "lifecycle_policy_preview": {"type": "boolean"},
+        "replication": {
+            "type": "object",
+            "properties": {
+                "destinations": {
+                    "type": "array",
+                    "minItems": 1,
+                    "maxItems": MAX_REPLICATION_DESTINATIONS,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "region": {"type": "string"},
+                            "registry_id": {"type": "string"}
+                        },
+                        "required": ["region"]
+                    }
+                },
+                "repository_filters": {"type": "array", "minItems": 1, "maxItems": MAX_REPLICATION_FILTERS, "items": {"type": "string"}}
+            },
+            "required": ["destinations"]
+        },
+        "repositories": {
+            "type": "object",
+            "additionalProperties": {
+                "type": "object",
+                "properties": REPO_PROPERTIES
+            }
+        }
+    }
+}
+
+REPOSITORY_OPS = [
+    "get_repository", "create_repository", "update_image_scanning_configuration",
+    "update_image_tag_mutability", "add_tags", "remove_tags", "get_lifecycle_policy",
+    "preview_lifecycle_policy", "put_lifecycle_policy", "delete_lifecycle_policy"
+]
+# Only apply to the top-level repository, so they can't be combined with repositories
+SINGLE_REPO_KEYS = ["name", "changeable_tags", "scan_on_push", "kms_key_arn", "lifecycle_policy", "lifecycle_policy_preview"]
+FLEET_OPS = [
+    "get_repositories", "create_repositories", "update_repositories",
+    "tag_repositories", "untag_repositories"
+]
 
 def lambda_handler(event, context):
     try:
-        print(f"event = {event}")
+        log("event", event, level="DEBUG")
         account_number = account_context(context)['number']
         region = account_context(context)['region']
         eh.capture_event(event)
@@ -29,6 +116,16 @@ def lambda_handler(event, context):
         repo_id = event.get("repo_id")
         cdef = event.get("component_def")
         cname = event.get("component_name")
+        # Callbacks carry the def that was validated on the first invocation
+        if (not event.get("pass_back_data")) and (not validate_component_def(eh, cdef, COMPONENT_DEF_SCHEMA)):
+            return eh.finish()
+
+        repositories = cdef.get("repositories") or {}
+        single_repo_keys = [k for k in SINGLE_REPO_KEYS if cdef.get(k)]
+        if repositories and single_repo_keys:
+            eh.add_log("Options Not Supported With repositories", {"keys": single_repo_keys}, is_error=True)
+            eh.perm_error(f"{', '.join(single_repo_keys)} only apply to a single repository and can't be combined with repositories", 0)
+            return eh.finish()
 
         name = cdef.get("name") or component_safe_name(
             project_code, repo_id, cname, max_chars=255,
@@ -38,52 +135,89 @@ def lambda_handler(event, context):
         registry_account_id = cdef.get("registry_account_id") or None
         tags = cdef.get("tags") or {}
         trust_level = cdef.get("trust_level")
-        
-        changeable_tags = cdef.get("changeable_tags") or "MUTABLE"
-        if changeable_tags not in ["MUTABLE", "IMMUTABLE"]:
-            raise Exception(f"Invalid changeable_tags value: {changeable_tags}")
+        drift_check_deploys = cdef.get("drift_check_deploys") or DRIFT_CHECK_DEPLOYS
+        drift_check_hours = cdef.get("drift_check_hours") or DRIFT_CHECK_HOURS
+        lifecycle_policy = cdef.get("lifecycle_policy")
+        lifecycle_policy_preview = cdef.get("lifecycle_policy_preview") or False
+        replication = cdef.get("replication")
+        prev_fleet = (prev_state.get("props") or {}).get("repositories") or {}
 
-        scan_on_push = cdef.get("scan_on_push") or False
-        if scan_on_push not in [True, False]:
-            raise Exception(f"Invalid scan_on_push value: {scan_on_push}")
+        repo_def = gen_repo_def(name, registry_account_id, cdef)
+        changeable_tags = repo_def["imageTagMutability"]
+        scan_on_push = repo_def["imageScanningConfiguration"]["scanOnPush"]
 
-        kms_key = cdef.get("kms_key_arn")
+        # Top-level tags apply to every repository, a repository's own tags win
+        fleet_defs = {
+            key: gen_repo_def(
+                spec.get("name") or component_safe_name(
+                    project_code, repo_id, f"{cname}-{key}", max_chars=255,
+                    no_uppercase=True
+                ), 
+                registry_account_id, {**spec, "tags": {**tags, **(spec.get("tags") or {})}}
+            ) for key, spec in repositories.items()
+        }
     
+        replication_rule = gen_replication_rule(
+            replication, [d["repositoryName"] for d in fleet_defs.values()] if repositories else [name], account_number
+        )
+        prev_replication_rule = (prev_state.get("props") or {}).get("replication_rule")
+        # Filters default to every repository's name, which the schema can't bound
+        if replication_rule and (event.get("op") == "upsert") and (len(replication_rule["repositoryFilters"]) > MAX_REPLICATION_FILTERS):
+            eh.add_log("Too Many Repositories to Replicate", {"filters": len(replication_rule["repositoryFilters"])}, is_error=True)
+            eh.perm_error(f"a replication rule allows at most {MAX_REPLICATION_FILTERS} repository filters, set replication.repository_filters to prefixes shared by the repositories", 0)
+            return eh.finish()
+
+        check_op = "get_repositories" if repositories else "get_repository"
+        def_hash = gen_def_hash((
+            {"repositories": fleet_defs, "replicationRule": replication_rule} if replication_rule else fleet_defs
+        ) if repositories else remove_none_attributes({
+            **repo_def, "lifecyclePolicy": lifecycle_policy, "lifecyclePolicyPreview": lifecycle_policy_preview or None,
+            "replicationRule": replication_rule
+        }))
+
         if event.get("pass_back_data"):
             print(f"pass_back_data found")
         elif event.get("op") == "upsert":
-            if trust_level == "full":
+            if trust_level in ["full", "code"]:
                 eh.add_op("compare_defs")
             else:
-                eh.add_op("get_repository")
+                eh.add_op(check_op)
 
         elif event.get("op") == "delete":
-            eh.add_op("delete_repository", {"create_and_remove": False, "name": name})
-            
-        compare_defs(event)
-
-        repo_def = remove_none_attributes({
-            "registryId": registry_account_id,
-            "repositoryName": name,
-            "tags": format_tags(tags) or None,
-            "imageTagMutability": changeable_tags, #Editable
-            "imageScanningConfiguration": {
-                "scanOnPush": scan_on_push
-            },
-            "encryptionConfiguration": {
-                "encryptionType": "KMS",
-                "kmsKey": kms_key
-            } if kms_key else None
-        })
+            if repositories or prev_fleet:
+                eh.add_op("delete_repositories", {
+                    key: {"name": v.get("name"), "registry_id": v.get("registry_id")}
+                    for key, v in prev_fleet.items()
+                } or {
+                    key: {"name": v["repositoryName"], "registry_id": v.get("registryId")}
+                    for key, v in fleet_defs.items()
+                })
+            else:
+                eh.add_op("delete_repository", {"create_and_remove": False, "name": name})
+            if prev_replication_rule:
+                eh.add_op("update_replication_configuration")
 
-        compare_defs(event)
-        get_repository(name, repo_def, prev_state, region, account_number, tags)
-        create_repository(name, repo_def)
-        update_image_scanning_configuration(name, scan_on_push)
-        update_image_tag_mutability(name, changeable_tags)
-        add_tags()
-        remove_tags()
-        delete_repository()
+        eh.run_ops([
+            (compare_defs, prev_state, def_hash, check_op, drift_check_deploys, drift_check_hours),
+            (get_repository, name, repo_def, prev_state, region, account_number, tags, def_hash, lifecycle_policy, replication_rule),
+            (create_repository, name, repo_def, lifecycle_policy, lifecycle_policy_preview),
+            (update_image_scanning_configuration, name, scan_on_push),
+            (update_image_tag_mutability, name, changeable_tags),
+            (add_tags,),
+            (remove_tags,),
+            (get_lifecycle_policy, name, lifecycle_policy, lifecycle_policy_preview, prev_state),
+            (preview_lifecycle_policy, name, lifecycle_policy),
+            (put_lifecycle_policy, name, lifecycle_policy),
+            (delete_lifecycle_policy, name),
+            (delete_repository, account_number),
+            (update_replication_configuration, replication_rule if event.get("op") == "upsert" else None, prev_replication_rule, registry_account_id, region, account_number),
+            (get_repositories, fleet_defs, prev_fleet, prev_state.get("props") or {}, registry_account_id, account_number, def_hash, replication_rule, prev_replication_rule),
+            (create_repositories,),
+            (update_repositories,),
+            (tag_repositories,),
+            (untag_repositories,),
+            (delete_repositories, account_number)
+        ])
             
         return eh.finish()
 
@@ -94,24 +228,64 @@ def lambda_handler(event, context):
         eh.declare_return(200, 0, error_code=str(e))
         return eh.finish()
 
-@ext(handler=eh, op="compare_defs")
-def compare_defs(event):
-    old_rendef = event.get("prev_state", {}).get("rendef", {})
-    new_rendef = event.get("component_def")
+def gen_repo_def(name, registry_account_id, spec):
+    tags = spec.get("tags") or {}
+    changeable_tags = spec.get("changeable_tags") or "MUTABLE"
+    scan_on_push = spec.get("scan_on_push") or False
+    kms_key = spec.get("kms_key_arn")
+
+    return remove_none_attributes({
+        "registryId": registry_account_id,
+        "repositoryName": name,
+        "tags": format_tags(tags) or None,
+        "imageTagMutability": changeable_tags, #Editable
+        "imageScanningConfiguration": {
+            "scanOnPush": scan_on_push
+        },
+        "encryptionConfiguration": {
+            "encryptionType": "KMS",
+            "kmsKey": kms_key
+        } if kms_key else None
+    })
+
+def gen_def_hash(repo_def):
+    """Hashes the resolved repository definition(s), so only settings that reach ECR count"""
+    return hashlib.sha256(json.dumps(repo_def, sort_keys=True).encode()).hexdigest()
 
-    _ = old_rendef.pop("trust_level", None)
-    _ = new_rendef.pop("trust_level", None)
+def is_drift_check(op):
+    """Drift checks read ECR itself, since the cache only holds what this container last saw"""
+    return isinstance(eh.ops.get(op), dict) and eh.ops[op].get("drift_check")
 
-    if old_rendef != new_rendef:
-        eh.add_op("get_repository")
+def set_checked_props(def_hash):
+    eh.add_props({"def_hash": def_hash, "deploys_since_check": 0, "last_checked_at": int(time.time())})
 
-    else:
-        eh.add_links(event.get("prev_state", {}).get('links'))
-        eh.add_props(event.get("prev_state", {}).get('props'))
-        eh.add_log("Full Trust, No Change: Exiting", {"old": old_rendef, "new": new_rendef})
+@ext(handler=eh, op="compare_defs", depends_on=[])
+def compare_defs(prev_state, def_hash, check_op, drift_check_deploys, drift_check_hours):
+    """Skips every ECR call when the definition hasn't changed since the last deploy,
+    except every drift_check_deploys deploys or drift_check_hours hours, when the repository is read anyway"""
+    old_props = prev_state.get("props") or {}
+    old_hash = old_props.get("def_hash")
 
-@ext(handler=eh, op="get_repository")
-def get_repository(name, repo_def, prev_state, region, account_number, tags):
+    if old_hash != def_hash:
+        eh.add_log("Definitions Don't Match, Deploying", {"old_hash": old_hash, "new_hash": def_hash})
+        eh.add_op(check_op)
+        return 0
+
+    deploys_since_check = (old_props.get("deploys_since_check") or 0) + 1
+    hours_since_check = (time.time() - (old_props.get("last_checked_at") or 0)) / 3600
+    if (deploys_since_check >= drift_check_deploys) or (hours_since_check >= drift_check_hours):
+        eh.add_log("No Change, Checking for Drift", {"deploys_since_check": deploys_since_check, "hours_since_check": round(hours_since_check, 1)})
+        eh.add_op(check_op, {"drift_check": True})
+        return 0
+
+    eh.add_links(prev_state.get('links') or {})
+    eh.add_props(old_props)
+    eh.add_props({"deploys_since_check": deploys_since_check})
+    eh.add_log("No Change: Exiting", {"def_hash": def_hash, "deploys_since_check": deploys_since_check})
+
+@ext(handler=eh, op="get_repository", depends_on=["compare_defs"])
+def get_repository(name, repo_def, prev_state, region, account_number, tags, def_hash, lifecycle_policy, replication_rule):
+    set_checked_props(def_hash)
 
     if prev_state and prev_state.get("props") and prev_state.get("props").get("name"):
         prev_name = prev_state.get("props").get("name")
@@ -122,17 +296,34 @@ def get_repository(name, repo_def, prev_state, region, account_number, tags):
                 "registry_id": prev_state.get("props").get("registry_id")
             })
 
+    # Switching from repositories, the previous deploy's repositories go once this one is in place
+    prev_fleet = (prev_state.get("props") or {}).get("repositories") or {}
+    removed = {
+        key: {"name": v.get("name"), "registry_id": v.get("registry_id")}
+        for key, v in prev_fleet.items() if v.get("name") != name
+    }
+    if removed:
+        eh.add_op("delete_repositories", removed)
+
 
+    key = (repo_def.get("registryId") or account_number, name)
     try:
-        params = remove_none_attributes({
-            "repositoryNames": [name],
-            "registryId": repo_def.get("registryId")
-        })
-        response = ecr.describe_repositories(**params)
-        print(f"Get repo response: {response}")
-        if response.get("repositories"):
-            eh.add_log("Found Repository", response.get("repositories")[0])
-            repo = response.get("repositories")[0]
+        cached = None if is_drift_check("get_repository") else repo_cache.get(key)
+        if cached:
+            repositories = [cached["repository"]]
+        else:
+            params = remove_none_attributes({
+                "repositoryNames": [name],
+                "registryId": repo_def.get("registryId")
+            })
+            response = ecr.describe_repositories(**params)
+            log("Get repo response", response, level="DEBUG")
+            repositories = response.get("repositories")
+        log("Repository cache", repo_cache.stats(), level="DEBUG")
+
+        if repositories:
+            eh.add_log("Found Repository", repositories[0])
+            repo = repositories[0]
             eh.add_props({
                 "arn": repo['repositoryArn'],
                 "name": repo['repositoryName'],
@@ -147,35 +338,52 @@ def get_repository(name, repo_def, prev_state, region, account_number, tags):
             if repo.get("imageScanningConfiguration", {}).get("scanOnPush") != repo_def.get("imageScanningConfiguration", {}).get("scanOnPush"):
                 eh.add_op("update_image_scanning_configuration")
             
-            response = ecr.list_tags_for_resource(
-                resourceArn=repo['repositoryArn']
-            )
-            print(f"tags response = {response}")
-            current_tags = unformat_tags(response.get("Tags") or [])
-
-            if tags != current_tags:
-                remove_tags = [k for k in current_tags.keys() if k not in tags]
-                add_tags = {k:v for k,v in tags.items() if k not in current_tags.keys()}
-                if remove_tags:
-                    eh.add_op("remove_tags", remove_tags)
-                if add_tags:
-                    eh.add_op("add_tags", add_tags)
+            if cached:
+                current_tags = cached["tags"]
+            else:
+                response = ecr.list_tags_for_resource(
+                    resourceArn=repo['repositoryArn']
+                )
+                log("tags response", response, level="DEBUG")
+                current_tags = unformat_tags(response.get("tags") or [])
+                repo_cache.put(key, {"repository": repo, "tags": current_tags})
+
+            upsert_tags, remove_tags = diff_tags(current_tags, tags)
+            if remove_tags:
+                eh.add_op("remove_tags", remove_tags)
+            if upsert_tags:
+                eh.add_op("add_tags", upsert_tags)
+
+            # A policy this component put is removed with the input, one set outside of it is left alone
+            if lifecycle_policy or (prev_state.get("props") or {}).get("lifecycle_policy_managed"):
+                eh.add_op("get_lifecycle_policy")
         
         else:
             eh.add_op("create_repository")
 
-    except botocore.exceptions.ClientError as e:
+        if replication_rule or (prev_state.get("props") or {}).get("replication_rule"):
+            eh.add_op("update_replication_configuration")
+
+    except ClientError as e:
         if e.response['Error']['Code'] == 'RepositoryNotFoundException':
             eh.add_op("create_repository")
+            if replication_rule or (prev_state.get("props") or {}).get("replication_rule"):
+                eh.add_op("update_replication_configuration")
         else:
             handle_common_errors(e, eh, "Get Repository Failed", 10)
 
-@ext(handler=eh, op="create_repository")
-def create_repository(name, repo_def):
+@ext(handler=eh, op="create_repository", depends_on=["get_repository"])
+def create_repository(name, repo_def, lifecycle_policy, lifecycle_policy_preview):
 
     try:
         response = ecr.create_repository(**repo_def).get("repository")
         eh.add_log("Created ECR Repository", response)
+        if lifecycle_policy and not lifecycle_policy_preview:
+            eh.add_op("put_lifecycle_policy")
+        repo_cache.put((response['registryId'], response['repositoryName']), {
+            "repository": response, 
+            "tags": unformat_tags(repo_def.get("tags") or [])
+        })
         eh.add_props({
             "arn": response['repositoryArn'],
             "name": response['repositoryName'],
@@ -195,7 +403,7 @@ def create_repository(name, repo_def):
             ]
         )
 
-@ext(handler=eh, op="update_image_scanning_configuration")
+@ext(handler=eh, op="update_image_scanning_configuration", depends_on=["get_repository", "create_repository"])
 def update_image_scanning_configuration(name, scan_on_push):
     registry_id = eh.props.get("registry_id")
 
@@ -208,6 +416,7 @@ def update_image_scanning_configuration(name, scan_on_push):
             }
         )
         eh.add_log("Updated Image Scanning Configuration", response)
+        repo_cache.update((registry_id, name), set_cached_config("imageScanningConfiguration", {"scanOnPush": scan_on_push}))
     
     except ClientError as e:
         handle_common_errors(
@@ -219,7 +428,7 @@ def update_image_scanning_configuration(name, scan_on_push):
             ]
         )
 
-@ext(handler=eh, op="update_image_tag_mutability")
+@ext(handler=eh, op="update_image_tag_mutability", depends_on=["get_repository", "create_repository"])
 def update_image_tag_mutability(name, image_tag_mutability):
     registry_id = eh.props.get("registry_id")
 
@@ -230,6 +439,7 @@ def update_image_tag_mutability(name, image_tag_mutability):
             imageTagMutability=image_tag_mutability
         )
         eh.add_log("Updated Image Tag Mutability", response)
+        repo_cache.update((registry_id, name), set_cached_config("imageTagMutability", image_tag_mutability))
     
     except ClientError as e:
         handle_common_errors(
@@ -240,11 +450,13 @@ def update_image_tag_mutability(name, image_tag_mutability):
             ]
         )
 
-@ext(handler=eh, op="delete_repository")
-def delete_repository():
+# Repositories are only deleted once every other change has gone through
+@ext(handler=eh, op="delete_repository", depends_on=REPOSITORY_OPS)
+def delete_repository(account_number):
     repo_name = eh.ops['delete_repository'].get("name")
     car = eh.ops['delete_repository'].get("create_and_remove")
     registry_id = eh.ops['delete_repository'].get("registry_id")
+    repo_cache.invalidate((registry_id or account_number, repo_name))
 
     try:
         params = remove_none_attributes({
@@ -256,43 +468,564 @@ def delete_repository():
         _ = ecr.delete_repository(**params)
         eh.add_log("Deleted Repo if it Existed", {"name": repo_name})
 
-    except botocore.exceptions.ClientError as e:
+    except ClientError as e:
         if e.response['Error']['Code'] == "RepositoryNotFoundException":
             eh.add_log("Old Repo Does Not Exist", {"name": repo_name})
         else:
             handle_common_errors(e, eh, "Delete Repo Failed", 80 if car else 10)
 
-@ext(handler=eh, op="add_tags")
+@ext(handler=eh, op="add_tags", depends_on=["get_repository", "create_repository"])
 def add_tags():
-    tags = format_tags(eh.ops['add_tags'])
+    tags = dict(eh.ops['add_tags'])
     arn = eh.props['arn']
 
     try:
-        ecr.tag_resource(
-            ResourceArn=arn,
-            Tags=tags
-        )
+        tag_resource_chunked(arn, eh.ops['add_tags'])
         eh.add_log("Tags Added", {"tags": tags})
+        repo_cache.update((eh.props['registry_id'], eh.props['name']), set_cached_tags(tags))
 
     except ClientError as e:
-        handle_common_errors(e, eh, "Add Tags Failed", 50, ['InvalidParameterValueException'])
+        handle_common_errors(e, eh, "Add Tags Failed", 50, TAG_PERM_ERRORS)
         
-@ext(handler=eh, op="remove_tags")
+@ext(handler=eh, op="remove_tags", depends_on=["get_repository", "create_repository"])
 def remove_tags():
+    tag_keys = list(eh.ops['remove_tags'])
     arn = eh.props['arn']
 
     try:
+        untag_resource_chunked(arn, eh.ops['remove_tags'])
+        eh.add_log("Tags Removed", {"tags": tag_keys})
+        repo_cache.update((eh.props['registry_id'], eh.props['name']), set_cached_tags({}, tag_keys))
+
+    except ClientError as e:
+        handle_common_errors(e, eh, "Remove Tags Failed", 65, TAG_PERM_ERRORS)
+
+@ext(handler=eh, op="get_lifecycle_policy", depends_on=["get_repository", "create_repository"])
+def get_lifecycle_policy(name, lifecycle_policy, lifecycle_policy_preview, prev_state):
+    try:
+        response = ecr.get_lifecycle_policy(registryId=eh.props.get("registry_id"), repositoryName=name)
+        current_policy = json.loads(response["lifecyclePolicyText"])
+    except ClientError as e:
+        if e.response['Error']['Code'] == "LifecyclePolicyNotFoundException":
+            current_policy = None
+        else:
+            handle_common_errors(e, eh, "Get Lifecycle Policy Failed", 40, ["RepositoryNotFoundException"])
+            return 0
+
+    if lifecycle_policy_preview and lifecycle_policy:
+        eh.add_log("Previewing Lifecycle Policy, Not Applying", {"current": current_policy})
+        eh.add_op("preview_lifecycle_policy")
+        # Previewing doesn't take over a policy set outside this component, only keeps one it put
+        if (prev_state.get("props") or {}).get("lifecycle_policy_managed"):
+            eh.add_props({"lifecycle_policy_managed": True})
+    elif lifecycle_policy and (canonical_policy(lifecycle_policy) != canonical_policy(current_policy)):
+        eh.add_log("Lifecycle Policy Changed", {"current": current_policy, "desired": lifecycle_policy})
+        eh.add_op("put_lifecycle_policy")
+    elif lifecycle_policy:
+        eh.add_props({"lifecycle_policy_managed": True})
+    elif current_policy:
+        eh.add_op("delete_lifecycle_policy")
+
+@ext(handler=eh, op="preview_lifecycle_policy", depends_on=["get_lifecycle_policy", "create_repository"])
+def preview_lifecycle_policy(name, lifecycle_policy):
+    try:
+        images = list_repository_images(name, eh.props.get("registry_id"))
+    except ClientError as e:
+        handle_common_errors(e, eh, "List Images Failed", 45, ["RepositoryNotFoundException"])
+        return 0
+
+    expiring = evaluate_lifecycle_policy(lifecycle_policy, images)
+    eh.add_log("Lifecycle Policy Preview", {"images": len(images), "expiring": len(expiring)})
+    eh.add_props({"lifecycle_policy_preview": {
+        "images": len(images),
+        "expiring": len(expiring),
+        "expiring_images": [{
+            "digest": i["imageDigest"], 
+            "tags": i.get("imageTags") or [], 
+            "rule_priority": i["rulePriority"]
+        } for i in expiring[:LIFECYCLE_PREVIEW_MAX_IMAGES]]
+    }})
+
+@ext(handler=eh, op="put_lifecycle_policy", depends_on=["get_lifecycle_policy", "create_repository"])
+def put_lifecycle_policy(name, lifecycle_policy):
+    try:
+        response = ecr.put_lifecycle_policy(
+            registryId=eh.props.get("registry_id"),
+            repositoryName=name,
+            lifecyclePolicyText=json.dumps(lifecycle_policy)
+        )
+        eh.add_log("Put Lifecycle Policy", {"policy": lifecycle_policy, "registry_id": response.get("registryId")})
+        eh.add_props({"lifecycle_policy_managed": True})
+    except ClientError as e:
+        handle_common_errors(e, eh, "Put Lifecycle Policy Failed", 45, ["RepositoryNotFoundException", "InvalidParameterException", "ValidationException"])
+
+@ext(handler=eh, op="delete_lifecycle_policy", depends_on=["get_lifecycle_policy"])
+def delete_lifecycle_policy(name):
+    try:
+        ecr.delete_lifecycle_policy(registryId=eh.props.get("registry_id"), repositoryName=name)
+        eh.add_log("Deleted Lifecycle Policy", {"name": name})
+    except ClientError as e:
+        if e.response['Error']['Code'] == "LifecyclePolicyNotFoundException":
+            eh.add_log("Lifecycle Policy Already Deleted", {"name": name})
+        else:
+            handle_common_errors(e, eh, "Delete Lifecycle Policy Failed", 45, ["RepositoryNotFoundException"])
+
+@ext(handler=eh, op="get_repositories", depends_on=["compare_defs"])
+def get_repositories(fleet_defs, prev_fleet, prev_props, registry_id, account_number, def_hash, replication_rule, prev_replication_rule):
+    set_checked_props(def_hash)
+    if replication_rule or prev_replication_rule:
+        eh.add_op("update_replication_configuration")
+    # By name, so a repository that only moved to another key is kept
+    names = [d["repositoryName"] for d in fleet_defs.values()]
+    removed = {
+        key: {"name": v.get("name"), "registry_id": v.get("registry_id")}
+        for key, v in prev_fleet.items() if v.get("name") not in names
+    }
+    if prev_props.get("name") and (prev_props["name"] not in names):
+        # Switching from a single repository, keyed by its name since it had no key
+        removed[prev_props["name"]] = {"name": prev_props["name"], "registry_id": prev_props.get("registry_id")}
+    if removed:
+        eh.add_op("delete_repositories", removed)
+
+    found, current_tags = {}, {}
+    for repo_def in ([] if is_drift_check("get_repositories") else fleet_defs.values()):
+        cached = repo_cache.get((registry_id or account_number, repo_def["repositoryName"]))
+        if cached:
+            found[repo_def["repositoryName"]] = cached["repository"]
+            current_tags[cached["repository"]["repositoryArn"]] = cached["tags"]
+
+    try:
+        described = describe_repositories_batched(
+            [d["repositoryName"] for d in fleet_defs.values() if d["repositoryName"] not in found], registry_id
+        )
+        found_arns = [r["repositoryArn"] for r in described.values()]
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_TAG_WORKERS, len(found_arns)))) as executor:
+            described_tags = dict(zip(found_arns, executor.map(list_repository_tags, found_arns)))
+    except ClientError as e:
+        handle_common_errors(e, eh, "Get Repositories Failed", 10)
+        return 0
+
+    for repo in described.values():
+        repo_cache.put((repo['registryId'], repo['repositoryName']), {
+            "repository": repo, 
+            "tags": described_tags[repo['repositoryArn']]
+        })
+    found.update(described)
+    current_tags.update(described_tags)
+    log("Repository cache", repo_cache.stats(), level="DEBUG")
+
+    fleet_props, to_create, to_update, to_tag, to_untag = {}, {}, {}, {}, {}
+    for key, repo_def in fleet_defs.items():
+        repo = found.get(repo_def["repositoryName"])
+        if not repo:
+            to_create[key] = repo_def
+            continue
+
+        fleet_props[key] = {
+            "arn": repo['repositoryArn'],
+            "name": repo['repositoryName'],
+            "uri": repo['repositoryUri'],
+            "registry_id": repo['registryId']
+        }
+
+        if (repo.get("encryptionConfiguration", {}).get("encryptionType") == "KMS") and not repo_def.get("encryptionConfiguration"):
+            eh.add_log("WARNING: Create a New Component to Change Encryption Type", {"key": key, "encryptionType": "KMS"}, is_error=True)
+        updates = {}
+        if repo.get("imageTagMutability") != repo_def.get("imageTagMutability"):
+            updates["imageTagMutability"] = repo_def.get("imageTagMutability")
+        if repo.get("imageScanningConfiguration", {}).get("scanOnPush") != repo_def["imageScanningConfiguration"]["scanOnPush"]:
+            updates["scanOnPush"] = repo_def["imageScanningConfiguration"]["scanOnPush"]
+        if updates:
+            to_update[key] = {"name": repo['repositoryName'], "registry_id": repo['registryId'], **updates}
+
+        upsert_tags, remove_keys = diff_tags(
+            current_tags.get(repo['repositoryArn']) or {}, 
+            unformat_tags(repo_def.get("tags") or [])
+        )
+        if remove_keys:
+            to_untag[key] = {"arn": repo['repositoryArn'], "keys": remove_keys}
+        if upsert_tags:
+            to_tag[key] = {"arn": repo['repositoryArn'], "tags": upsert_tags}
+
+    eh.add_log("Found Repositories", {"found": list(fleet_props.keys()), "missing": list(to_create.keys())})
+    eh.add_props({"repositories": fleet_props})
+    if to_create:
+        eh.add_op("create_repositories", to_create)
+    if to_update:
+        eh.add_op("update_repositories", to_update)
+    if to_tag:
+        eh.add_op("tag_repositories", to_tag)
+    if to_untag:
+        eh.add_op("untag_repositories", to_untag)
+
+@ext(handler=eh, op="create_repositories", depends_on=["get_repositories"])
+def create_repositories():
+    pending = eh.ops['create_repositories']
+
+    for key in list(pending.keys()):
+        try:
+            response = ecr.create_repository(**pending[key]).get("repository")
+            eh.add_log("Created ECR Repository", {"key": key, "name": response['repositoryName']})
+            repo_cache.put((response['registryId'], response['repositoryName']), {
+                "repository": response, 
+                "tags": unformat_tags(pending[key].get("tags") or [])
+            })
+            eh.props.setdefault("repositories", {})[key] = {
+                "arn": response['repositoryArn'],
+                "name": response['repositoryName'],
+                "uri": response['repositoryUri'],
+                "registry_id": response['registryId']
+            }
+            del pending[key]
+        except ClientError as e:
+            handle_common_errors(
+                e, eh, f"Create ECR Repository {key} Failed", 20,
+                perm_errors=[
+                    "LimitExceededException", 
+                    "RepositoryAlreadyExistsException",
+                    "InvalidParameterException",
+                    "InvalidTagParameterException",
+                    "TooManyTagsException"
+                ]
+            )
+            return 0
+
+@ext(handler=eh, op="update_repositories", depends_on=["get_repositories"])
+def update_repositories():
+    pending = eh.ops['update_repositories']
+
+    for key in list(pending.keys()):
+        update = pending[key]
+        try:
+            if "scanOnPush" in update:
+                ecr.put_image_scanning_configuration(
+                    registryId=update["registry_id"],
+                    repositoryName=update["name"],
+                    imageScanningConfiguration={
+                        "scanOnPush": update["scanOnPush"]
+                    }
+                )
+                repo_cache.update((update["registry_id"], update["name"]), set_cached_config("imageScanningConfiguration", {"scanOnPush": update["scanOnPush"]}))
+                del update["scanOnPush"]
+            if "imageTagMutability" in update:
+                ecr.put_image_tag_mutability(
+                    registryId=update["registry_id"],
+                    repositoryName=update["name"],
+                    imageTagMutability=update["imageTagMutability"]
+                )
+                repo_cache.update((update["registry_id"], update["name"]), set_cached_config("imageTagMutability", update["imageTagMutability"]))
+                del update["imageTagMutability"]
+            eh.add_log("Updated Repository Configuration", {"key": key, "name": update["name"]})
+            del pending[key]
+        except ClientError as e:
+            handle_common_errors(
+                e, eh, f"Update Repository {key} Failed", 30,
+                perm_errors=[
+                    "RepositoryNotFoundException",
+                    "InvalidParameterException",
+                    "ValidationException"
+                ]
+            )
+            return 0
+
+@ext(handler=eh, op="tag_repositories", depends_on=["get_repositories"])
+def tag_repositories():
+    pending = eh.ops['tag_repositories']
+    fleet_props = eh.props.get("repositories") or {}
+
+    for key in list(pending.keys()):
+        tags = dict(pending[key]["tags"])
+        try:
+            tag_resource_chunked(pending[key]["arn"], pending[key]["tags"])
+            eh.add_log("Tags Added", {"key": key, "tags": tags})
+            if key in fleet_props:
+                repo_cache.update((fleet_props[key]["registry_id"], fleet_props[key]["name"]), set_cached_tags(tags))
+            del pending[key]
+        except ClientError as e:
+            handle_common_errors(e, eh, f"Add Tags to {key} Failed", 50, TAG_PERM_ERRORS)
+            return 0
+
+@ext(handler=eh, op="untag_repositories", depends_on=["get_repositories"])
+def untag_repositories():
+    pending = eh.ops['untag_repositories']
+    fleet_props = eh.props.get("repositories") or {}
+
+    for key in list(pending.keys()):
+        tag_keys = list(pending[key]["keys"])
+        try:
+            untag_resource_chunked(pending[key]["arn"], pending[key]["keys"])
+            eh.add_log("Tags Removed", {"key": key, "tags": tag_keys})
+            if key in fleet_props:
+                repo_cache.update((fleet_props[key]["registry_id"], fleet_props[key]["name"]), set_cached_tags({}, tag_keys))
+            del pending[key]
+        except ClientError as e:
+            handle_common_errors(e, eh, f"Remove Tags from {key} Failed", 65, TAG_PERM_ERRORS)
+            return 0
+
+@ext(handler=eh, op="delete_repositories", depends_on=FLEET_OPS + REPOSITORY_OPS)
+def delete_repositories(account_number):
+    pending = eh.ops['delete_repositories']
+
+    for key in list(pending.keys()):
+        repo_cache.invalidate((pending[key].get("registry_id") or account_number, pending[key]["name"]))
+        try:
+            ecr.delete_repository(**remove_none_attributes({
+                "repositoryName": pending[key]["name"],
+                "registryId": pending[key].get("registry_id"),
+                "force": True
+            }))
+            eh.add_log("Deleted Repo if it Existed", {"key": key, "name": pending[key]["name"]})
+        except ClientError as e:
+            if e.response['Error']['Code'] == "RepositoryNotFoundException":
+                eh.add_log("Old Repo Does Not Exist", {"key": key, "name": pending[key]["name"]})
+            else:
+                handle_common_errors(e, eh, f"Delete Repo {key} Failed", 80)
+                return 0
+        del pending[key]
+
+@ext(handler=eh, op="update_replication_configuration", depends_on=REPOSITORY_OPS + FLEET_OPS)
+def update_replication_configuration(replication_rule, prev_replication_rule, registry_id, region, account_number):
+    """The replication configuration belongs to the registry, so it is read and written back whole.
+    Only the rule this component put (the replication_rule prop) is replaced or removed, 
+    rules put by anything else are written back as they were found. The configuration is read 
+    again after each put, and merged and put again if another writer's put dropped any rule 
+    this one wrote. Every component checks its own put, so the other writer does the same."""
+    if registry_id and (registry_id != account_number):
+        eh.add_log("Replication Needs a Repository in This Account", {"registry_id": registry_id}, is_error=True)
+        eh.perm_error("replication is configured on this account's registry, remove registry_account_id or replication", 70)
+        return 0
+
+    try:
+        current_rules = describe_replication_rules()
+        for attempt in range(REPLICATION_PUT_ATTEMPTS):
+            rules, owned = merge_replication_rules(current_rules, replication_rule, prev_replication_rule)
+            if sorted(map(canonical_replication_rule, rules)) == sorted(map(canonical_replication_rule, current_rules)):
+                eh.add_log("Replication Configuration Unchanged", {"rules": len(rules)})
+                break
+            elif len(rules) > MAX_REPLICATION_RULES:
+                eh.add_log("Too Many Replication Rules", {"rules": rules}, is_error=True)
+                eh.perm_error(f"the registry already has {len(current_rules)} replication rules, and allows at most {MAX_REPLICATION_RULES}", 70)
+                return 0
+
+            ecr.put_replication_configuration(replicationConfiguration={"rules": rules})
+            current_rules = describe_replication_rules()
+            found = set(map(canonical_replication_rule, current_rules))
+            lost = [r for r in rules if canonical_replication_rule(r) not in found]
+            if not lost:
+                eh.add_log("Updated Replication Configuration", {"rule": owned, "previous_rule": prev_replication_rule})
+                break
+            eh.add_log("Replication Configuration Changed Concurrently, Merging Again", {"attempt": attempt + 1, "lost": lost})
+        else:
+            eh.add_log("Replication Configuration Kept Changing", {"attempts": REPLICATION_PUT_ATTEMPTS}, is_error=True)
+            eh.retry_error("Replication Configuration Changed Concurrently", 70)
+            return 0
+    except ClientError as e:
+        handle_common_errors(e, eh, "Update Replication Configuration Failed", 70, ["ValidationException", "InvalidParameterException"])
+        return 0
+
+    if owned:
+        eh.add_props({"replication_rule": owned})
+    if replication_rule:
+        destinations = replication_rule["destinations"]
+        fleet_props = eh.props.get("repositories")
+        if fleet_props is not None:
+            for repo_props in fleet_props.values():
+                repo_props["replicated_uris"] = replicated_uris(repo_props["name"], destinations, region, account_number)
+        else:
+            eh.add_props({"replicated_uris": replicated_uris(eh.props.get("name"), destinations, region, account_number)})
+
+def gen_replication_rule(replication, names, account_number):
+    """repository_filters default to the names of this component's repositories. 
+    ECR only supports prefix filters, so a name also matches longer names that start with it"""
+    if not replication:
+        return None
+    return {
+        "destinations": [{
+            "region": d["region"],
+            "registryId": d.get("registry_id") or account_number
+        } for d in replication["destinations"]],
+        "repositoryFilters": [{
+            "filter": f,
+            "filterType": "PREFIX_MATCH"
+        } for f in (replication.get("repository_filters") or names)]
+    }
+
+def describe_replication_rules():
+    response = ecr.describe_registry()
+    return (response.get("replicationConfiguration") or {}).get("rules") or []
+
+def merge_replication_rules(current_rules, replication_rule, prev_replication_rule):
+    """Returns the registry's rules with this component's rule in place, and the rule it owns.
+    The previous rule is replaced where it sits, so the other rules keep their order. 
+    A rule that already matches one put by something else is left unmanaged."""
+    prev_key = canonical_replication_rule(prev_replication_rule)
+    others = [r for r in current_rules if canonical_replication_rule(r) != prev_key]
+    if not replication_rule:
+        return others, None
+    if canonical_replication_rule(replication_rule) in [canonical_replication_rule(r) for r in others]:
+        eh.add_log("Matching Replication Rule Already Exists, Leaving Unmanaged", {"rule": replication_rule})
+        return others, None
+
+    rules, replaced = [], False
+    for r in current_rules:
+        if canonical_replication_rule(r) != prev_key:
+            rules.append(r)
+        elif not replaced:
+            rules.append(replication_rule)
+            replaced = True
+    if not replaced:
+        rules.append(replication_rule)
+    return rules, replication_rule
+
+def canonical_replication_rule(rule):
+    """ECR doesn't promise to keep the order of destinations or filters"""
+    if not rule:
+        return None
+    return json.dumps({
+        "destinations": sorted((d["region"], d["registryId"]) for d in rule["destinations"]),
+        "repositoryFilters": sorted((f["filter"], f["filterType"]) for f in rule.get("repositoryFilters") or [])
+    })
+
+def replicated_uris(name, destinations, region, account_number):
+    """Keyed by region, or by registry_id/region for destinations in other accounts.
+    The source region is included, so consumers can always look up their own region"""
+    uris = {region: f"{account_number}.dkr.ecr.{region}.amazonaws.com/{name}"}
+    for d in destinations:
+        key = d["region"] if d["registryId"] == account_number else f"{d['registryId']}/{d['region']}"
+        uris[key] = f"{d['registryId']}.dkr.ecr.{d['region']}.amazonaws.com/{name}"
+    return uris
+
+def describe_repositories_batched(names, registry_id):
+    """Returns {repositoryName: repository} for the names that exist.
+    describe_repositories fails the whole call if any name is missing, 
+    so the first miss falls back to a single paginated listing of the registry."""
+    found = {}
+    for i in range(0, len(names), DESCRIBE_BATCH_SIZE):
+        chunk = names[i:i + DESCRIBE_BATCH_SIZE]
+        try:
+            response = ecr.describe_repositories(**remove_none_attributes({
+                "repositoryNames": chunk,
+                "registryId": registry_id
+            }))
+            found.update({r['repositoryName']: r for r in response.get("repositories") or []})
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'RepositoryNotFoundException':
+                raise e
+            wanted = set(names[i:])
+            paginator = ecr.get_paginator("describe_repositories")
+            for page in paginator.paginate(**remove_none_attributes({"registryId": registry_id})):
+                found.update({r['repositoryName']: r for r in page.get("repositories") or [] if r['repositoryName'] in wanted})
+            break
+
+    log("Described repositories", {"found": len(found), "requested": len(names)}, level="DEBUG")
+    return found
+
+def canonical_policy(policy):
+    return json.dumps(policy, sort_keys=True) if policy else None
+
+def list_repository_images(name, registry_id=None):
+    images = []
+    paginator = ecr.get_paginator("describe_images")
+    for page in paginator.paginate(**remove_none_attributes({"repositoryName": name, "registryId": registry_id})):
+        images.extend(page.get("imageDetails") or [])
+    return images
+
+def evaluate_lifecycle_policy(policy, images, now=None):
+    """Returns the images, as returned by describe_images, that policy would expire, 
+    each with the rulePriority of the rule that expires it. Works offline on any image listing.
+    Rules run in rulePriority order, and an image selected by one rule is never 
+    considered by the rules after it, as in ECR."""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    claimed = set()
+    expiring = []
+    for rule in sorted(policy["rules"], key=lambda r: r["rulePriority"]):
+        selection = rule["selection"]
+        selected = [i for i in images if (i["imageDigest"] not in claimed) and lifecycle_rule_selects(selection, i)]
+        claimed.update(i["imageDigest"] for i in selected)
+        if (rule.get("action") or {}).get("type", "expire") != "expire":
+            continue
+
+        if selection["countType"] == "imageCountMoreThan":
+            newest_first = sorted(selected, key=lambda i: pushed_at(i), reverse=True)
+            expired = newest_first[selection["countNumber"]:]
+        else:
+            cutoff = now - datetime.timedelta(days=selection["countNumber"])
+            expired = [i for i in selected if pushed_at(i) < cutoff]
+        expiring.extend({**i, "rulePriority": rule["rulePriority"]} for i in expired)
+    return expiring
+
+def lifecycle_rule_selects(selection, image):
+    tags = image.get("imageTags") or []
+    status = selection["tagStatus"]
+    if status == "any":
+        return True
+    elif status == "untagged":
+        return not tags
+    elif not tags:
+        return False
+    # Every prefix or pattern listed has to match at least one of the image's tags
+    if selection.get("tagPrefixList"):
+        return all(any(t.startswith(p) for t in tags) for p in selection["tagPrefixList"])
+    if selection.get("tagPatternList"):
+        regexes = [re.compile("^" + ".*".join(re.escape(part) for part in p.split("*")) + "$") for p in selection["tagPatternList"]]
+        return all(any(r.match(t) for t in tags) for r in regexes)
+    return True
+
+def pushed_at(image):
+    value = image.get("imagePushedAt")
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    elif isinstance(value, str):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+def list_repository_tags(arn):
+    response = ecr.list_tags_for_resource(resourceArn=arn)
+    return unformat_tags(response.get("tags") or [])
+
+def diff_tags(current_tags, desired_tags):
+    """Returns the tags to add or change and the tag keys to remove, in one pass over each side"""
+    upsert_tags = {k: v for k, v in desired_tags.items() if (k not in current_tags) or (current_tags[k] != v)}
+    remove_keys = [k for k in current_tags.keys() if k not in desired_tags]
+    return upsert_tags, remove_keys
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def tag_resource_chunked(arn, tags):
+    """Tags in chunks of MAX_TAGS_PER_CALL. Applied keys are removed from tags
+    as each chunk succeeds, so a retry only sends what is left"""
+    for chunk in chunks(list(tags.keys()), MAX_TAGS_PER_CALL):
+        ecr.tag_resource(
+            resourceArn=arn,
+            tags=format_tags({k: tags[k] for k in chunk})
+        )
+        for k in chunk:
+            del tags[k]
+
+def untag_resource_chunked(arn, tag_keys):
+    """Untags in chunks of MAX_TAGS_PER_CALL, removing keys from tag_keys as each chunk succeeds"""
+    for chunk in chunks(list(tag_keys), MAX_TAGS_PER_CALL):
         ecr.untag_resource(
-            ResourceArn=arn,
-            TagKeys=eh.ops['remove_tags']
+            resourceArn=arn,
+            tagKeys=chunk
         )
-        eh.add_log("Tags Removed", {"tags": eh.ops['remove_tags']})
+        del tag_keys[:len(chunk)]
+
+def set_cached_config(field, value):
+    def update(entry):
+        entry["repository"][field] = value
+    return update
 
-    except botocore.exceptions.ClientError as e:
-        handle_common_errors(e, eh, "Remove Tags Failed", 65, ['InvalidParameterValueException'])
+def set_cached_tags(added, removed=None):
+    def update(entry):
+        entry["tags"].update(added)
+        for k in removed or []:
+            entry["tags"].pop(k, None)
+    return update
 
 def format_tags(tags_dict):
-    return [{"Key": k, "Value": v} for k,v in tags_dict]
+    return [{"Key": k, "Value": v} for k,v in tags_dict.items()]
 
 def unformat_tags(tags_list):
     return {t["Key"]: t["Value"] for t in tags_list}
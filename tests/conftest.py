@@ -0,0 +1,86 @@
+import importlib
+import os
+import sys
+
+import pytest
+from botocore.stub import Stubber
+
+from local_s3 import LocalS3
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ACCOUNT_NUMBER = "123456789012"
+REGION = "us-east-1"
+
+# Read by extutil at import time, so they are set before any lambda is loaded
+os.environ.update({
+    "AWS_DEFAULT_REGION": REGION,
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_LAMBDA_FUNCTION_NAME": "ck-test",
+    "AWS_LAMBDA_LOG_STREAM_NAME": "2026/01/01/[$LATEST]test",
+    "emf_metrics": "false"
+})
+
+def load_lambda(folder):
+    """Imports folder/lambda_function.py with the extutil copy deployed next to it.
+    Every call gives fresh modules, so clients, caches and handler state don't leak between tests"""
+    path = os.path.join(ROOT, folder)
+    for name in ["lambda_function", "extutil"]:
+        sys.modules.pop(name, None)
+    sys.path.insert(0, path)
+    try:
+        lambda_function = importlib.import_module("lambda_function")
+        extutil = sys.modules["extutil"]
+    finally:
+        sys.path.remove(path)
+        for name in ["lambda_function", "extutil"]:
+            sys.modules.pop(name, None)
+    return lambda_function, extutil
+
+def load_extutil():
+    return load_lambda("repo")[1]
+
+class LambdaContext:
+    invoked_function_arn = f"arn:aws:lambda:{REGION}:{ACCOUNT_NUMBER}:function:ck-test"
+
+@pytest.fixture
+def context():
+    return LambdaContext()
+
+@pytest.fixture
+def repo():
+    return load_lambda("repo")
+
+@pytest.fixture
+def image():
+    return load_lambda("image")
+
+@pytest.fixture
+def pullthrough():
+    return load_lambda("pullthrough")
+
+@pytest.fixture
+def extutil():
+    return load_extutil()
+
+@pytest.fixture
+def stub():
+    """stub(extutil, "ecr") returns an active Stubber on the client the lambda will use,
+    and checks that every queued response was used"""
+    stubbers = []
+    def make(extutil, service):
+        stubber = Stubber(extutil.get_client(service))
+        stubber.activate()
+        stubbers.append(stubber)
+        return stubber
+    yield make
+    for stubber in stubbers:
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+@pytest.fixture
+def local_s3():
+    """local_s3(extutil) answers the S3 client the lambda will use from memory"""
+    def make(extutil):
+        return LocalS3(extutil.get_client("s3"))
+    return make
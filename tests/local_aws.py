@@ -0,0 +1,268 @@
+import datetime
+import hashlib
+import io
+import json
+
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+
+ACCOUNT_NUMBER = "123456789012"
+REGION = "us-east-1"
+
+class LocalService:
+    """An in-memory AWS service behind real botocore clients. Calls are answered from before-call,
+    the way Stubber answers them, so parameter validation and extutil's call recording still run.
+    Unlike Stubber, calls can come in any order and from any thread. Each operation is a
+    _<OperationName> method returning the parsed response, or {"Error": ..., "status": ...}"""
+    service = None
+
+    def __init__(self, client=None):
+        self.requests = []
+        if client:
+            self.attach(client)
+
+    def attach(self, client):
+        """Answers client's calls too, so one fake can back every cold start of a scenario"""
+        client.meta.events.register(f"before-parameter-build.{self.service}", self._capture_params)
+        client.meta.events.register_first(f"before-call.{self.service}", self._handle)
+        return self
+
+    def _capture_params(self, params, context, **kwargs):
+        context["local_params"] = dict(params)
+
+    def _handle(self, model, context, **kwargs):
+        params = context["local_params"]
+        self.requests.append((model.name, params))
+        handler = getattr(self, f"_{model.name}", None)
+        if handler is None:
+            raise NotImplementedError(f"{type(self).__name__} does not support {model.name}")
+        result = handler(**params)
+        if "Error" in result:
+            status = result.pop("status")
+            return AWSResponse(None, status, {}, None), {**result, "ResponseMetadata": {"HTTPStatusCode": status}}
+        return AWSResponse(None, 200, {}, None), {**result, "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+def error(code, message, status=400):
+    return {"Error": {"Code": code, "Message": message}, "status": status}
+
+class LocalECR(LocalService):
+    """Repositories, their tags and lifecycle policies, images, and the registry's replication
+    configuration and pull through cache rules, for the calls the repo, image and pullthrough lambdas make"""
+    service = "ecr"
+
+    def __init__(self, client=None):
+        self.repositories = {}
+        self.tags = {}
+        self.lifecycle_policies = {}
+        self.images = {}
+        self.replication_rules = []
+        self.pull_through_rules = {}
+        super().__init__(client)
+
+    def push(self, name, tags, manifest=None):
+        """What a build's docker push does: stores the image and points tags at it"""
+        manifest = manifest or json.dumps({"schemaVersion": 2, "layers": sorted(tags)})
+        return self._put_image(name, manifest, "application/vnd.docker.distribution.manifest.v2+json", tags)
+
+    def _repository(self, repositoryName):
+        repo = self.repositories.get(repositoryName)
+        if not repo:
+            return None, error("RepositoryNotFoundException", f"The repository with name '{repositoryName}' does not exist in the registry with id '{ACCOUNT_NUMBER}'")
+        return repo, None
+
+    def _put_image(self, name, manifest, media_type, tags):
+        digest = f"sha256:{hashlib.sha256(manifest.encode()).hexdigest()}"
+        images = self.images.setdefault(name, {})
+        for image in images.values():
+            image["tags"] = [t for t in image["tags"] if t not in tags]
+        image = images.setdefault(digest, {
+            "manifest": manifest, "media_type": media_type, "tags": [],
+            "pushed_at": datetime.datetime.now(datetime.timezone.utc)
+        })
+        image["tags"] += tags
+        return digest
+
+    def _find_image(self, name, image_id):
+        for digest, image in self.images.get(name, {}).items():
+            if (image_id.get("imageDigest") == digest) or (image_id.get("imageTag") in image["tags"]):
+                return digest, image
+        return None, None
+
+    def _DescribeRepositories(self, repositoryNames=None, registryId=None, **kwargs):
+        for name in repositoryNames or []:
+            _, missing = self._repository(name)
+            if missing:
+                return missing
+        return {"repositories": [self.repositories[n] for n in (repositoryNames or self.repositories)]}
+
+    def _CreateRepository(self, repositoryName, tags=None, imageTagMutability="MUTABLE",
+            imageScanningConfiguration=None, encryptionConfiguration=None, registryId=None, **kwargs):
+        if repositoryName in self.repositories:
+            return error("RepositoryAlreadyExistsException", f"The repository with name '{repositoryName}' already exists")
+        arn = f"arn:aws:ecr:{REGION}:{ACCOUNT_NUMBER}:repository/{repositoryName}"
+        self.repositories[repositoryName] = {
+            "repositoryArn": arn,
+            "registryId": registryId or ACCOUNT_NUMBER,
+            "repositoryName": repositoryName,
+            "repositoryUri": f"{ACCOUNT_NUMBER}.dkr.ecr.{REGION}.amazonaws.com/{repositoryName}",
+            "imageTagMutability": imageTagMutability,
+            "imageScanningConfiguration": imageScanningConfiguration or {"scanOnPush": False},
+            "encryptionConfiguration": encryptionConfiguration or {"encryptionType": "AES256"}
+        }
+        self.tags[arn] = {t["Key"]: t["Value"] for t in tags or []}
+        return {"repository": self.repositories[repositoryName]}
+
+    def _DeleteRepository(self, repositoryName, registryId=None, force=False, **kwargs):
+        repo, missing = self._repository(repositoryName)
+        if missing:
+            return missing
+        del self.repositories[repositoryName]
+        self.tags.pop(repo["repositoryArn"], None)
+        self.lifecycle_policies.pop(repositoryName, None)
+        self.images.pop(repositoryName, None)
+        return {"repository": repo}
+
+    def _ListTagsForResource(self, resourceArn):
+        return {"tags": [{"Key": k, "Value": v} for k, v in self.tags[resourceArn].items()]}
+
+    def _TagResource(self, resourceArn, tags):
+        self.tags[resourceArn].update({t["Key"]: t["Value"] for t in tags})
+        return {}
+
+    def _UntagResource(self, resourceArn, tagKeys):
+        for k in tagKeys:
+            self.tags[resourceArn].pop(k, None)
+        return {}
+
+    def _PutImageScanningConfiguration(self, repositoryName, imageScanningConfiguration, registryId=None):
+        repo, missing = self._repository(repositoryName)
+        if missing:
+            return missing
+        repo["imageScanningConfiguration"] = imageScanningConfiguration
+        return {"repositoryName": repositoryName, "imageScanningConfiguration": imageScanningConfiguration}
+
+    def _PutImageTagMutability(self, repositoryName, imageTagMutability, registryId=None):
+        repo, missing = self._repository(repositoryName)
+        if missing:
+            return missing
+        repo["imageTagMutability"] = imageTagMutability
+        return {"repositoryName": repositoryName, "imageTagMutability": imageTagMutability}
+
+    def _GetLifecyclePolicy(self, repositoryName, registryId=None):
+        if repositoryName not in self.lifecycle_policies:
+            return error("LifecyclePolicyNotFoundException", "Lifecycle policy does not exist")
+        return {"repositoryName": repositoryName, "lifecyclePolicyText": self.lifecycle_policies[repositoryName]}
+
+    def _PutLifecyclePolicy(self, repositoryName, lifecyclePolicyText, registryId=None):
+        self.lifecycle_policies[repositoryName] = lifecyclePolicyText
+        return {"repositoryName": repositoryName, "registryId": ACCOUNT_NUMBER, "lifecyclePolicyText": lifecyclePolicyText}
+
+    def _DeleteLifecyclePolicy(self, repositoryName, registryId=None):
+        if repositoryName not in self.lifecycle_policies:
+            return error("LifecyclePolicyNotFoundException", "Lifecycle policy does not exist")
+        return {"repositoryName": repositoryName, "lifecyclePolicyText": self.lifecycle_policies.pop(repositoryName)}
+
+    def _DescribeRegistry(self):
+        return {"registryId": ACCOUNT_NUMBER, "replicationConfiguration": {"rules": json.loads(json.dumps(self.replication_rules))}}
+
+    def _PutReplicationConfiguration(self, replicationConfiguration):
+        self.replication_rules = json.loads(json.dumps(replicationConfiguration["rules"]))
+        return {"replicationConfiguration": replicationConfiguration}
+
+    def _DescribeImages(self, repositoryName, imageIds=None, registryId=None, **kwargs):
+        _, missing = self._repository(repositoryName)
+        if missing:
+            return missing
+        found = {}
+        for image_id in imageIds or [{"imageDigest": d} for d in self.images.get(repositoryName, {})]:
+            digest, image = self._find_image(repositoryName, image_id)
+            if not image:
+                return error("ImageNotFoundException", f"The image with imageId {image_id} does not exist within the repository with name '{repositoryName}'")
+            found[digest] = {
+                "repositoryName": repositoryName, "imageDigest": digest, "imageTags": list(image["tags"]),
+                "imageSizeInBytes": len(image["manifest"]), "imagePushedAt": image["pushed_at"]
+            }
+        return {"imageDetails": list(found.values())}
+
+    def _BatchGetImage(self, repositoryName, imageIds, acceptedMediaTypes=None, registryId=None):
+        _, missing = self._repository(repositoryName)
+        if missing:
+            return missing
+        images, failures = [], []
+        for image_id in imageIds:
+            digest, image = self._find_image(repositoryName, image_id)
+            if image:
+                images.append({
+                    "repositoryName": repositoryName, "imageId": {**image_id, "imageDigest": digest},
+                    "imageManifest": image["manifest"], "imageManifestMediaType": image["media_type"]
+                })
+            else:
+                failures.append({"imageId": image_id, "failureCode": "ImageNotFound", "failureReason": "Requested image not found"})
+        return {"images": images, "failures": failures}
+
+    def _PutImage(self, repositoryName, imageManifest, imageTag=None, imageManifestMediaType=None, registryId=None, **kwargs):
+        _, missing = self._repository(repositoryName)
+        if missing:
+            return missing
+        digest, image = self._find_image(repositoryName, {"imageTag": imageTag})
+        if image and image["manifest"] == imageManifest:
+            return error("ImageAlreadyExistsException", f"Image with digest '{digest}' and tag '{imageTag}' already exists in the repository")
+        digest = self._put_image(repositoryName, imageManifest, imageManifestMediaType, [imageTag] if imageTag else [])
+        return {"image": {"repositoryName": repositoryName, "imageId": {"imageDigest": digest, "imageTag": imageTag}}}
+
+    def _pull_through_rule(self, ecrRepositoryPrefix):
+        rule = self.pull_through_rules.get(ecrRepositoryPrefix)
+        if not rule:
+            return None, error("PullThroughCacheRuleNotFoundException", f"The pull through cache rule with prefix '{ecrRepositoryPrefix}' does not exist")
+        return rule, None
+
+    def _CreatePullThroughCacheRule(self, ecrRepositoryPrefix, upstreamRegistryUrl, registryId=None,
+            upstreamRegistry=None, credentialArn=None, **kwargs):
+        if ecrRepositoryPrefix in self.pull_through_rules:
+            return error("PullThroughCacheRuleAlreadyExistsException", f"A pull through cache rule with prefix '{ecrRepositoryPrefix}' already exists")
+        rule = {
+            "ecrRepositoryPrefix": ecrRepositoryPrefix, "upstreamRegistryUrl": upstreamRegistryUrl,
+            "registryId": registryId or ACCOUNT_NUMBER, "createdAt": datetime.datetime.now(datetime.timezone.utc)
+        }
+        if upstreamRegistry:
+            rule["upstreamRegistry"] = upstreamRegistry
+        if credentialArn:
+            rule["credentialArn"] = credentialArn
+        self.pull_through_rules[ecrRepositoryPrefix] = rule
+        return dict(rule)
+
+    def _DescribePullThroughCacheRules(self, registryId=None, ecrRepositoryPrefixes=None, **kwargs):
+        for prefix in ecrRepositoryPrefixes or []:
+            _, missing = self._pull_through_rule(prefix)
+            if missing:
+                return missing
+        return {"pullThroughCacheRules": [dict(self.pull_through_rules[p]) for p in (ecrRepositoryPrefixes or self.pull_through_rules)]}
+
+    def _UpdatePullThroughCacheRule(self, ecrRepositoryPrefix, credentialArn=None, registryId=None, **kwargs):
+        rule, missing = self._pull_through_rule(ecrRepositoryPrefix)
+        if missing:
+            return missing
+        rule["credentialArn"] = credentialArn
+        return {
+            "ecrRepositoryPrefix": ecrRepositoryPrefix, "registryId": rule["registryId"], "credentialArn": credentialArn,
+            "updatedAt": datetime.datetime.now(datetime.timezone.utc)
+        }
+
+    def _DeletePullThroughCacheRule(self, ecrRepositoryPrefix, registryId=None):
+        rule, missing = self._pull_through_rule(ecrRepositoryPrefix)
+        if missing:
+            return missing
+        return dict(self.pull_through_rules.pop(ecrRepositoryPrefix))
+
+class LocalLambda(LocalService):
+    """Answers invoke with children[FunctionName](payload), which returns the child's result"""
+    service = "lambda"
+
+    def __init__(self, children, client=None):
+        self.children = children
+        super().__init__(client)
+
+    def _Invoke(self, FunctionName, Payload, InvocationType="RequestResponse", **kwargs):
+        result = self.children[FunctionName](json.loads(Payload))
+        body = json.dumps(result).encode()
+        return {"StatusCode": 200, "Payload": StreamingBody(io.BytesIO(body), len(body))}
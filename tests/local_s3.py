@@ -0,0 +1,80 @@
+import hashlib
+import io
+
+from botocore.response import StreamingBody
+
+from local_aws import LocalService
+
+class LocalS3(LocalService):
+    """Objects, range reads and multipart uploads, for the calls the lambdas make"""
+    service = "s3"
+
+    def __init__(self, client=None):
+        self.objects = {}
+        self.uploads = {}
+        super().__init__(client)
+
+    def put(self, bucket, key, data):
+        self.objects[(bucket, key)] = {"body": bytes(data), "etag": f'"{hashlib.md5(data).hexdigest()}"'}
+        return self.objects[(bucket, key)]["etag"]
+
+    def get(self, bucket, key):
+        return self.objects[(bucket, key)]["body"]
+
+    def _find(self, Bucket, Key, IfMatch=None):
+        obj = self.objects.get((Bucket, Key))
+        if obj is None:
+            return None, {"Error": {"Code": "NoSuchKey", "Message": "The specified key does not exist."}, "status": 404}
+        if IfMatch and IfMatch != obj["etag"]:
+            return None, {"Error": {"Code": "PreconditionFailed", "Message": "At least one of the pre-conditions you specified did not hold"}, "status": 412}
+        return obj, None
+
+    def _HeadObject(self, Bucket, Key, **kwargs):
+        obj, error = self._find(Bucket, Key)
+        if error:
+            return {"Error": {"Code": "404", "Message": "Not Found"}, "status": 404}
+        return {"ETag": obj["etag"], "ContentLength": len(obj["body"])}
+
+    def _GetObject(self, Bucket, Key, IfMatch=None, Range=None, **kwargs):
+        obj, error = self._find(Bucket, Key, IfMatch)
+        if error:
+            return error
+        body = obj["body"]
+        if Range:
+            start, end = Range[len("bytes="):].split("-")
+            body = body[int(start):int(end) + 1]
+        return {"ETag": obj["etag"], "ContentLength": len(body), "Body": StreamingBody(io.BytesIO(body), len(body))}
+
+    def _PutObject(self, Bucket, Key, Body=b"", **kwargs):
+        data = Body.read() if hasattr(Body, "read") else Body
+        return {"ETag": self.put(Bucket, Key, data)}
+
+    def _DeleteObject(self, Bucket, Key, **kwargs):
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def _CreateMultipartUpload(self, Bucket, Key, **kwargs):
+        upload_id = f"upload-{len(self.uploads) + 1}"
+        self.uploads[upload_id] = {"bucket": Bucket, "key": Key, "parts": {}}
+        return {"Bucket": Bucket, "Key": Key, "UploadId": upload_id}
+
+    def _UploadPart(self, Bucket, Key, UploadId, PartNumber, Body=b"", **kwargs):
+        data = Body.read() if hasattr(Body, "read") else Body
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        self.uploads[UploadId]["parts"][PartNumber] = (data, etag)
+        return {"ETag": etag}
+
+    def _CompleteMultipartUpload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        upload = self.uploads.pop(UploadId)
+        parts = [upload["parts"][p["PartNumber"]] for p in MultipartUpload["Parts"]]
+        assert [p["ETag"] for p in MultipartUpload["Parts"]] == [etag for _, etag in parts]
+        self.objects[(Bucket, Key)] = {
+            "body": b"".join(data for data, _ in parts),
+            # S3's multipart ETag: the MD5 of the part MD5s, then the part count
+            "etag": f'"{hashlib.md5(b"".join(bytes.fromhex(etag.strip(chr(34))) for _, etag in parts)).hexdigest()}-{len(parts)}"'
+        }
+        return {"Bucket": Bucket, "Key": Key, "ETag": self.objects[(Bucket, Key)]["etag"]}
+
+    def _AbortMultipartUpload(self, Bucket, Key, UploadId, **kwargs):
+        self.uploads.pop(UploadId, None)
+        return {}
@@ -0,0 +1,110 @@
+import json
+import time
+
+import pytest
+
+CHILD_ARN = "arn:aws:lambda:us-east-1:123456789012:function:ck-child"
+
+def invoke_child(eh, **kwargs):
+    return eh.invoke_extension(
+        arn=CHILD_ARN, component_def={"name": "child"}, child_key="Child",
+        progress_start=20, progress_end=40, poll_sec=5, **kwargs
+    )
+
+def parent_event(pass_back_data=None):
+    return {"op": "upsert", "component_name": "parent", "bucket": "ck-bucket", "pass_back_data": pass_back_data}
+
+class RecordedPayload:
+    """Matches any invoke Payload and keeps it, since the result token in it is random"""
+    def __init__(self):
+        self.payloads = []
+
+    def __eq__(self, other):
+        self.payloads.append(json.loads(other))
+        return True
+
+@pytest.fixture
+def invokes(extutil, stub):
+    """invokes() queues one Event invocation of the child, invokes.payloads has what was sent"""
+    lambda_stub = stub(extutil, "lambda")
+    recorded = RecordedPayload()
+    def queue():
+        lambda_stub.add_response("invoke", {"StatusCode": 202}, {
+            "FunctionName": CHILD_ARN, "InvocationType": "Event", "LogType": "None", "Payload": recorded
+        })
+    queue.payloads = recorded.payloads
+    return queue
+
+@pytest.mark.parametrize("path", [None, "files"])
+def test_local_result_store_round_trip(extutil, tmp_path, path):
+    store = extutil.LocalResultStore(str(tmp_path) if path else None)
+    copy = extutil.result_store_from_description(json.loads(json.dumps(store.describe())))
+    assert copy.get("token") is None
+    store.put("token", {"success": True, "props": {"arn": "x"}})
+    assert copy.get("token") == {"success": True, "props": {"arn": "x"}}
+    copy.delete("token")
+    assert store.get("token") is None
+    store.delete("token")
+
+def test_async_child_result_is_collected(extutil, invokes, tmp_path):
+    store = extutil.LocalResultStore(str(tmp_path))
+    parent = extutil.ExtensionHandler(result_store=store)
+
+    invokes()
+    parent.capture_event(parent_event())
+    assert invoke_child(parent) is False
+    first = parent.finish()
+    assert first["pass_back_data"]["Child"]["async_token"]
+
+    # Still running, but acknowledged: the parent keeps waiting
+    payload = invokes.payloads[0]
+    child = extutil.ExtensionHandler()
+    child.capture_event(payload)
+    parent.capture_event(parent_event(first["pass_back_data"]))
+    assert invoke_child(parent) is False
+    second = parent.finish()
+    assert second["pass_back_data"]["Child"]["acknowledged"] is True
+
+    child.add_props({"arn": "child-arn"})
+    child.finish()
+    parent.capture_event(parent_event(second["pass_back_data"]))
+    assert invoke_child(parent) is True
+    assert parent.props["Child"] == {"arn": "child-arn"}
+    assert store.get(payload["async_result"]["token"]) is None
+
+def test_child_without_async_support_fails_fast(extutil, invokes, tmp_path):
+    parent = extutil.ExtensionHandler(result_store=extutil.LocalResultStore(str(tmp_path)))
+    invokes()
+    parent.capture_event(parent_event())
+    invoke_child(parent)
+    pass_back_data = parent.finish()["pass_back_data"]
+
+    # An old child ignores async_result and never writes anything
+    pass_back_data["Child"]["invoked_at"] = int(time.time()) - 121
+    parent.capture_event(parent_event(pass_back_data))
+    assert invoke_child(parent) is False
+    result = parent.finish()
+    assert "does not support asynchronous invocation" in result["error"]
+
+@pytest.mark.parametrize("failures,stored", [(2, True), (3, False)])
+def test_child_result_put_is_retried(extutil, tmp_path, monkeypatch, capsys, failures, stored):
+    store = extutil.LocalResultStore(str(tmp_path))
+    put = extutil.LocalResultStore.put
+    failed = []
+    def flaky_put(self, token, result):
+        if not token.endswith(extutil.ASYNC_ACK_SUFFIX) and len(failed) < failures:
+            failed.append(token)
+            raise extutil.ClientError({"Error": {"Code": "SlowDown", "Message": "Please reduce your request rate"}}, "PutObject")
+        put(self, token, result)
+    monkeypatch.setattr(extutil.LocalResultStore, "put", flaky_put)
+    sleeps = []
+    monkeypatch.setattr(extutil.time, "sleep", sleeps.append)
+
+    child = extutil.ExtensionHandler()
+    child.capture_event({"op": "upsert", "component_name": "child", "async_result": {"token": "token", "store": store.describe()}})
+    child.add_props({"arn": "child-arn"})
+    result = child.finish()
+    assert result["success"] and result["props"] == {"arn": "child-arn"}
+    assert (store.get("token") == result) == stored
+    assert sleeps == [0.5, 1.0]
+    assert ("Async Result Not Stored" in capsys.readouterr().out) != stored
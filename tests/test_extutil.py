@@ -0,0 +1,361 @@
+import datetime
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import pytest
+
+from conftest import load_extutil
+
+def write_tree(path, files):
+    for name, data in files.items():
+        full_path = os.path.join(path, name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as f:
+            f.write(data)
+
+TREE = {
+    "Dockerfile": b"FROM python:3.12\nCOPY . /app\n",
+    "app/main.py": b"print('hello')\n" * 500,
+    "app/static/logo.png": os.urandom(4096),
+    "app/static/empty.txt": b"",
+    "requirements.txt": b"boto3\n"
+}
+
+def test_jsonable_matches_round_trip(extutil):
+    payload = {
+        "createdAt": datetime.datetime(2026, 1, 1, 12, 30, tzinfo=datetime.timezone.utc),
+        "tuple": (1, 2.5, "three"),
+        1: "int key",
+        None: "none key",
+        2.5: "float key",
+        "nested": [{"at": datetime.datetime(2026, 1, 2)}, None, False]
+    }
+    assert extutil.jsonable(payload) == json.loads(json.dumps(payload, default=extutil.defaultconverter))
+
+def test_creturn_output_is_json_safe(extutil):
+    response = extutil.creturn(200, 100, success=True, props={"pushed_at": datetime.datetime(2026, 1, 1)})
+    assert json.loads(json.dumps(response)) == response
+
+def test_reproducible_zip_is_byte_identical(extutil, tmp_path):
+    first, second = tmp_path / "first", tmp_path / "second"
+    write_tree(first, TREE)
+    # Same content, created in a different order with different mtimes
+    write_tree(second, dict(reversed(list(TREE.items()))))
+    for name in TREE:
+        os.utime(second / name, (time.time() - 86400, time.time() - 86400))
+
+    digests = []
+    for tree, workers in [(first, 1), (first, 4), (second, 2)]:
+        out = tmp_path / f"{tree.name}-{workers}.zip"
+        extutil.create_zip(str(out), str(tree), reproducible=True, max_workers=workers)
+        digests.append(hashlib.sha256(out.read_bytes()).hexdigest())
+    assert len(set(digests)) == 1
+
+def read_zip(path):
+    import zipfile
+    with zipfile.ZipFile(path) as z:
+        assert z.testzip() is None
+        return {i.filename: (i.compress_type, z.read(i)) for i in z.infolist()}
+
+@pytest.mark.parametrize("internals", [True, False])
+def test_zip_members_pass_testzip(extutil, tmp_path, monkeypatch, internals):
+    import zipfile
+    write_tree(tmp_path / "tree", TREE)
+    # Larger than the parallel limit, so it is streamed through zipfile either way
+    monkeypatch.setattr(extutil, "ZIP_MAX_PARALLEL_MEMBER_BYTES", 1024)
+    if not internals:
+        monkeypatch.setattr(extutil, "zip_internals_available", lambda ziph: False)
+
+    extutil.create_zip(str(tmp_path / "out.zip"), str(tmp_path / "tree"), reproducible=True, max_workers=2)
+    members = read_zip(tmp_path / "out.zip")
+    assert {name: data for name, (_, data) in members.items()} == TREE
+    assert all(compress_type == zipfile.ZIP_DEFLATED for compress_type, _ in members.values())
+
+def test_zip_window_bounded_by_bytes(extutil, tmp_path, monkeypatch):
+    files = {f"member-{n}.bin": os.urandom(1000) for n in range(10)}
+    write_tree(tmp_path / "tree", files)
+    monkeypatch.setattr(extutil, "ZIP_MAX_WINDOW_BYTES", 2500)
+    window = {"bytes": 0, "max": 0}
+    write_zip_member = extutil.write_zip_member
+    def written(ziph, zinfo, future, full_path):
+        write_zip_member(ziph, zinfo, future, full_path)
+        window["bytes"] -= zinfo.file_size
+
+    class RecordingExecutor(extutil.ThreadPoolExecutor):
+        def submit(self, fn, full_path, *args):
+            window["bytes"] += os.path.getsize(full_path)
+            window["max"] = max(window["max"], window["bytes"])
+            return super().submit(fn, full_path, *args)
+    monkeypatch.setattr(extutil, "write_zip_member", written)
+    monkeypatch.setattr(extutil, "ThreadPoolExecutor", RecordingExecutor)
+
+    # The count alone would allow all 10 members
+    extutil.create_zip(str(tmp_path / "out.zip"), str(tmp_path / "tree"), max_workers=8)
+    assert window["max"] == 2000
+    assert {name: data for name, (_, data) in read_zip(tmp_path / "out.zip").items()} == files
+
+def test_stored_extensions_are_opt_in(extutil, tmp_path):
+    import zipfile
+    write_tree(tmp_path / "tree", TREE)
+    extutil.create_zip(str(tmp_path / "out.zip"), str(tmp_path / "tree"), store_extensions=extutil.ZIP_STORED_EXTENSIONS)
+    members = read_zip(tmp_path / "out.zip")
+    assert members["app/static/logo.png"][0] == zipfile.ZIP_STORED
+    assert members["app/main.py"][0] == zipfile.ZIP_DEFLATED
+
+def test_emf_lines_per_service(extutil, stub, monkeypatch, capsys):
+    monkeypatch.setattr(extutil, "EMF_METRICS", True)
+    monkeypatch.setattr(extutil, "EMF_MAX_VALUES", 2)
+    ecr = stub(extutil, "ecr")
+    ecr.add_response("describe_repositories", {"repositories": []})
+    ecr.add_client_error("describe_repositories", "RepositoryNotFoundException")
+    ecr.add_client_error("delete_repository", "ThrottlingException")
+    s3 = stub(extutil, "s3")
+    s3.add_response("head_object", {"ETag": '"abc"'})
+
+    eh = extutil.ExtensionHandler()
+    eh.capture_event({"op": "upsert", "component_name": "app", "project_code": "ck", "repo_id": "repo"})
+    client = extutil.get_client("ecr")
+    client.describe_repositories()
+    for call in [lambda: client.describe_repositories(repositoryNames=["app-repo"]), lambda: client.delete_repository(repositoryName="app-repo")]:
+        with pytest.raises(extutil.ClientError):
+            call()
+    extutil.get_client("s3").head_object(Bucket="b", Key="k")
+    eh.add_props({"name": "app-repo"})
+    eh.finish()
+
+    lines = [json.loads(l) for l in capsys.readouterr().out.splitlines() if l.startswith('{"_aws"')]
+    # ecr's third latency goes in a second line
+    assert [(l["Service"], len(l["ApiLatency"])) for l in lines] == [("ecr", 2), ("ecr", 1), ("s3", 1)]
+    for line in lines:
+        directive = line["_aws"]["CloudWatchMetrics"]
+        assert len(directive) == 1 and directive[0]["Dimensions"] == [["Op", "Service"]]
+        assert (line["Op"], line["component_name"]) == ("upsert", "app")
+    ecr_line, ecr_more, s3_line = lines
+    assert [m["Name"] for m in ecr_line["_aws"]["CloudWatchMetrics"][0]["Metrics"]] == [name for name, _, _ in extutil.EMF_TOTALS] + ["ApiLatency"]
+    assert (ecr_line["ApiCalls"], ecr_line["ApiErrors"], ecr_line["ApiThrottles"]) == (3, 2, 1)
+    assert ecr_line["api_operations"]["ecr.DescribeRepositories"]["calls"] == 2
+    assert ecr_line["api_operations"]["ecr.DeleteRepository"]["throttles"] == 1
+    assert [m["Name"] for m in ecr_more["_aws"]["CloudWatchMetrics"][0]["Metrics"]] == ["ApiLatency"]
+    assert "ApiCalls" not in ecr_more and "api_operations" not in ecr_more
+    assert (s3_line["ApiCalls"], s3_line["ApiErrors"]) == (1, 0)
+    assert list(s3_line["api_operations"]) == ["s3.HeadObject"]
+
+@pytest.fixture
+def eh(extutil):
+    handler = extutil.ExtensionHandler()
+    handler.capture_event({"op": "upsert", "component_name": "app"})
+    return handler
+
+def test_run_ops_waves(extutil, eh):
+    ran = []
+    # a and b only finish if they run at the same time
+    both_running = threading.Barrier(2, timeout=5)
+
+    @extutil.ext(handler=eh, op="a", depends_on=[])
+    def a():
+        both_running.wait()
+        ran.append("a")
+
+    @extutil.ext(handler=eh, op="b", depends_on=[])
+    def b():
+        both_running.wait()
+        ran.append("b")
+
+    @extutil.ext(handler=eh, op="c", depends_on=["a"])
+    def c():
+        ran.append("c")
+
+    @extutil.ext(handler=eh, op="d")
+    def d():
+        ran.append("d")
+
+    for op in ["a", "b", "c", "d"]:
+        eh.add_op(op)
+    eh.run_ops([(a,), (b,), (c,), (d,)])
+    assert sorted(ran[:2]) == ["a", "b"] and ran[2:] == ["c", "d"]
+    assert not eh.ops
+
+def test_run_ops_runs_ops_added_mid_run(extutil, eh):
+    ran = []
+
+    @extutil.ext(handler=eh, op="create", depends_on=["get"])
+    def create():
+        ran.append("create")
+
+    @extutil.ext(handler=eh, op="get", depends_on=[])
+    def get():
+        ran.append("get")
+        eh.add_op("create")
+        eh.add_op("tag")
+
+    @extutil.ext(handler=eh, op="tag", depends_on=["get"])
+    def tag():
+        ran.append("tag")
+
+    eh.add_op("get")
+    # create is listed first but only added by get, after its first wave was picked
+    eh.run_ops([(create,), (get,), (tag,)])
+    assert ran[0] == "get" and sorted(ran[1:]) == ["create", "tag"]
+    assert not eh.ops
+
+def test_run_ops_first_declared_return_wins(extutil, eh):
+    first_declared = threading.Event()
+    ran = []
+
+    @extutil.ext(handler=eh, op="a", depends_on=[])
+    def a():
+        eh.retry_error("a failed", 10)
+        first_declared.set()
+
+    @extutil.ext(handler=eh, op="b", depends_on=[])
+    def b():
+        first_declared.wait(5)
+        eh.perm_error("b failed", 20)
+
+    @extutil.ext(handler=eh, op="c", depends_on=["a", "b"])
+    def c():
+        ran.append("c")
+
+    for op in ["a", "b", "c"]:
+        eh.add_op(op)
+    eh.run_ops([(a,), (b,), (c,)])
+    assert (eh.error, eh.progress) == ("a failed", 10)
+    assert eh.callback
+    # Neither op completed, so both run again on the retry, and c never ran
+    assert set(eh.ops) == {"a", "b", "c"}
+    assert not ran
+
+def test_failure_in_parallel_branch_fails_the_op(extutil, eh):
+    def part(fail):
+        if fail:
+            eh.retry_error("part failed", 30)
+        return not fail
+
+    @extutil.ext(handler=eh, op="fan_out", depends_on=[])
+    def fan_out():
+        return eh.run_parallel([(part, False), (part, True), (part, False)])
+
+    eh.add_op("fan_out")
+    assert fan_out() == [True, False, True]
+    assert eh.error == "part failed"
+    assert "fan_out" in eh.ops
+
+def test_exception_in_parallel_branch_is_raised(extutil, eh):
+    def part(fail):
+        if fail:
+            raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        eh.run_parallel([(part, False), (part, True)])
+    assert not eh._parallel
+
+@pytest.mark.parametrize("code", ["default", "ThrottlingException", "ServerException"])
+def test_retry_delay_full_jitter_bounds(extutil, code):
+    policy = extutil.RETRY_POLICIES[code]
+    random.seed(1234)
+    for retries in range(12):
+        ceiling = min(policy["cap"], policy["base"] * 2**retries)
+        delays = [extutil.retry_delay(policy, retries) for _ in range(200)]
+        assert 1 <= min(delays) and max(delays) <= max(1, ceiling)
+        if ceiling >= 8:
+            # Spread across the range rather than bunched at the ceiling
+            assert min(delays) <= ceiling / 4 and max(delays) >= ceiling * 3 / 4
+
+def test_retry_delay_without_jitter(extutil):
+    policy = {"base": 1, "cap": 60, "jitter": False}
+    assert [extutil.retry_delay(policy, r) for r in [0, 3, 5, 6, 20]] == [1, 8, 32, 60, 60]
+
+def test_retry_policy_per_code(extutil):
+    eh = extutil.ExtensionHandler(max_retries_per_error_code=3)
+    assert eh.retry_policy("ThrottlingException")["max_attempts"] == 10
+    assert eh.retry_policy("SomethingElse") == {**extutil.RETRY_POLICIES["default"], "max_attempts": 3}
+
+@pytest.mark.parametrize("retries,calls_back", [(8, True), (9, False)])
+def test_throttle_retries_use_their_own_max_attempts(extutil, retries, calls_back):
+    eh = extutil.ExtensionHandler(max_retries_per_error_code=2)
+    eh.capture_event({"op": "upsert", "component_name": "app", "pass_back_data": {"retries": {"Get Failed": retries}}})
+    eh.retry_error("Get Failed", 10, retry_code="ThrottlingException")
+    result = eh.finish()
+    assert (result.get("error") is None) == calls_back
+    assert result["pass_back_data"]["retries"]["Get Failed"] == retries + 1
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(extutil, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(extutil.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(extutil.time, "sleep", clock.sleep)
+    return clock
+
+def test_token_bucket_allows_burst_then_paces(extutil, clock):
+    bucket = extutil.TokenBucket(rate=2, burst=3)
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == []
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == [0.5, 0.5]
+
+def test_token_bucket_refill_is_capped_at_burst(extutil, clock):
+    bucket = extutil.TokenBucket(rate=2, burst=3)
+    bucket.acquire()
+    clock.now += 60
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == []
+    bucket.acquire()
+    assert clock.sleeps == [0.5]
+
+def test_oversized_log_details_are_truncated(extutil, eh, capsys, monkeypatch):
+    small = {"name": "app-repo"}
+    large = {"images": ["sha256:" + "a" * 64] * 100}
+    assert extutil.truncate_details(small) == small
+    truncated = extutil.truncate_details(large)
+    assert truncated["truncated"] is True
+    assert truncated["size"] == len(json.dumps(large))
+    assert len(truncated["preview"]) == extutil.LOG_DETAIL_MAX_CHARS
+
+    eh.add_log("Found Images", large)
+    assert eh.logs[-1]["details"] == truncated
+    assert len(capsys.readouterr().out) < extutil.LOG_DETAIL_MAX_CHARS + 200
+
+    monkeypatch.setattr(extutil, "DEBUG_LOGS", True)
+    assert extutil.truncate_details(large) == large
+
+class Rendered:
+    """Counts how often log details were rendered"""
+    count = 0
+
+    def __repr__(self):
+        Rendered.count += 1
+        return "rendered"
+
+def test_debug_logs_suppressed_at_default_level(extutil, capsys, monkeypatch):
+    assert extutil.LOG_LEVEL == extutil.LOG_LEVELS["INFO"]
+    Rendered.count = 0
+    extutil.log("Debug Details", {"value": Rendered()}, level="DEBUG")
+    assert capsys.readouterr().out == ""
+    assert Rendered.count == 0
+
+    extutil.log("Info Details", {"value": "x"})
+    assert capsys.readouterr().out == "Info Details: {'value': 'x'}\n"
+
+    monkeypatch.setenv("log_level", "debug")
+    debug_extutil = load_extutil()
+    debug_extutil.log("Debug Details", {"value": Rendered()}, level="DEBUG")
+    assert capsys.readouterr().out == "Debug Details: {'value': rendered}\n"
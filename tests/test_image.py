@@ -0,0 +1,150 @@
+import subprocess
+import sys
+
+import pytest
+
+@pytest.fixture
+def handler(image):
+    lambda_function, _ = image
+    lambda_function.eh.capture_event({"op": "upsert", "component_name": "image"})
+    return lambda_function.eh
+
+def test_build_cache_treats_missing_repository_as_miss(image, handler, stub):
+    lambda_function, extutil = image
+    ecr = stub(extutil, "ecr")
+    ecr.add_client_error("batch_get_image", "RepositoryNotFoundException")
+    handler.add_op("check_build_cache")
+
+    lambda_function.check_build_cache("new-repo", ["latest"], "build-hash")
+    assert handler.error is None
+    assert "retag_image" not in handler.ops
+    assert handler.state["build_cache_tag"].startswith(lambda_function.BUILD_CACHE_TAG_PREFIX)
+
+def build_command(lambda_function, cdef):
+    project_def = lambda_function.gen_codebuild_project_def(
+        "ck-bucket", "source.zip", {}, "us-east-1", "123456789012", "app", ["latest"], "upsert", False, cdef
+    )
+    return project_def["pre_build_commands"], project_def["build_commands"][2]
+
+@pytest.mark.parametrize("mutability", ["MUTABLE", "IMMUTABLE"])
+def test_registry_layer_cache_export_skipped_for_immutable_repos(image, handler, stub, mutability):
+    lambda_function, extutil = image
+    ecr = stub(extutil, "ecr")
+    ecr.add_response("describe_repositories", {"repositories": [{"repositoryName": "app", "imageTagMutability": mutability}]})
+    ecr.add_client_error("describe_images", "ImageNotFoundException")
+
+    pre_build, build = build_command(lambda_function, {"layer_cache": "registry"})
+    assert "--cache-from type=registry" in build
+    assert ("--cache-to" in build) == (mutability == "MUTABLE")
+    assert f"--driver-opt image={lambda_function.BUILDKIT_IMAGE}" in pre_build[-1]
+
+def test_buildkit_image_pulled_through_base_image_cache(image, handler, stub):
+    lambda_function, extutil = image
+    handler.add_state({"repo_tag_mutability": "MUTABLE", f"layer_cache_checked_{lambda_function.LAYER_CACHE_TAG}": True})
+
+    pre_build, _ = build_command(lambda_function, {"layer_cache": "registry", "base_image_cache_prefix": "docker-hub"})
+    assert f"--driver-opt image=123456789012.dkr.ecr.us-east-1.amazonaws.com/docker-hub/{lambda_function.BUILDKIT_IMAGE}" in " ".join(pre_build)
+
+CACHE = "123456789012.dkr.ecr.us-east-1.amazonaws.com/docker-hub"
+DOCKERFILE = """ARG BASE=python:3.12
+FROM --platform=$BUILDPLATFORM golang:1.22 AS Build
+FROM ${BASE} AS runtime-base
+from docker.io/bitnami/redis:7
+FROM gcr.io/distroless/base
+FROM localhost:5000/tools
+FROM build AS test
+FROM runtime-base
+FROM scratch
+COPY --from=build /out /app
+"""
+REWRITTEN = {
+    "golang:1.22": f"{CACHE}/library/golang:1.22",
+    "docker.io/bitnami/redis:7": f"{CACHE}/bitnami/redis:7"
+}
+
+def test_from_lines_rewritten_to_base_image_cache(image):
+    lambda_function, _ = image
+    lines, rewritten = lambda_function.rewrite_from_lines(DOCKERFILE.splitlines(keepends=True), CACHE)
+    assert dict(rewritten) == REWRITTEN
+    # Stage aliases, ARG references, other registries and scratch are left as they were
+    assert lines[1] == f"FROM --platform=$BUILDPLATFORM {CACHE}/library/golang:1.22 AS Build\n"
+    assert lines[3] == f"from {CACHE}/bitnami/redis:7\n"
+    assert [l for i, l in enumerate(lines) if i not in (1, 3)] == [l for i, l in enumerate(DOCKERFILE.splitlines(keepends=True)) if i not in (1, 3)]
+
+def test_from_rewrite_script_runs_on_its_own(image, tmp_path):
+    lambda_function, _ = image
+    (tmp_path / "Dockerfile").write_text(DOCKERFILE)
+    result = subprocess.run(
+        [sys.executable, "-", str(tmp_path / "Dockerfile")], input=lambda_function.from_rewrite_script(),
+        env={"BASE_IMAGE_CACHE": CACHE}, capture_output=True, text=True, check=True
+    )
+    assert result.stdout.splitlines() == [f"Base image {old} -> {new}" for old, new in REWRITTEN.items()]
+    assert (tmp_path / "Dockerfile").read_text() == "".join(lambda_function.rewrite_from_lines(DOCKERFILE.splitlines(keepends=True), CACHE)[0])
+
+PLATFORM_IMAGES = {
+    "linux/amd64": {"manifest": '{"schemaVersion": 2, "arch": "amd64"}', "media_type": "application/vnd.oci.image.manifest.v1+json"},
+    "linux/arm64": {"manifest": '{"schemaVersion": 2, "arch": "arm64"}', "media_type": "application/vnd.oci.image.manifest.v1+json"}
+}
+
+def expect_put_image(ecr, platform, tag, error=None):
+    params = {
+        "repositoryName": "app", "imageTag": tag,
+        "imageManifest": PLATFORM_IMAGES[platform]["manifest"], 
+        "imageManifestMediaType": PLATFORM_IMAGES[platform]["media_type"]
+    }
+    if error:
+        ecr.add_client_error("put_image", error, expected_params=params)
+    else:
+        ecr.add_response("put_image", {"image": {"repositoryName": "app", "imageId": {"imageTag": tag}}}, params)
+
+def test_per_build_platform_tags_are_removed(image, handler, stub):
+    lambda_function, extutil = image
+    ecr = stub(extutil, "ecr")
+    handler.add_state({"platform_build_id": "b1"})
+    handler.add_op("untag_platform_images", dict(PLATFORM_IMAGES))
+    expect_put_image(ecr, "linux/amd64", "ck-amd64")
+    expect_put_image(ecr, "linux/arm64", "ck-arm64", "ImageAlreadyExistsException")
+    ecr.add_response("batch_delete_image", {"imageIds": [{"imageTag": "ck-amd64-b1"}, {"imageTag": "ck-arm64-b1"}]}, {
+        "repositoryName": "app", "imageIds": [{"imageTag": "ck-amd64-b1"}, {"imageTag": "ck-arm64-b1"}]
+    })
+
+    lambda_function.untag_platform_images("app")
+    assert handler.error is None
+    assert "untag_platform_images" not in handler.ops
+
+def test_per_build_platform_tags_kept_when_stable_tag_is_immutable(image, handler, stub):
+    lambda_function, extutil = image
+    ecr = stub(extutil, "ecr")
+    handler.add_state({"platform_build_id": "b1"})
+    handler.add_op("untag_platform_images", dict(PLATFORM_IMAGES))
+    expect_put_image(ecr, "linux/amd64", "ck-amd64", "ImageTagAlreadyExistsException")
+    expect_put_image(ecr, "linux/arm64", "ck-arm64", "ImageTagAlreadyExistsException")
+
+    lambda_function.untag_platform_images("app")
+    assert handler.error is None
+
+def zip_bytes(files):
+    import io
+    import zipfile
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, data in files.items():
+            z.writestr(name, data)
+    return buffer.getvalue()
+
+def fingerprint(lambda_function, s3, files, docker_build_options):
+    lambda_function._source_memo.clear()
+    s3.put("ck-bucket", "source.zip", zip_bytes(files))
+    dockerfile = lambda_function.posixpath.normpath(lambda_function.dockerfile_path(docker_build_options))
+    return lambda_function.get_source_fingerprint("ck-bucket", "source.zip", True, dockerfile)
+
+def test_dockerignored_custom_dockerfile_stays_in_fingerprint(image, handler, local_s3):
+    lambda_function, extutil = image
+    s3 = local_s3(extutil)
+    files = {".dockerignore": b"docker/\n*.md\n", "docker/Dockerfile.prod": b"FROM python:3.12\n", "app.py": b"print(1)\n", "README.md": b"docs"}
+    options = "-f ./docker/Dockerfile.prod --pull"
+
+    before = fingerprint(lambda_function, s3, files, options)
+    assert before.startswith(lambda_function.SOURCE_FINGERPRINT_PREFIX)
+    assert fingerprint(lambda_function, s3, {**files, "README.md": b"new docs"}, options) == before
+    assert fingerprint(lambda_function, s3, {**files, "docker/Dockerfile.prod": b"FROM python:3.13\n"}, options) != before
@@ -0,0 +1,21 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+# Imported on first use, so cold starts that don't need them don't pay for them
+DEFERRED_MODULES = ["boto3", "fastjsonschema", "zipfile"]
+
+@pytest.mark.parametrize("folder", ["repo", "image", "pullthrough"])
+def test_heavy_modules_not_imported_at_load(folder):
+    # A fresh interpreter, since this one already has them from other tests
+    result = subprocess.run(
+        [sys.executable, "-c", f"import sys, json, lambda_function; print(json.dumps([m for m in {DEFERRED_MODULES!r} if m in sys.modules]))"],
+        cwd=os.path.join(ROOT, folder), capture_output=True, text=True, check=True,
+        env={**os.environ, "PYTHONPATH": ""}
+    )
+    assert json.loads(result.stdout.splitlines()[-1]) == []
@@ -0,0 +1,62 @@
+import datetime
+
+import pytest
+
+NOW = datetime.datetime(2026, 6, 1, tzinfo=datetime.timezone.utc)
+
+def image(digest, tags=None, days_old=0):
+    return {"imageDigest": digest, "imageTags": tags or [], "imagePushedAt": NOW - datetime.timedelta(days=days_old)}
+
+def rule(priority, count_type, count_number, tag_status="any", **selection):
+    return {
+        "rulePriority": priority,
+        "selection": {"tagStatus": tag_status, "countType": count_type, "countNumber": count_number, **selection},
+        "action": {"type": "expire"}
+    }
+
+def expiring(lambda_function, rules, images):
+    return {i["imageDigest"]: i["rulePriority"] for i in lambda_function.evaluate_lifecycle_policy({"rules": rules}, images, now=NOW)}
+
+def test_images_claimed_by_earlier_priority(repo):
+    lambda_function, _ = repo
+    images = [image("v1", ["v1"], 4), image("v2", ["v2"], 3), image("u1", days_old=2), image("u2", days_old=1)]
+    # Listed out of order, rule 1 still runs first
+    rules = [rule(2, "imageCountMoreThan", 1), rule(1, "imageCountMoreThan", 1, "tagged", tagPrefixList=["v"])]
+    # v2 is kept by rule 1, so rule 2 only counts the untagged images
+    assert expiring(lambda_function, rules, images) == {"v1": 1, "u1": 2}
+
+def test_image_count_keeps_newest(repo):
+    lambda_function, _ = repo
+    images = [image(f"d{n}", [f"t{n}"], days_old=n) for n in range(5)]
+    assert expiring(lambda_function, [rule(1, "imageCountMoreThan", 2)], images) == {"d2": 1, "d3": 1, "d4": 1}
+
+def test_since_image_pushed(repo):
+    lambda_function, _ = repo
+    old = NOW - datetime.timedelta(days=10)
+    images = [
+        image("fresh", days_old=3),
+        {"imageDigest": "datetime", "imagePushedAt": old},
+        {"imageDigest": "epoch", "imagePushedAt": old.timestamp()},
+        {"imageDigest": "iso", "imagePushedAt": old.isoformat()}
+    ]
+    rules = [rule(1, "sinceImagePushed", 7, countUnit="days")]
+    assert expiring(lambda_function, rules, images) == {"datetime": 1, "epoch": 1, "iso": 1}
+
+@pytest.mark.parametrize("selection,tags,selected", [
+    ({"tagStatus": "untagged"}, [], True),
+    ({"tagStatus": "untagged"}, ["v1"], False),
+    ({"tagStatus": "tagged", "tagPrefixList": ["prod"]}, [], False),
+    # Every prefix has to match one of the tags
+    ({"tagStatus": "tagged", "tagPrefixList": ["prod", "v"]}, ["prod-1", "v1"], True),
+    ({"tagStatus": "tagged", "tagPrefixList": ["prod", "v"]}, ["prod-1"], False),
+    ({"tagStatus": "tagged", "tagPatternList": ["prod*"]}, ["prod-1"], True),
+    ({"tagStatus": "tagged", "tagPatternList": ["*-rc*"]}, ["v1-rc2"], True),
+    ({"tagStatus": "tagged", "tagPatternList": ["*-rc"]}, ["v1-rc2"], False),
+    # * is the only wildcard, everything else is matched as written
+    ({"tagStatus": "tagged", "tagPatternList": ["v1.*"]}, ["v1x2"], False),
+    ({"tagStatus": "tagged", "tagPatternList": ["prod*", "*-rc"]}, ["prod-1", "v1-rc"], True),
+    ({"tagStatus": "tagged", "tagPatternList": ["prod*", "*-rc"]}, ["prod-1"], False)
+])
+def test_tag_selection(repo, selection, tags, selected):
+    lambda_function, _ = repo
+    assert lambda_function.lifecycle_rule_selects(selection, {"imageTags": tags}) == selected
@@ -0,0 +1,453 @@
+"""End to end deploys against in-memory ECR, S3 and child lambdas. Each scenario checks the
+exact API calls a deploy makes, so a change that adds calls to a common path shows up here,
+and that the deploy stays within WALL_MS of wall time"""
+import json
+
+import pytest
+
+from conftest import load_lambda, LambdaContext
+from local_aws import LocalECR, LocalLambda, error
+from local_s3 import LocalS3
+
+# Every call is answered in memory, so this only catches work that doesn't belong in a deploy
+WALL_MS = 2000
+MAX_CALLBACKS = 10
+BUCKET = "ck-bucket"
+SOURCE_KEY = "app/source.zip"
+PROJECT_LAMBDA = "ck-codebuild-project"
+BUILD_LAMBDA = "ck-codebuild-build"
+
+class Deployer:
+    """Deploys one component again and again, against fakes that keep their state between deploys.
+    Each deploy runs on a cold container unless warm is set. A deploy follows its callbacks 
+    until it finishes, and the calls of all of them are recorded together"""
+    def __init__(self, folder, fakes, **event):
+        self.folder = folder
+        self.fakes = fakes
+        self.event = event
+        self.prev_state = {}
+        self.container = None
+
+    def deploy(self, cdef, op="upsert", warm=False, **event):
+        if not (warm and self.container):
+            self.container = load_lambda(self.folder)
+            for fake in self.fakes:
+                fake.attach(self.container[1].get_client(fake.service))
+        lambda_function, extutil = self.container
+
+        event = {
+            "op": op, "component_name": "app", "project_code": "ck", "repo_id": "github.com/o/r",
+            "bucket": BUCKET, "prev_state": self.prev_state, **self.event, **event
+        }
+        with extutil.ApiCallRecorder() as calls:
+            for _ in range(MAX_CALLBACKS):
+                result = lambda_function.lambda_handler({**event, "component_def": json.loads(json.dumps(cdef))}, LambdaContext())
+                if result.get("error") or not result.get("pass_back_data"):
+                    break
+                event["pass_back_data"] = result["pass_back_data"]
+
+        assert result.get("error") is None, result
+        assert result["success"]
+        assert calls.wall_ms < WALL_MS, calls.summary()
+        self.prev_state = {"props": result["props"], "links": result["links"], "state": result.get("state") or {}}
+        return result, calls
+
+@pytest.fixture
+def ecr():
+    return LocalECR()
+
+@pytest.fixture
+def repo_deploy(ecr):
+    return Deployer("repo", [ecr])
+
+REPO = {"name": "app-repo", "tags": {"team": "a", "old": "x"}}
+
+def test_create(repo_deploy, ecr):
+    _, calls = repo_deploy.deploy(REPO)
+    assert calls.counts() == {"ecr.DescribeRepositories": 1, "ecr.CreateRepository": 1}
+    assert ecr.tags[ecr.repositories["app-repo"]["repositoryArn"]] == REPO["tags"]
+
+def test_no_change_with_full_trust(repo_deploy):
+    repo_deploy.deploy({**REPO, "trust_level": "full"})
+    result, calls = repo_deploy.deploy({**REPO, "trust_level": "full"})
+    assert calls.counts() == {}
+    assert result["props"]["name"] == "app-repo"
+
+def test_tag_change(repo_deploy, ecr):
+    repo_deploy.deploy(REPO)
+    _, calls = repo_deploy.deploy({**REPO, "tags": {"team": "b"}})
+    assert calls.counts() == {
+        "ecr.DescribeRepositories": 1, "ecr.ListTagsForResource": 1,
+        "ecr.TagResource": 1, "ecr.UntagResource": 1
+    }
+    assert ecr.tags[ecr.repositories["app-repo"]["repositoryArn"]] == {"team": "b"}
+
+def test_config_change(repo_deploy, ecr):
+    repo_deploy.deploy(REPO)
+    _, calls = repo_deploy.deploy({**REPO, "scan_on_push": True, "changeable_tags": "IMMUTABLE"})
+    assert calls.counts() == {
+        "ecr.DescribeRepositories": 1, "ecr.ListTagsForResource": 1,
+        "ecr.PutImageScanningConfiguration": 1, "ecr.PutImageTagMutability": 1
+    }
+    assert ecr.repositories["app-repo"]["imageTagMutability"] == "IMMUTABLE"
+
+def test_no_change_reads_by_default(repo_deploy):
+    repo_deploy.deploy(REPO)
+    _, calls = repo_deploy.deploy(REPO)
+    assert calls.counts() == {"ecr.DescribeRepositories": 1, "ecr.ListTagsForResource": 1}
+
+def test_drift_check_reads_past_warm_cache(repo_deploy, ecr):
+    cdef = {**REPO, "trust_level": "full", "drift_check_deploys": 1}
+    repo_deploy.deploy(cdef)
+    ecr.repositories["app-repo"]["imageTagMutability"] = "IMMUTABLE"
+    _, calls = repo_deploy.deploy(cdef, warm=True)
+    assert calls.counts() == {"ecr.DescribeRepositories": 1, "ecr.ListTagsForResource": 1, "ecr.PutImageTagMutability": 1}
+    assert ecr.repositories["app-repo"]["imageTagMutability"] == "MUTABLE"
+
+LIFECYCLE_POLICY = {"rules": [{
+    "rulePriority": 1, "selection": {"tagStatus": "untagged", "countType": "imageCountMoreThan", "countNumber": 10},
+    "action": {"type": "expire"}
+}]}
+
+def test_previewed_policy_leaves_outside_policy_alone(repo_deploy, ecr):
+    ecr._CreateRepository(repositoryName="app-repo", tags=[{"Key": k, "Value": v} for k, v in REPO["tags"].items()])
+    outside_policy = json.dumps({"rules": [{**LIFECYCLE_POLICY["rules"][0], "description": "set by hand"}]})
+    ecr.lifecycle_policies["app-repo"] = outside_policy
+
+    result, _ = repo_deploy.deploy({**REPO, "lifecycle_policy": LIFECYCLE_POLICY, "lifecycle_policy_preview": True})
+    assert "lifecycle_policy_managed" not in result["props"]
+    _, calls = repo_deploy.deploy(REPO)
+    assert "ecr.DeleteLifecyclePolicy" not in calls.counts()
+    assert ecr.lifecycle_policies["app-repo"] == outside_policy
+
+def replication_rule(*regions, filters=("app-repo",)):
+    return {
+        "destinations": [{"region": r, "registryId": "123456789012"} for r in regions],
+        "repositoryFilters": [{"filter": f, "filterType": "PREFIX_MATCH"} for f in filters]
+    }
+
+OTHER_RULES = [replication_rule("ap-south-1", filters=["other"]), replication_rule("sa-east-1", filters=["another"])]
+
+def test_replication_rule_replaced_in_place(repo_deploy, ecr):
+    ecr.replication_rules = OTHER_RULES[:1]
+    repo_deploy.deploy({**REPO, "replication": {"destinations": [{"region": "us-west-2"}]}})
+    ecr.replication_rules.append(OTHER_RULES[1])
+
+    _, calls = repo_deploy.deploy({**REPO, "replication": {"destinations": [{"region": "eu-west-1"}, {"region": "us-west-2"}]}})
+    assert calls.counts()["ecr.PutReplicationConfiguration"] == 1
+    assert ecr.replication_rules == [OTHER_RULES[0], replication_rule("eu-west-1", "us-west-2"), OTHER_RULES[1]]
+
+    # Same rules in another order, with the destinations reordered too
+    ecr.replication_rules = [replication_rule("us-west-2", "eu-west-1")] + list(reversed(OTHER_RULES))
+    _, calls = repo_deploy.deploy({**REPO, "replication": {"destinations": [{"region": "eu-west-1"}, {"region": "us-west-2"}]}, "tags": {}})
+    assert "ecr.PutReplicationConfiguration" not in calls.counts()
+
+def test_replication_rule_put_again_when_another_writer_drops_it(repo_deploy, ecr, monkeypatch):
+    ecr.replication_rules = OTHER_RULES[:1]
+    put = ecr._PutReplicationConfiguration
+    puts = []
+    def put_then_overwritten(replicationConfiguration):
+        puts.append(replicationConfiguration)
+        result = put(replicationConfiguration)
+        if len(puts) == 1:
+            # Another component's put, merged from a read taken before this one's put
+            ecr.replication_rules = OTHER_RULES
+        return result
+    monkeypatch.setattr(ecr, "_PutReplicationConfiguration", put_then_overwritten)
+
+    _, calls = repo_deploy.deploy({**REPO, "replication": {"destinations": [{"region": "us-west-2"}]}})
+    assert calls.counts()["ecr.PutReplicationConfiguration"] == 2
+    assert calls.counts()["ecr.DescribeRegistry"] == 3
+    assert ecr.replication_rules == OTHER_RULES + [replication_rule("us-west-2")]
+
+def test_replication_create_and_remove(repo_deploy, ecr):
+    destinations = [{"region": "us-west-2"}, {"region": "eu-west-1", "registry_id": "210987654321"}]
+    rule = {**replication_rule("us-west-2"), "destinations": [
+        {"region": "us-west-2", "registryId": "123456789012"}, {"region": "eu-west-1", "registryId": "210987654321"}
+    ]}
+    result, calls = repo_deploy.deploy({**REPO, "replication": {"destinations": destinations}})
+    assert calls.counts()["ecr.PutReplicationConfiguration"] == 1
+    assert ecr.replication_rules == [rule]
+    assert result["props"]["replication_rule"] == rule
+    assert result["props"]["replicated_uris"] == {
+        "us-east-1": "123456789012.dkr.ecr.us-east-1.amazonaws.com/app-repo",
+        "us-west-2": "123456789012.dkr.ecr.us-west-2.amazonaws.com/app-repo",
+        "210987654321/eu-west-1": "210987654321.dkr.ecr.eu-west-1.amazonaws.com/app-repo"
+    }
+
+    result, calls = repo_deploy.deploy(REPO)
+    assert calls.counts()["ecr.PutReplicationConfiguration"] == 1
+    assert ecr.replication_rules == []
+    assert "replication_rule" not in result["props"]
+
+def test_replication_rule_removed_on_delete(repo_deploy, ecr):
+    ecr.replication_rules = OTHER_RULES[:1]
+    repo_deploy.deploy({**REPO, "replication": {"destinations": [{"region": "us-west-2"}]}})
+    _, calls = repo_deploy.deploy({**REPO, "replication": {"destinations": [{"region": "us-west-2"}]}}, op="delete")
+    assert calls.counts()["ecr.DeleteRepository"] == 1
+    assert ecr.replication_rules == OTHER_RULES[:1]
+
+def test_rename(repo_deploy, ecr):
+    repo_deploy.deploy(REPO)
+    result, calls = repo_deploy.deploy({**REPO, "name": "app-repo-2"})
+    assert calls.counts() == {"ecr.DescribeRepositories": 1, "ecr.CreateRepository": 1, "ecr.DeleteRepository": 1}
+    assert list(ecr.repositories) == ["app-repo-2"]
+    assert result["props"]["name"] == "app-repo-2"
+
+def test_delete(repo_deploy, ecr):
+    repo_deploy.deploy(REPO)
+    _, calls = repo_deploy.deploy(REPO, op="delete")
+    assert calls.counts() == {"ecr.DeleteRepository": 1}
+    assert not ecr.repositories
+
+FLEET = {
+    "tags": {"team": "a"},
+    "repositories": {
+        "api": {"name": "app-api"},
+        "web": {"name": "app-web", "tags": {"team": "web"}}
+    }
+}
+
+def fleet_tags(ecr):
+    return {name: ecr.tags[repo["repositoryArn"]] for name, repo in ecr.repositories.items()}
+
+def test_fleet_create(repo_deploy, ecr):
+    result, calls = repo_deploy.deploy(FLEET)
+    # The batched describe misses, so the registry is listed instead
+    assert calls.counts() == {"ecr.DescribeRepositories": 2, "ecr.CreateRepository": 2}
+    assert fleet_tags(ecr) == {"app-api": {"team": "a"}, "app-web": {"team": "web"}}
+    assert {k: v["name"] for k, v in result["props"]["repositories"].items()} == {"api": "app-api", "web": "app-web"}
+
+def test_fleet_describe_batches(repo_deploy, ecr):
+    ecr._CreateRepository(repositoryName="app-api")
+    repo_deploy.container = load_lambda("repo")
+    repo_deploy.container[0].DESCRIBE_BATCH_SIZE = 1
+    ecr.attach(repo_deploy.container[1].get_client("ecr"))
+    _, calls = repo_deploy.deploy(FLEET, warm=True)
+    # app-api's batch is found, app-web's misses and the rest come from one listing
+    assert calls.counts() == {
+        "ecr.DescribeRepositories": 3, "ecr.ListTagsForResource": 1,
+        "ecr.TagResource": 1, "ecr.CreateRepository": 1
+    }
+    assert fleet_tags(ecr) == {"app-api": {"team": "a"}, "app-web": {"team": "web"}}
+
+def test_fleet_tag_change(repo_deploy, ecr):
+    repo_deploy.deploy({**FLEET, "tags": {"team": "a", "old": "x"}})
+    _, calls = repo_deploy.deploy({**FLEET, "tags": {"team": "b"}})
+    # app-web keeps its own team tag, so it only loses old
+    assert calls.counts() == {
+        "ecr.DescribeRepositories": 1, "ecr.ListTagsForResource": 2,
+        "ecr.TagResource": 1, "ecr.UntagResource": 2
+    }
+    assert fleet_tags(ecr) == {"app-api": {"team": "b"}, "app-web": {"team": "web"}}
+
+def test_fleet_config_change(repo_deploy, ecr):
+    repo_deploy.deploy(FLEET)
+    repositories = {**FLEET["repositories"], "api": {"name": "app-api", "scan_on_push": True, "changeable_tags": "IMMUTABLE"}}
+    _, calls = repo_deploy.deploy({**FLEET, "repositories": repositories})
+    assert calls.counts() == {
+        "ecr.DescribeRepositories": 1, "ecr.ListTagsForResource": 2,
+        "ecr.PutImageScanningConfiguration": 1, "ecr.PutImageTagMutability": 1
+    }
+    assert ecr.repositories["app-api"]["imageTagMutability"] == "IMMUTABLE"
+    assert ecr.repositories["app-web"]["imageTagMutability"] == "MUTABLE"
+
+def test_fleet_shrink(repo_deploy, ecr):
+    repo_deploy.deploy(FLEET)
+    result, calls = repo_deploy.deploy({**FLEET, "repositories": {"api": FLEET["repositories"]["api"]}})
+    assert calls.counts() == {"ecr.DescribeRepositories": 1, "ecr.ListTagsForResource": 1, "ecr.DeleteRepository": 1}
+    assert list(ecr.repositories) == ["app-api"]
+    assert list(result["props"]["repositories"]) == ["api"]
+
+def test_fleet_key_move_keeps_repository(repo_deploy, ecr):
+    repo_deploy.deploy(FLEET)
+    result, calls = repo_deploy.deploy({**FLEET, "repositories": {"backend": FLEET["repositories"]["api"], "web": FLEET["repositories"]["web"]}})
+    assert "ecr.DeleteRepository" not in calls.counts()
+    assert "ecr.CreateRepository" not in calls.counts()
+    assert result["props"]["repositories"]["backend"]["name"] == "app-api"
+
+def test_fleet_create_retries_only_what_failed(repo_deploy, ecr, monkeypatch):
+    create = ecr._CreateRepository
+    failures = []
+    def fail_web_once(repositoryName, **kwargs):
+        if repositoryName == "app-web" and not failures:
+            failures.append(repositoryName)
+            return error("KmsException", "KMS is having a moment")
+        return create(repositoryName, **kwargs)
+    monkeypatch.setattr(ecr, "_CreateRepository", fail_web_once)
+
+    result, calls = repo_deploy.deploy(FLEET)
+    assert [p["repositoryName"] for op, p in ecr.requests if op == "CreateRepository"].count("app-api") == 1
+    assert calls.counts()["ecr.CreateRepository"] == 3
+    assert sorted(ecr.repositories) == ["app-api", "app-web"]
+    assert sorted(result["props"]["repositories"]) == ["api", "web"]
+
+def test_fleet_delete(repo_deploy, ecr):
+    repo_deploy.deploy(FLEET)
+    _, calls = repo_deploy.deploy(FLEET, op="delete")
+    assert calls.counts() == {"ecr.DeleteRepository": 2}
+    assert not ecr.repositories
+
+def test_fleet_replication(repo_deploy, ecr):
+    result, _ = repo_deploy.deploy({**FLEET, "replication": {"destinations": [{"region": "us-west-2"}]}})
+    assert ecr.replication_rules == [replication_rule("us-west-2", filters=["app-api", "app-web"])]
+    assert result["props"]["repositories"]["web"]["replicated_uris"]["us-west-2"] == "123456789012.dkr.ecr.us-west-2.amazonaws.com/app-web"
+
+def test_fleet_replication_needs_filters_past_rule_limit(ecr):
+    lambda_function, extutil = load_lambda("repo")
+    ecr.attach(extutil.get_client("ecr"))
+    cdef = {"repositories": {f"r{i}": {} for i in range(101)}, "replication": {"destinations": [{"region": "us-west-2"}]}}
+    result = lambda_function.lambda_handler({
+        "op": "upsert", "component_name": "app", "project_code": "ck", "repo_id": "github.com/o/r",
+        "bucket": BUCKET, "prev_state": {}, "component_def": cdef
+    }, LambdaContext())
+    assert "repository_filters" in result["error"]
+    assert not ecr.requests
+
+def test_switch_to_repositories_deletes_single_repository(repo_deploy, ecr):
+    repo_deploy.deploy(REPO)
+    result, calls = repo_deploy.deploy(FLEET)
+    assert calls.counts()["ecr.DeleteRepository"] == 1
+    assert sorted(ecr.repositories) == ["app-api", "app-web"]
+    assert sorted(result["props"]["repositories"]) == ["api", "web"]
+
+def test_switch_from_repositories_deletes_fleet(repo_deploy, ecr):
+    repo_deploy.deploy(FLEET)
+    result, calls = repo_deploy.deploy({**REPO, "name": "app-api"})
+    # app-api is the new single repository, so only app-web goes
+    assert calls.counts()["ecr.DeleteRepository"] == 1
+    assert sorted(ecr.repositories) == ["app-api"]
+    assert result["props"]["name"] == "app-api"
+
+@pytest.fixture
+def pullthrough_deploy(ecr):
+    return Deployer("pullthrough", [ecr])
+
+CREDENTIAL = "arn:aws:secretsmanager:us-east-1:123456789012:secret:ecr-pullthroughcache/hub"
+PULLTHROUGH = {"ecr_repository_prefix": "mirror", "upstream_registry": "docker-hub", "credential_arn": CREDENTIAL}
+
+def test_pullthrough_create(pullthrough_deploy, ecr):
+    result, calls = pullthrough_deploy.deploy(PULLTHROUGH)
+    assert calls.counts() == {"ecr.DescribePullThroughCacheRules": 1, "ecr.CreatePullThroughCacheRule": 1}
+    assert ecr.pull_through_rules["mirror"]["upstreamRegistryUrl"] == "registry-1.docker.io"
+    assert result["props"]["cache_uri_prefix"] == "123456789012.dkr.ecr.us-east-1.amazonaws.com/mirror"
+    assert result["props"]["credential_arn"] == CREDENTIAL
+
+def test_pullthrough_no_change(pullthrough_deploy):
+    pullthrough_deploy.deploy(PULLTHROUGH)
+    _, calls = pullthrough_deploy.deploy(PULLTHROUGH)
+    assert calls.counts() == {"ecr.DescribePullThroughCacheRules": 1}
+
+def test_pullthrough_credential_update(pullthrough_deploy, ecr):
+    pullthrough_deploy.deploy(PULLTHROUGH)
+    result, calls = pullthrough_deploy.deploy({**PULLTHROUGH, "credential_arn": CREDENTIAL + "-2"})
+    assert calls.counts() == {"ecr.DescribePullThroughCacheRules": 1, "ecr.UpdatePullThroughCacheRule": 1}
+    assert ecr.pull_through_rules["mirror"]["credentialArn"] == CREDENTIAL + "-2"
+    assert result["props"]["credential_arn"] == CREDENTIAL + "-2"
+
+def test_pullthrough_upstream_change_replaces_rule(pullthrough_deploy, ecr):
+    pullthrough_deploy.deploy(PULLTHROUGH)
+    result, calls = pullthrough_deploy.deploy({"ecr_repository_prefix": "mirror", "upstream_registry_url": "public.ecr.aws", "upstream_registry": "ecr-public"})
+    assert calls.counts() == {
+        "ecr.DescribePullThroughCacheRules": 1, "ecr.DeletePullThroughCacheRule": 1, "ecr.CreatePullThroughCacheRule": 1
+    }
+    assert ecr.pull_through_rules["mirror"]["upstreamRegistryUrl"] == "public.ecr.aws"
+    assert "credentialArn" not in ecr.pull_through_rules["mirror"]
+    assert result["props"]["upstream_registry_url"] == "public.ecr.aws"
+
+def test_pullthrough_prefix_rename_removes_old_rule(pullthrough_deploy, ecr):
+    pullthrough_deploy.deploy(PULLTHROUGH)
+    result, calls = pullthrough_deploy.deploy({**PULLTHROUGH, "ecr_repository_prefix": "hub"})
+    assert calls.sequence() == ["ecr.DescribePullThroughCacheRules", "ecr.CreatePullThroughCacheRule", "ecr.DeletePullThroughCacheRule"]
+    assert list(ecr.pull_through_rules) == ["hub"]
+    assert result["props"]["cache_uri_prefix"] == "123456789012.dkr.ecr.us-east-1.amazonaws.com/hub"
+
+def test_pullthrough_delete(pullthrough_deploy, ecr):
+    pullthrough_deploy.deploy(PULLTHROUGH)
+    _, calls = pullthrough_deploy.deploy(PULLTHROUGH, op="delete")
+    assert calls.counts() == {"ecr.DeletePullThroughCacheRule": 1}
+    assert not ecr.pull_through_rules
+
+class CodebuildChildren:
+    """The Codebuild Project and Build extensions. A build pushes the image with the tags
+    the project was set up with"""
+    def __init__(self, ecr):
+        self.ecr = ecr
+        self.builds = 0
+        self.project_def = None
+
+    def project(self, payload):
+        self.project_def = payload["component_def"]
+        return {"success": True, "props": {"name": "ck-app-build"}, "links": {}}
+
+    def build(self, payload):
+        self.builds += 1
+        env = self.project_def["environment_variables"]
+        tags = [v for k, v in sorted(env.items()) if k.startswith("IMAGE_TAG_")]
+        self.ecr.push(env["IMAGE_REPO_NAME"], tags, json.dumps({"schemaVersion": 2, "build": self.builds}))
+        return {"success": True, "props": {"build_id": f"ck-app-build:{self.builds}"}, "links": {}}
+
+@pytest.fixture
+def source(tmp_path):
+    """source(files) zips files to the deploy's s3_object_name, as the CloudKommand CLI does"""
+    extutil = load_lambda("image")[1]
+    s3 = LocalS3()
+    def upload(files):
+        for name, data in files.items():
+            (tmp_path / "src" / name).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / "src" / name).write_bytes(data)
+        extutil.create_zip(str(tmp_path / "source.zip"), str(tmp_path / "src"))
+        s3.put(BUCKET, SOURCE_KEY, (tmp_path / "source.zip").read_bytes())
+    upload.s3 = s3
+    return upload
+
+@pytest.fixture
+def image_deploy(ecr, source, monkeypatch):
+    monkeypatch.setenv("codebuild_project_lambda_name", PROJECT_LAMBDA)
+    monkeypatch.setenv("codebuild_build_lambda_name", BUILD_LAMBDA)
+    ecr._CreateRepository(repositoryName="app-image")
+    children = CodebuildChildren(ecr)
+    deployer = Deployer("image", [ecr, source.s3, LocalLambda({PROJECT_LAMBDA: children.project, BUILD_LAMBDA: children.build})],
+        s3_object_name=SOURCE_KEY)
+    source({"Dockerfile": b"FROM python:3.12\nCOPY . /app\n", "app/main.py": b"print('hello')\n"})
+    deployer.deploy(IMAGE)
+    deployer.children = children
+    return deployer
+
+IMAGE = {"repo_name": "app-image", "docker_tags": ["latest"], "trust_level": "code"}
+SOURCE_READS = ["s3.HeadObject", "s3.GetObject"]
+BUILD = ["lambda.Invoke", "lambda.Invoke", "ecr.DescribeImages"]
+
+def test_image_no_change(image_deploy):
+    result, calls = image_deploy.deploy(IMAGE)
+    assert calls.sequence() == SOURCE_READS
+    assert image_deploy.children.builds == 1
+    assert result["props"]["tags"] == ["latest"]
+
+def test_image_tag_change_retags(image_deploy, ecr):
+    result, calls = image_deploy.deploy({**IMAGE, "docker_tags": ["latest", "v2"]})
+    # latest already points at the image, so its put_image gets ImageAlreadyExistsException and moves on
+    assert calls.sequence() == SOURCE_READS + ["ecr.BatchGetImage", "ecr.PutImage", "ecr.PutImage", "ecr.DescribeImages"]
+    assert image_deploy.children.builds == 1
+    assert set(result["props"]["tag_digests"]) == {"latest", "v2"}
+
+def test_image_build_def_change_rebuilds(image_deploy):
+    _, calls = image_deploy.deploy({**IMAGE, "docker_build_options": "--build-arg VERSION=2"})
+    assert calls.sequence() == SOURCE_READS + BUILD
+    assert image_deploy.children.builds == 2
+
+def test_image_code_change_rebuilds(image_deploy, source):
+    source({"app/main.py": b"print('goodbye')\n"})
+    result, calls = image_deploy.deploy(IMAGE)
+    assert calls.sequence() == SOURCE_READS + BUILD
+    assert image_deploy.children.builds == 2
+    assert result["props"]["initial_etag"] == source.s3.objects[(BUCKET, SOURCE_KEY)]["etag"]
+
+def test_image_repo_change_rebuilds(image_deploy, ecr):
+    ecr._CreateRepository(repositoryName="app-image-2")
+    # Only tags and the repository changed, but the image isn't in the new repository to retag
+    result, calls = image_deploy.deploy({**IMAGE, "repo_name": "app-image-2", "docker_tags": ["latest", "v2"]})
+    assert calls.sequence() == SOURCE_READS + BUILD
+    assert image_deploy.children.builds == 2
+    assert result["props"]["uri"].startswith("123456789012.dkr.ecr.us-east-1.amazonaws.com/app-image-2@")
+    assert set(result["props"]["tag_digests"]) == {"latest", "v2"}
@@ -0,0 +1,38 @@
+import json
+import os
+
+import pytest
+
+from conftest import ROOT, load_lambda
+
+# Documentation-only keywords in kommand.json, left out of the lambdas' copies
+ANNOTATIONS = ["description", "default", "common"]
+
+with open(os.path.join(ROOT, "kommand.json")) as f:
+    KOMMAND = json.load(f)
+
+def strip_annotations(schema):
+    if isinstance(schema, dict):
+        return {k: strip_annotations(v) for k, v in schema.items() if k not in ANNOTATIONS}
+    elif isinstance(schema, list):
+        return [strip_annotations(v) for v in schema]
+    return schema
+
+@pytest.mark.parametrize("component", ["repo", "image", "pullthrough"])
+def test_component_def_schema_matches_kommand(component):
+    lambda_function, _ = load_lambda(component)
+    assert lambda_function.COMPONENT_DEF_SCHEMA == strip_annotations(KOMMAND["components"][component]["input"])
+
+@pytest.mark.parametrize("component", ["repo", "image", "pullthrough"])
+def test_examples_validate(component):
+    lambda_function, extutil = load_lambda(component)
+    validator = extutil.get_validator(lambda_function.COMPONENT_DEF_SCHEMA)
+    for example in KOMMAND["components"][component].get("examples") or []:
+        validator({k: v for k, v in example["definition"].items() if k != "type"})
+
+def test_extutil_copies_are_identical():
+    copies = []
+    for component in ["repo", "image", "pullthrough"]:
+        with open(os.path.join(ROOT, component, "extutil.py")) as f:
+            copies.append(f.read())
+    assert copies[0] == copies[1] == copies[2]
@@ -0,0 +1,69 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+MB = 1024 * 1024
+
+@pytest.fixture
+def s3(extutil, local_s3):
+    return local_s3(extutil)
+
+def write_tree(path, files):
+    for name, data in files.items():
+        full_path = os.path.join(path, name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as f:
+            f.write(data)
+
+def zip_on_disk(extutil, tmp_path, tree, **options):
+    extutil.create_zip(str(tmp_path / "disk.zip"), str(tree), **options)
+    return (tmp_path / "disk.zip").read_bytes()
+
+def test_small_archive_uses_put_object(extutil, s3, tmp_path):
+    write_tree(tmp_path / "tree", {"Dockerfile": b"FROM scratch\n", "app/main.py": b"print(1)\n" * 100})
+
+    etag = extutil.create_zip_s3("ck-bucket", "source.zip", str(tmp_path / "tree"), s3_client=extutil.get_client("s3"), reproducible=True)
+    assert [name for name, _ in s3.requests] == ["PutObject"]
+    assert etag == extutil.get_client("s3").head_object(Bucket="ck-bucket", Key="source.zip")["ETag"]
+    assert s3.get("ck-bucket", "source.zip") == zip_on_disk(extutil, tmp_path, tmp_path / "tree", reproducible=True)
+
+def test_large_archive_uses_multipart_upload(extutil, s3, tmp_path):
+    write_tree(tmp_path / "tree", {"blob.bin": os.urandom(12 * MB), "app/main.py": b"print(1)\n" * 100})
+
+    etag = extutil.create_zip_s3(
+        "ck-bucket", "source.zip", str(tmp_path / "tree"), part_size=5 * MB, upload_workers=2,
+        reproducible=True, store_extensions=True
+    )
+    calls = [name for name, _ in s3.requests]
+    assert calls[0] == "CreateMultipartUpload" and calls[-1] == "CompleteMultipartUpload"
+    assert calls.count("UploadPart") == 3
+    assert etag.endswith('-3"')
+    assert etag == extutil.get_client("s3").head_object(Bucket="ck-bucket", Key="source.zip")["ETag"]
+    assert s3.get("ck-bucket", "source.zip") == zip_on_disk(extutil, tmp_path, tmp_path / "tree", reproducible=True, store_extensions=True)
+
+def test_streamed_members_on_non_seekable_writer(extutil, s3, tmp_path, monkeypatch):
+    files = {"big.txt": b"line of text\n" * 200000, "small.txt": b"hello"}
+    write_tree(tmp_path / "tree", files)
+    # Streams every member through zipfile, which has to use data descriptors on a non-seekable writer
+    monkeypatch.setattr(extutil, "ZIP_MAX_PARALLEL_MEMBER_BYTES", 0)
+    assert not extutil.S3MultipartWriter("ck-bucket", "source.zip").seekable()
+
+    extutil.create_zip_s3("ck-bucket", "source.zip", str(tmp_path / "tree"), reproducible=True)
+    with zipfile.ZipFile(io.BytesIO(s3.get("ck-bucket", "source.zip"))) as z:
+        assert z.testzip() is None
+        assert {i.filename: z.read(i) for i in z.infolist()} == files
+        assert all(i.flag_bits & 0x08 for i in z.infolist())
+
+def test_failed_part_aborts_upload(extutil, s3, tmp_path, monkeypatch):
+    write_tree(tmp_path / "tree", {"blob.bin": os.urandom(11 * MB)})
+    def fail(**kwargs):
+        return {"Error": {"Code": "NoSuchUpload", "Message": "The specified upload does not exist."}, "status": 404}
+    monkeypatch.setattr(s3, "_UploadPart", fail)
+
+    with pytest.raises(extutil.ClientError):
+        extutil.create_zip_s3("ck-bucket", "source.zip", str(tmp_path / "tree"), part_size=5 * MB, store_extensions=True)
+    assert [name for name, _ in s3.requests][-1] == "AbortMultipartUpload"
+    assert not s3.uploads
+    assert ("ck-bucket", "source.zip") not in s3.objects